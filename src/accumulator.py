@@ -0,0 +1,186 @@
+from analysis import (
+    bit_matrix,
+    measured_bits,
+    count_tables,
+    data_tables,
+    process_tables,
+)
+from run_table import RunTable
+import numpy as np
+import json
+import os
+import pickle
+import sys
+
+# Sufficient statistics of the analysis: every metric of process_data_pandas is a
+# function of the per-length count tables (runs for each alice_basis, bob_basis,
+# alice_bit, bob_bit), so a campaign is summarized by 16 integers per length.
+# Tables can be updated as the counts of each circuit arrive and merged across
+# shards and campaigns; they are saved as a few KB of JSON.
+
+
+class RunAccumulator:
+
+    def __init__(self, every=50):
+        # length -> int64 array [ab, bb, a, b]
+        self.tables = {}
+        # circuits simulated between two live updates
+        self.every = every
+        self.rows = None
+
+    def add_tables(self, lengths, tables):
+        for length, table in zip(np.asarray(lengths).tolist(), tables):
+            if length in self.tables:
+                self.tables[length] = self.tables[length] + table
+            else:
+                self.tables[length] = np.array(table, dtype=np.int64)
+        return self
+
+    def add_data(self, data):
+        # data rows after update_data
+        return self.add_tables(*data_tables(data))
+
+    def merge(self, other):
+        return self.add_tables(*other.lengths_tables())
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def lengths_tables(self):
+        lengths = np.array(sorted(self.tables), dtype=np.int64)
+        tables = np.zeros((len(lengths), 2, 2, 2, 2), dtype=np.int64)
+        for idx, length in enumerate(lengths.tolist()):
+            tables[idx] = self.tables[length]
+        return lengths, tables
+
+    def num_runs(self):
+        return {length: int(table.sum()) for length, table in self.tables.items()}
+
+    def process(self):
+        # result_df of process_data_pandas
+        return process_tables(*self.lengths_tables())
+
+    def report(self):
+        result_df = self.process()
+        runs = self.num_runs()
+        return ", ".join(
+            f"{length}: QUBER {quber:.3f}, CHSH {chsh:.3f} ({runs[length]} runs)"
+            for length, quber, chsh in zip(
+                result_df["length"], result_df["QUBER"], result_df["CHSH"]
+            )
+        )
+
+    # counts as they arrive
+
+    def watch(self, data, circuits):
+        # index the data rows by counts entry (the circuit_idx of the rows), so
+        # that add_counts can find the rows of a range of circuits. Template
+        # circuits have one entry per shot.
+        columns = self._columns(data)
+        order = np.argsort(columns["entry"], kind="stable")
+        self.rows = {key: value[order] for key, value in columns.items()}
+        shots = [(circuit.metadata or {}).get("shots", 1) for circuit in circuits]
+        self.entry_start = np.concatenate([[0], np.cumsum(shots)])
+
+    def add_counts(self, start, circuit_counts):
+        # circuit_counts: lists of single-shot counts of circuits start, start + 1, ...
+        counts = [counts for counts_list in circuit_counts for counts in counts_list]
+        if not counts:
+            return self
+        first = self.entry_start[start]
+        low, high = np.searchsorted(self.rows["entry"], [first, first + len(counts)])
+        rows = {key: value[low:high] for key, value in self.rows.items()}
+        return self._add_rows(rows, bit_matrix(counts), rows["entry"] - first)
+
+    def add_completed(self, completed):
+        # circuits completed before a restart (circuit index -> counts), a
+        # contiguous range at a time
+        indices = sorted(completed)
+        first = 0
+        for pos in range(1, len(indices) + 1):
+            if pos == len(indices) or indices[pos] != indices[pos - 1] + 1:
+                self.add_counts(
+                    indices[first],
+                    [completed[idx] for idx in indices[first:pos]],
+                )
+                first = pos
+        return self
+
+    def add_window(self, rows, counts, first_entry):
+        # rows and flat counts of a window of run_streaming_simulation
+        if not rows:
+            return self
+        columns = self._columns(rows)
+        return self._add_rows(
+            columns, bit_matrix(counts), columns["entry"] - first_entry
+        )
+
+    def _columns(self, data):
+        if not isinstance(data, RunTable):
+            data = RunTable.from_rows(data)
+        columns = data.columns()
+        # counts entry of each run
+        columns["entry"] = columns.pop("circuit_idx")
+        return columns
+
+    def _add_rows(self, rows, bits, entry):
+        alice_bit, bob_bit = measured_bits(
+            rows["length"], rows["alice_bit"], rows["virtual_qb"], entry, bits
+        )
+        return self.add_tables(
+            *count_tables(
+                rows["length"],
+                rows["alice_basis"],
+                rows["bob_basis"],
+                alice_bit,
+                bob_bit,
+            )
+        )
+
+    # serialization
+
+    def to_dict(self):
+        return {
+            "tables": {
+                str(length): table.reshape(-1).tolist()
+                for length, table in sorted(self.tables.items())
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, content):
+        accumulator = cls()
+        for length, table in content["tables"].items():
+            accumulator.tables[int(length)] = np.array(table, dtype=np.int64).reshape(
+                2, 2, 2, 2
+            )
+        return accumulator
+
+    def save(self, path="data/count_tables.json"):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file)
+
+    @classmethod
+    def load(cls, path="data/count_tables.json"):
+        with open(path, "r") as file:
+            return cls.from_dict(json.load(file))
+
+
+def merge_campaigns(folders):
+    # count tables of several campaigns (folders with count_tables.json) merged
+    accumulator = RunAccumulator()
+    for folder in folders:
+        accumulator += RunAccumulator.load(os.path.join(folder, "count_tables.json"))
+    return accumulator
+
+
+if __name__ == "__main__":
+    # python accumulator.py folder1 folder2 ... output_folder: merged count tables
+    # and processed data of the campaigns written to output_folder
+    *folders, output_folder = sys.argv[1:]
+    accumulator = merge_campaigns(folders)
+    os.makedirs(output_folder, exist_ok=True)
+    accumulator.save(os.path.join(output_folder, "count_tables.json"))
+    with open(os.path.join(output_folder, "processed_data.pkl"), "wb") as file:
+        pickle.dump(accumulator.process(), file)
+    print(accumulator.report())
@@ -0,0 +1,195 @@
+from sequential import simulate_round, add_round, write_rounds
+from simulation import SimulationResources
+from analysis import data_tables, table_metrics
+from accumulator import RunAccumulator
+from run_table import RunTable
+import pandas as pd
+import numpy as np
+import pickle
+
+# Adaptive sweep: instead of a fixed lengths list, lengths are simulated on a
+# coarse grid first and new ones are placed, round after round, in the middle of
+# the intervals where QBER crosses the security threshold or where QBER and CHSH
+# change the most (in units of their errors). The sweep stops when no interval is
+# both wider than the resolution and significant, or when the runs budget is spent.
+
+
+def coarse_grid(max_length, num_points):
+    # evenly spaced lengths from 1 to max_length
+    num_points = min(num_points, max_length)
+    return np.unique(np.linspace(1, max_length, num_points).round().astype(int))
+
+
+def interval_scores(metrics, threshold):
+    # change of QUBER and CHSH across each interval of consecutive lengths, in
+    # units of its error (the larger of the two); intervals where QUBER crosses
+    # the threshold score infinity
+    scores = np.zeros(len(metrics["QUBER"]) - 1)
+    for key in ["QUBER", "CHSH"]:
+        change = np.abs(np.diff(metrics[key]))
+        error = np.hypot(metrics[f"{key}_error"][:-1], metrics[f"{key}_error"][1:])
+        scores = np.maximum(scores, change / np.maximum(error, 1e-12))
+    above = metrics["QUBER"] >= threshold
+    scores[above[:-1] != above[1:]] = np.inf
+    return scores
+
+
+def refine(lengths, scores, resolution, num_points, min_score=2.0):
+    # midpoints of the best scoring intervals wider than the resolution whose
+    # change is significant (min_score errors, at most num_points), best first
+    # (an interval of gap 1 has no new length in it, whatever the resolution)
+    gaps = np.diff(lengths)
+    candidates = np.flatnonzero((gaps > max(resolution, 1)) & (scores >= min_score))
+    best = candidates[np.argsort(-scores[candidates], kind="stable")][:num_points]
+    return (lengths[best] + lengths[best + 1]) // 2
+
+
+def threshold_crossing(lengths, qber, threshold):
+    # first length at which QUBER reaches the threshold (linear interpolation
+    # between the lengths around it), None if it never does
+    above = np.flatnonzero(qber >= threshold)
+    if len(above) == 0:
+        return None
+    idx = above[0]
+    if idx == 0:
+        return float(lengths[0])
+    low, high = qber[idx - 1], qber[idx]
+    return float(
+        lengths[idx - 1]
+        + (threshold - low) / (high - low) * (lengths[idx] - lengths[idx - 1])
+    )
+
+
+def run_adaptive(
+    master_chain,
+    protocol,
+    runs=500,
+    max_length=None,
+    coarse_points=8,
+    refine_points=4,
+    resolution=2,
+    threshold=0.11,
+    budget=None,
+    baseline_lengths=None,
+    seed=None,
+    rng=None,
+    templates=False,
+    native=False,
+    packing=False,
+    **simulation_options,
+):
+    # simulation_options: passed to run_simulation (device, QPU, method, ...).
+    # max_length: longest length (up to len(master_chain) - 1 for BB84 and BBM92,
+    # required for Id-BB84, whose runs all fit on one qubit). budget: cap on the
+    # total runs (None: until the grid is refined). Simulators, noise models and
+    # worker pools are reused across the rounds. Writes the data and counts of
+    # all rounds as run_simulation would, returns the per-length results.
+    if max_length is None:
+        if protocol == "Id-BB84":
+            raise Exception("max_length is needed for an adaptive Id-BB84 sweep.")
+        max_length = len(master_chain) - 1
+    if protocol != "Id-BB84" and max_length > len(master_chain) - 1:
+        raise Exception(
+            f"max_length {max_length} does not fit on the master chain ({len(master_chain)} qubits)."
+        )
+    if resolution < 1:
+        raise Exception("resolution must be at least 1 (lengths are integers).")
+    if rng is None:
+        rng = np.random.default_rng(seed)
+
+    accumulator = RunAccumulator()
+    data = RunTable()
+    counts = []
+    new_lengths = coarse_grid(max_length, coarse_points)
+    spent = 0
+    round_idx = 0
+
+    resources = SimulationResources()
+    try:
+        while len(new_lengths):
+            if budget is not None and spent + runs * len(new_lengths) > budget:
+                # as many new lengths as the budget allows, best scoring first (the
+                # threshold crossing is never dropped for a flat interval)
+                new_lengths = new_lengths[: (budget - spent) // runs]
+                if len(new_lengths) == 0:
+                    print("Adaptive sweep: runs budget spent.")
+                    break
+            new_lengths = np.sort(new_lengths)
+            round_idx += 1
+            round_data, round_counts = simulate_round(
+                new_lengths.tolist(),
+                runs,
+                master_chain,
+                protocol,
+                rng,
+                seed,
+                len(counts),
+                templates=templates,
+                native=native,
+                packing=packing,
+                resources=resources,
+                **simulation_options,
+            )
+            accumulator.add_tables(*data_tables(round_data))
+            add_round(data, counts, round_data, round_counts)
+            spent += runs * len(new_lengths)
+
+            # intervals between the lengths simulated so far (in increasing order)
+            lengths, tables = accumulator.lengths_tables()
+            metrics = table_metrics(tables)
+            scores = interval_scores(metrics, threshold)
+            crossing = threshold_crossing(lengths, metrics["QUBER"], threshold)
+            print(
+                f"Round {round_idx}: lengths {new_lengths.tolist()}, {spent} runs so far, QBER threshold crossed at "
+                + ("no length." if crossing is None else f"length {crossing:.1f}.")
+            )
+            new_lengths = refine(lengths, scores, resolution, refine_points)
+    finally:
+        resources.close()
+
+    write_rounds(
+        data,
+        counts,
+        simulation_options.get("device", False),
+        simulation_options.get("storage", "pickle"),
+    )
+
+    report = adaptive_report(
+        accumulator, threshold, runs, spent, len(counts), baseline_lengths
+    )
+    with open("data/adaptive_report.pkl", "wb") as file:
+        pickle.dump(report, file)
+    return report
+
+
+def adaptive_report(
+    accumulator, threshold, runs, spent, num_circuits, baseline_lengths
+):
+    lengths, tables = accumulator.lengths_tables()
+    metrics = table_metrics(tables)
+    report = pd.DataFrame(
+        {
+            "length": lengths,
+            "runs": tables.sum(axis=(1, 2, 3, 4)),
+            "QUBER": metrics["QUBER"],
+            "QUBER_error": metrics["QUBER_error"],
+            "CHSH": metrics["CHSH"],
+            "CHSH_error": metrics["CHSH_error"],
+        }
+    )
+    crossing = threshold_crossing(lengths, metrics["QUBER"], threshold)
+    report.attrs["threshold_crossing"] = crossing
+    print(report.to_string(index=False))
+    print(
+        f"Adaptive sweep: {len(lengths)} lengths, {spent} runs in {num_circuits} circuits."
+        + (
+            ""
+            if baseline_lengths is None
+            else f" A fixed grid of {len(baseline_lengths)} lengths takes {runs * len(baseline_lengths)} runs."
+        )
+    )
+    if crossing is None:
+        print(f"QBER stays below {threshold} up to length {lengths[-1]}.")
+    else:
+        print(f"QBER crosses {threshold} at length {crossing:.1f}.")
+    return report
@@ -1,25 +1,59 @@
 import pandas as pd
 import numpy as np
 from scipy.stats import norm
+from operator import itemgetter
+from run_table import RunTable
 
 
-def update_data(data, counts):
+def bit_matrix(counts):
+    # measured bitstring of each circuit (first key of its counts) as a uint8
+    # matrix: bits[circuit_idx, cl_bit] (bitstrings are little endian)
+    bitstrings = [next(iter(count)) for count in counts]
+    width = len(bitstrings[0])
+    bits = np.frombuffer("".join(bitstrings).encode(), dtype=np.uint8) - ord("0")
+    return bits.reshape(len(bitstrings), width)[:, ::-1]
+
+
+def data_column(data, idx, dtype=np.int64):
+    # column idx of the data rows as an array
+    return np.fromiter(map(itemgetter(idx), data), dtype=dtype, count=len(data))
+
+
+def measured_bits(length, alice_bit, virtual_qb, entry, bits):
+    # Alice and Bob bits of runs given as columns (alice_bit -1 where measured, as
+    # in BBM92), entry: row of each run in the bit matrix
+    bob_bit = bits[entry, virtual_qb]
+    alice_bit = np.array(alice_bit, dtype=np.int8)
+    missing = np.flatnonzero(alice_bit < 0)
+    alice_bit[missing] = bits[entry[missing], virtual_qb[missing] - length[missing]]
+    return alice_bit, bob_bit
+
 
-    for idx, dat in enumerate(data):
-        (
-            length,
-            alice_basis,
-            bob_basis,
-            alice_bit,
-            bob_bit,
-            virtual_qb,
-            cl_bit,
-            circuit_idx,
-        ) = dat
-        bob_bit = int(list(counts[circuit_idx])[0][::-1][virtual_qb])
-        data[idx][4] = bob_bit
-        if alice_bit == None:
-            alice_bit = int(list(counts[circuit_idx])[0][::-1][virtual_qb - length])
+def update_data(data, counts):
+    # gather every Bob bit (and every missing Alice bit, measured length qubits
+    # before Bob's) from the bit matrix, then fill the rows. counts can also be
+    # the bit matrix itself (see storage.read_bits)
+    bits = counts if isinstance(counts, np.ndarray) else bit_matrix(counts)
+    if isinstance(data, RunTable):
+        # filled in place, column by column
+        data.alice_bit[:], data.bob_bit[:] = measured_bits(
+            data.length, data.alice_bit, data.virtual_qb, data.circuit_idx, bits
+        )
+        return data
+
+    virtual_qb = data_column(data, 5)
+    circuit_idx = data_column(data, 7)
+    bob_bits = bits[circuit_idx, virtual_qb].tolist()
+    for dat, bob_bit in zip(data, bob_bits):
+        dat[4] = bob_bit
+
+    missing = np.flatnonzero(data_column(data, 3, dtype=object) == None)
+    if len(missing):
+        length = data_column(data, 0)
+        alice_bits = bits[
+            circuit_idx[missing], virtual_qb[missing] - length[missing]
+        ].tolist()
+        for idx, alice_bit in zip(missing.tolist(), alice_bits):
             data[idx][3] = alice_bit
 
     return data
@@ -122,166 +156,202 @@ def process_data(data):
     return 0
 
 
-def process_data_pandas(data):
-
-    # Convert data into a DataFrame
-    columns = [
-        "length",
-        "alice_basis",
-        "bob_basis",
-        "alice_bit",
-        "bob_bit",
-        "virtual_qb",
-        "cl_bit",
-        "circuit_idx",
-    ]
-    df = pd.DataFrame(data, columns=columns)
-
-    # Function to compute Wald confidence interval
-    def wald_error(p, n):
-        if n == 0 or np.isnan(p):
-            return (np.nan, np.nan)
-        margin = np.sqrt((p * (1 - p)) / n)
-        return margin
-
-    # Group by length and calculate quantities
-    results = []
-    for length, group in df.groupby("length"):
-        # total = len(group)
+# bases are encoded as X = 0, Z = 1
+BASIS_CODES = {"X": 0, "Z": 1}
+
+
+def encode_basis(bases):
+    bases = np.asarray(bases)
+    if bases.dtype.kind in "iub":
+        return bases.astype(np.int8, copy=False)
+    return (bases == "Z").astype(np.int8)
+
+
+def count_tables(length, alice_basis, bob_basis, alice_bit, bob_bit):
+    # number of runs of each length for every (alice_basis, bob_basis, alice_bit,
+    # bob_bit), built with a single bincount: tables[length_idx, ab, bb, a, b]
+    length = np.asarray(length)
+    code = encode_basis(alice_basis) << 3
+    code |= encode_basis(bob_basis) << 2
+    code |= np.asarray(alice_bit).astype(np.int8, copy=False) << 1
+    code |= np.asarray(bob_bit).astype(np.int8, copy=False)
+
+    if length.dtype.kind in "iu" and len(length):
+        # lengths are small integers: offset instead of sorting
+        low = int(length.min())
+        key = length.astype(np.intp)
+        key -= low
+        key <<= 4
+        key += code
+        num_lengths = int(length.max()) - low + 1
+        tables = np.bincount(key, minlength=num_lengths * 16).reshape(-1, 16)
+        present = tables.sum(axis=1) > 0
+        lengths = np.flatnonzero(present) + low
+        tables = tables[present]
+    else:
+        lengths, length_idx = np.unique(length, return_inverse=True)
+        tables = np.bincount(length_idx * 16 + code, minlength=len(lengths) * 16)
+    return lengths, tables.reshape(len(lengths), 2, 2, 2, 2)
+
+
+def wald_errors(p, n):
+    # Wald confidence interval of the fractions p measured on n runs
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(n > 0, np.sqrt(p * (1 - p) / n), np.nan)
+
+
+def table_metrics(tables):
+    # QUBER, CHSH and the fractions of every length (arrays along the first axis)
+    tables = tables.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total = tables.sum(axis=(1, 2, 3, 4))
+        # runs and equal bits for each pair of bases: [length, ab, bb]
+        pair_runs = tables.sum(axis=(3, 4))
+        pair_equal = tables[..., 0, 0] + tables[..., 1, 1]
 
         # 1. QUBER
-        same_basis = group[group["alice_basis"] == group["bob_basis"]]
-        mismatched = (same_basis["alice_bit"] != same_basis["bob_bit"]).sum()
-        quber = mismatched / len(same_basis) if len(same_basis) > 0 else np.nan
-        quber_error = (
-            wald_error(quber, len(same_basis)) if len(same_basis) > 0 else np.nan
-        )
+        same_basis = pair_runs[:, 0, 0] + pair_runs[:, 1, 1]
+        mismatched = same_basis - pair_equal[:, 0, 0] - pair_equal[:, 1, 1]
+        quber = np.where(same_basis > 0, mismatched / same_basis, np.nan)
 
         # 2. CHSH
-        def correlation(df_subset):
-            if len(df_subset) == 0:
-                return np.nan
-            p_equal = (df_subset["alice_bit"] == df_subset["bob_bit"]).mean()
-            return 2 * p_equal - 1
-
-        e_xx = correlation(
-            group[(group["alice_basis"] == "X") & (group["bob_basis"] == "X")]
-        )
-        e_xz = correlation(
-            group[(group["alice_basis"] == "X") & (group["bob_basis"] == "Z")]
-        )
-        e_zx = correlation(
-            group[(group["alice_basis"] == "Z") & (group["bob_basis"] == "X")]
-        )
-        e_zz = correlation(
-            group[(group["alice_basis"] == "Z") & (group["bob_basis"] == "Z")]
-        )
-        chsh = abs(e_xx - e_xz) + abs(e_zx + e_zz)
-
+        correlation = np.where(pair_runs > 0, 2 * pair_equal / pair_runs - 1, np.nan)
+        e_xx, e_xz = correlation[:, 0, 0], correlation[:, 0, 1]
+        e_zx, e_zz = correlation[:, 1, 0], correlation[:, 1, 1]
+        chsh = np.abs(e_xx - e_xz) + np.abs(e_zx + e_zz)
         # Error for CHSH: propagate variance assuming independence
-        def variance_term(corr):
-            return 0 if np.isnan(corr) else (1 - corr**2) / len(group)
-
-        chsh_variance = (
-            variance_term(e_xx)
-            + variance_term(e_xz)
-            + variance_term(e_zx)
-            + variance_term(e_zz)
+        variance_terms = np.where(
+            np.isnan(correlation), 0, (1 - correlation**2) / total[:, None, None]
         )
-        chsh_error = np.sqrt(chsh_variance)
+        chsh_error = np.sqrt(variance_terms.sum(axis=(1, 2)))
 
-        # 3. Fractions
+        # 3. Fractions: bit 1 for each party and basis, both bits 1 for each pair of bases
         fractions = {}
         errors = {}
-        for person, basis in [
-            ("alice", "X"),
-            ("alice", "Z"),
-            ("bob", "X"),
-            ("bob", "Z"),
+        alice_runs = tables.sum(axis=(2, 3, 4))
+        alice_ones = tables[:, :, :, 1, :].sum(axis=(2, 3))
+        bob_runs = tables.sum(axis=(1, 3, 4))
+        bob_ones = tables[:, :, :, :, 1].sum(axis=(1, 3))
+        for person, runs, ones in [
+            ("A", alice_runs, alice_ones),
+            ("B", bob_runs, bob_ones),
         ]:
-            sub_group = group[group[f"{person}_basis"] == basis]
-            fraction = (
-                (sub_group[f"{person}_bit"] == 1).mean()
-                if len(sub_group) > 0
-                else np.nan
-            )
-            fraction_error = (
-                wald_error(fraction, len(sub_group)) if len(sub_group) > 0 else np.nan
-            )
-            fractions[f"{person[0].upper()}{basis}"] = fraction
-            errors[f"{person[0].upper()}{basis}_error"] = fraction_error
-
-        for ab in ["X", "Z"]:
-            for bb in ["X", "Z"]:
-                sub_group = group[
-                    (group["alice_basis"] == ab) & (group["bob_basis"] == bb)
-                ]
-                fraction = (
-                    ((sub_group["alice_bit"] == 1) & (sub_group["bob_bit"] == 1)).mean()
-                    if len(sub_group) > 0
-                    else np.nan
-                )
-                fraction_error = (
-                    wald_error(fraction, len(sub_group))
-                    if len(sub_group) > 0
-                    else np.nan
+            for basis, code in BASIS_CODES.items():
+                n = runs[:, code]
+                fraction = np.where(n > 0, ones[:, code] / n, np.nan)
+                fractions[f"{person}{basis}"] = fraction
+                errors[f"{person}{basis}_error"] = wald_errors(fraction, n)
+        for ab, ab_code in BASIS_CODES.items():
+            for bb, bb_code in BASIS_CODES.items():
+                n = pair_runs[:, ab_code, bb_code]
+                fraction = np.where(
+                    n > 0, tables[:, ab_code, bb_code, 1, 1] / n, np.nan
                 )
                 fractions[f"{ab}{bb}"] = fraction
-                errors[f"{ab}{bb}_error"] = fraction_error
-
-        # explored quantities
-        quantities = compute_quantities(fractions, errors)
-
-        # Store results
-        results.append(
-            {
-                "length": length,
-                "QUBER": quber,
-                "QUBER_error": quber_error,
-                "CHSH": chsh,
-                "CHSH_error": chsh_error,
-                **quantities,
-            }
-        )
+                errors[f"{ab}{bb}_error"] = wald_errors(fraction, n)
+
+    return {
+        "QUBER": quber,
+        "QUBER_error": wald_errors(quber, same_basis),
+        "CHSH": chsh,
+        "CHSH_error": chsh_error,
+        "fractions": fractions,
+        "errors": errors,
+    }
 
-    # Convert results to DataFrame
-    result_df = pd.DataFrame(results)
 
-    return result_df
+def process_tables(lengths, tables):
+    # result_df of process_data_pandas from the count tables of each length
+    metrics = table_metrics(tables)
+    # explored quantities, all lengths at once
+    quantities = batch_quantities(
+        fraction_matrix(metrics["fractions"]),
+        fraction_matrix(metrics["errors"], "_error"),
+    )
+    return pd.DataFrame(
+        {
+            "length": lengths,
+            "QUBER": metrics["QUBER"],
+            "QUBER_error": metrics["QUBER_error"],
+            "CHSH": metrics["CHSH"],
+            "CHSH_error": metrics["CHSH_error"],
+            **quantities,
+        }
+    )
 
 
-def compute_quantities(fractions, errors):
-    # Constants
-    expected = np.array([0.5, 0.5, 0.5, 0.5, 0.5, 0.25, 0.25, 0.5])
-    uncorrelated_surface = lambda a0, a1, c0, c1: np.array(
-        [a0, a1, c0, c1, a0 * c0, a0 * c1, a1 * c0, a1 * c1]
+def data_tables(data):
+    # count tables of the data rows (after update_data)
+    if isinstance(data, RunTable):
+        return count_tables(
+            data.length, data.alice_basis, data.bob_basis, data.alice_bit, data.bob_bit
+        )
+    return count_tables(
+        data_column(data, 0),
+        data_column(data, 1, dtype=object),
+        data_column(data, 2, dtype=object),
+        data_column(data, 3, dtype=np.int8),
+        data_column(data, 4, dtype=np.int8),
     )
-    normalization = np.linalg.norm(expected - uncorrelated_surface(*expected[:4]))
 
-    observed = np.array(list(fractions.values()))
-    errors = np.array(list(errors.values()))
 
-    # 1. Norm of Expected Minus Observed Point
-    norm_diff = np.linalg.norm(observed - expected)
+def process_data_pandas(data):
+    # all quantities are functions of the per-length count tables
+    return process_tables(*data_tables(data))
+
+
+# columns of the observed fractions (and of their errors) in the matrices of
+# batch_quantities
+FRACTIONS = ["AX", "AZ", "BX", "BZ", "XX", "XZ", "ZX", "ZZ"]
+FRACTION_INDEX = {name: idx for idx, name in enumerate(FRACTIONS)}
+# fractions of the ideal protocol
+EXPECTED = np.array([0.5, 0.5, 0.5, 0.5, 0.5, 0.25, 0.25, 0.5])
+
+
+def uncorrelated_surface(a0, a1, c0, c1):
+    # points of the surface of uncorrelated fractions (last axis: FRACTIONS)
+    return np.stack([a0, a1, c0, c1, a0 * c0, a0 * c1, a1 * c0, a1 * c1], axis=-1)
+
+
+# distance between the expected point and the surface through its parameters
+NORMALIZATION = np.linalg.norm(EXPECTED - uncorrelated_surface(*EXPECTED[:4]))
 
-    # 2. Norm of Expected Minus Observed with Error Normalization
-    norm_diff_normalized = np.sqrt(np.sum(((observed - expected) / errors) ** 2))
 
-    # 3. Distance to the Uncorrelated Surface with Fixed Parameters
-    a0, a1, c0, c1 = observed[:4]  # Use observed parameters for the surface
-    surface_point = uncorrelated_surface(a0, a1, c0, c1)
-    # add as normalization the distance between expected and surface?
-    distance_to_surface = np.linalg.norm(observed - surface_point) / normalization
+def fraction_matrix(values, suffix=""):
+    # dict of fractions (or of their errors, suffix "_error") as a matrix with the
+    # columns in FRACTIONS order
+    return np.column_stack([values[f"{name}{suffix}"] for name in FRACTIONS])
 
-    # 4. Gaussian Overlap (Separability Test)
-    # exploit 2 gaussians symmetry, the first centered in 0 and the second centered in norm_diff, having the same variance
-    std_dev = np.sqrt(np.sum(errors**2))
-    intersection = norm_diff / 2
-    # (a-\mu)/\sigma
-    area_left = norm.cdf(-intersection / std_dev)  # intersection-norm_diff
-    area_right = 1 - norm.cdf(intersection / std_dev)
 
-    overlap = area_right + area_left
+def batch_quantities(observed, errors):
+    # separability metrics of every row of the (n, 8) observed and errors matrices
+    observed = np.atleast_2d(np.asarray(observed, dtype=np.float64))
+    errors = np.atleast_2d(np.asarray(errors, dtype=np.float64))
+    diff = observed - EXPECTED
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # 1. Norm of Expected Minus Observed Point
+        norm_diff = np.sqrt(np.sum(diff**2, axis=1))
+
+        # 2. Norm of Expected Minus Observed with Error Normalization
+        norm_diff_normalized = np.sqrt(np.sum((diff / errors) ** 2, axis=1))
+
+        # 3. Distance to the Uncorrelated Surface with Fixed Parameters
+        # (observed parameters for the surface)
+        surface_point = uncorrelated_surface(
+            *(observed[:, FRACTION_INDEX[name]] for name in ["AX", "AZ", "BX", "BZ"])
+        )
+        distance_to_surface = (
+            np.sqrt(np.sum((observed - surface_point) ** 2, axis=1)) / NORMALIZATION
+        )
+
+        # 4. Gaussian Overlap (Separability Test)
+        # exploit 2 gaussians symmetry, the first centered in 0 and the second centered in norm_diff, having the same variance
+        std_dev = np.sqrt(np.sum(errors**2, axis=1))
+        intersection = norm_diff / 2
+        # (a-\mu)/\sigma: both tails in a single call
+        tails = norm.cdf(np.stack([-intersection / std_dev, intersection / std_dev]))
+        overlap = tails[0] + (1 - tails[1])
 
     return {
         "Norm of Expected Minus Observed Point": norm_diff,
@@ -289,3 +359,11 @@ def compute_quantities(fractions, errors):
         "Distance to Uncorrelated Surface": distance_to_surface,
         "Gaussian Overlap": overlap,
     }
+
+
+def compute_quantities(fractions, errors):
+    # metrics of a single length (dicts keyed by FRACTIONS and FRACTIONS + "_error")
+    quantities = batch_quantities(
+        fraction_matrix(fractions), fraction_matrix(errors, "_error")
+    )
+    return {key: value[0] for key, value in quantities.items()}
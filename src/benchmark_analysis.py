@@ -0,0 +1,377 @@
+from analysis import (
+    update_data,
+    process_data_pandas,
+    batch_quantities,
+    FRACTIONS,
+    count_tables,
+    process_tables,
+    data_tables,
+)
+from bootstrap import bootstrap_intervals
+from run_table import RunTable
+import pandas as pd
+import numpy as np
+from scipy.stats import norm
+import time
+import tracemalloc
+
+
+def update_data_loop(data, counts):
+    # previous implementation of update_data (one bitstring lookup per row),
+    # kept as a reference for benchmarks
+    for idx, dat in enumerate(data):
+        (
+            length,
+            alice_basis,
+            bob_basis,
+            alice_bit,
+            bob_bit,
+            virtual_qb,
+            cl_bit,
+            circuit_idx,
+        ) = dat
+        bob_bit = int(list(counts[circuit_idx])[0][::-1][virtual_qb])
+        data[idx][4] = bob_bit
+        if alice_bit == None:
+            alice_bit = int(list(counts[circuit_idx])[0][::-1][virtual_qb - length])
+            data[idx][3] = alice_bit
+
+    return data
+
+
+def process_data_pandas_groupby(data):
+    # previous implementation of process_data_pandas (boolean masks on each
+    # length group), kept as a reference for benchmarks
+
+    # Convert data into a DataFrame
+    columns = [
+        "length",
+        "alice_basis",
+        "bob_basis",
+        "alice_bit",
+        "bob_bit",
+        "virtual_qb",
+        "cl_bit",
+        "circuit_idx",
+    ]
+    df = pd.DataFrame(data, columns=columns)
+
+    # Function to compute Wald confidence interval
+    def wald_error(p, n):
+        if n == 0 or np.isnan(p):
+            return (np.nan, np.nan)
+        margin = np.sqrt((p * (1 - p)) / n)
+        return margin
+
+    # Group by length and calculate quantities
+    results = []
+    for length, group in df.groupby("length"):
+        # total = len(group)
+
+        # 1. QUBER
+        same_basis = group[group["alice_basis"] == group["bob_basis"]]
+        mismatched = (same_basis["alice_bit"] != same_basis["bob_bit"]).sum()
+        quber = mismatched / len(same_basis) if len(same_basis) > 0 else np.nan
+        quber_error = (
+            wald_error(quber, len(same_basis)) if len(same_basis) > 0 else np.nan
+        )
+
+        # 2. CHSH
+        def correlation(df_subset):
+            if len(df_subset) == 0:
+                return np.nan
+            p_equal = (df_subset["alice_bit"] == df_subset["bob_bit"]).mean()
+            return 2 * p_equal - 1
+
+        e_xx = correlation(
+            group[(group["alice_basis"] == "X") & (group["bob_basis"] == "X")]
+        )
+        e_xz = correlation(
+            group[(group["alice_basis"] == "X") & (group["bob_basis"] == "Z")]
+        )
+        e_zx = correlation(
+            group[(group["alice_basis"] == "Z") & (group["bob_basis"] == "X")]
+        )
+        e_zz = correlation(
+            group[(group["alice_basis"] == "Z") & (group["bob_basis"] == "Z")]
+        )
+        chsh = abs(e_xx - e_xz) + abs(e_zx + e_zz)
+
+        # Error for CHSH: propagate variance assuming independence
+        def variance_term(corr):
+            return 0 if np.isnan(corr) else (1 - corr**2) / len(group)
+
+        chsh_variance = (
+            variance_term(e_xx)
+            + variance_term(e_xz)
+            + variance_term(e_zx)
+            + variance_term(e_zz)
+        )
+        chsh_error = np.sqrt(chsh_variance)
+
+        # 3. Fractions
+        fractions = {}
+        errors = {}
+        for person, basis in [
+            ("alice", "X"),
+            ("alice", "Z"),
+            ("bob", "X"),
+            ("bob", "Z"),
+        ]:
+            sub_group = group[group[f"{person}_basis"] == basis]
+            fraction = (
+                (sub_group[f"{person}_bit"] == 1).mean()
+                if len(sub_group) > 0
+                else np.nan
+            )
+            fraction_error = (
+                wald_error(fraction, len(sub_group)) if len(sub_group) > 0 else np.nan
+            )
+            fractions[f"{person[0].upper()}{basis}"] = fraction
+            errors[f"{person[0].upper()}{basis}_error"] = fraction_error
+
+        for ab in ["X", "Z"]:
+            for bb in ["X", "Z"]:
+                sub_group = group[
+                    (group["alice_basis"] == ab) & (group["bob_basis"] == bb)
+                ]
+                fraction = (
+                    ((sub_group["alice_bit"] == 1) & (sub_group["bob_bit"] == 1)).mean()
+                    if len(sub_group) > 0
+                    else np.nan
+                )
+                fraction_error = (
+                    wald_error(fraction, len(sub_group))
+                    if len(sub_group) > 0
+                    else np.nan
+                )
+                fractions[f"{ab}{bb}"] = fraction
+                errors[f"{ab}{bb}_error"] = fraction_error
+
+        # explored quantities
+        quantities = compute_quantities_loop(fractions, errors)
+
+        # Store results
+        results.append(
+            {
+                "length": length,
+                "QUBER": quber,
+                "QUBER_error": quber_error,
+                "CHSH": chsh,
+                "CHSH_error": chsh_error,
+                **quantities,
+            }
+        )
+
+    # Convert results to DataFrame
+    result_df = pd.DataFrame(results)
+
+    return result_df
+
+
+def compute_quantities_loop(fractions, errors):
+    # previous implementation of compute_quantities (one length per call), kept
+    # as a reference for benchmarks
+    # Constants
+    expected = np.array([0.5, 0.5, 0.5, 0.5, 0.5, 0.25, 0.25, 0.5])
+    uncorrelated_surface = lambda a0, a1, c0, c1: np.array(
+        [a0, a1, c0, c1, a0 * c0, a0 * c1, a1 * c0, a1 * c1]
+    )
+    normalization = np.linalg.norm(expected - uncorrelated_surface(*expected[:4]))
+
+    observed = np.array(list(fractions.values()))
+    errors = np.array(list(errors.values()))
+
+    # 1. Norm of Expected Minus Observed Point
+    norm_diff = np.linalg.norm(observed - expected)
+
+    # 2. Norm of Expected Minus Observed with Error Normalization
+    norm_diff_normalized = np.sqrt(np.sum(((observed - expected) / errors) ** 2))
+
+    # 3. Distance to the Uncorrelated Surface with Fixed Parameters
+    a0, a1, c0, c1 = observed[:4]  # Use observed parameters for the surface
+    surface_point = uncorrelated_surface(a0, a1, c0, c1)
+    # add as normalization the distance between expected and surface?
+    distance_to_surface = np.linalg.norm(observed - surface_point) / normalization
+
+    # 4. Gaussian Overlap (Separability Test)
+    # exploit 2 gaussians symmetry, the first centered in 0 and the second centered in norm_diff, having the same variance
+    std_dev = np.sqrt(np.sum(errors**2))
+    intersection = norm_diff / 2
+    # (a-\mu)/\sigma
+    area_left = norm.cdf(-intersection / std_dev)  # intersection-norm_diff
+    area_right = 1 - norm.cdf(intersection / std_dev)
+
+    overlap = area_right + area_left
+
+    return {
+        "Norm of Expected Minus Observed Point": norm_diff,
+        "Norm of Expected Minus Observed with Error Normalization": norm_diff_normalized,
+        "Distance to Uncorrelated Surface": distance_to_surface,
+        "Gaussian Overlap": overlap,
+    }
+
+
+def synthetic_run_data(
+    num_rows, protocol="BB84", lengths=(1, 10, 50), width=109, seed=0
+):
+    # data rows laid out as by generate_circuits and random measured bitstrings
+    rng = np.random.default_rng(seed)
+    bases = ["X", "Z"]
+    data = []
+    num_circuits = 0
+    runs = num_rows // len(lengths)
+    for length in lengths:
+        runs_per_circuit = width // (length + 1)
+        choices = rng.integers(0, 2, size=(runs, 3)).tolist()
+        for run, (alice_basis, bob_basis, alice_bit) in enumerate(choices):
+            pos = run % runs_per_circuit
+            data.append(
+                [
+                    length,
+                    bases[alice_basis],
+                    bases[bob_basis],
+                    None if protocol == "BBM92" else alice_bit,
+                    None,
+                    pos * (length + 1) + length,
+                    pos,
+                    num_circuits + run // runs_per_circuit,
+                ]
+            )
+        num_circuits += -(-runs // runs_per_circuit)
+    bits = rng.integers(0, 2, size=(num_circuits, width), dtype=np.uint8) + ord("0")
+    counts = [{bitstring.decode(): 1} for bitstring in map(bytes, bits)]
+    return data, counts
+
+
+def benchmark_update_data(num_rows, protocol):
+    data, counts = synthetic_run_data(num_rows, protocol)
+    data_loop = [dat[:] for dat in data]
+
+    start = time.perf_counter()
+    update_data_loop(data_loop, counts)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    update_data(data, counts)
+    vectorized_time = time.perf_counter() - start
+
+    assert data == data_loop, "update_data differs from the loop"
+    print(
+        f"update_data, {protocol}, {num_rows} rows, {len(counts)} circuits: loop {loop_time:.2f} s, vectorized {vectorized_time:.2f} s ({loop_time / vectorized_time:.1f}x faster)"
+    )
+
+
+def benchmark_process_data(num_rows):
+    data, counts = synthetic_run_data(num_rows)
+    data = update_data(data, counts)
+
+    start = time.perf_counter()
+    result_groupby = process_data_pandas_groupby(data)
+    groupby_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = process_data_pandas(data)
+    tables_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(result, result_groupby, check_dtype=False)
+    print(
+        f"process_data_pandas, {num_rows} rows: groupby {groupby_time:.2f} s, count tables {tables_time:.2f} s ({groupby_time / tables_time:.1f}x faster, including the conversion of the rows)"
+    )
+
+
+def benchmark_count_tables(num_runs, num_lengths=18, seed=0):
+    # kernel alone, on encoded columns
+    rng = np.random.default_rng(seed)
+    length = rng.integers(0, num_lengths, num_runs, dtype=np.int16)
+    alice_basis, bob_basis, alice_bit, bob_bit = rng.integers(
+        0, 2, (4, num_runs), dtype=np.int8
+    )
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        lengths, tables = count_tables(
+            length, alice_basis, bob_basis, alice_bit, bob_bit
+        )
+        process_tables(lengths, tables)
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    print(
+        f"count tables + metrics, {num_runs} runs, {num_lengths} lengths: {elapsed:.2f} s"
+    )
+
+
+def benchmark_bootstrap(num_rows, num_replicates=2000, processes=(1, 4)):
+    # bootstrap intervals of 18 lengths from their count tables
+    data, counts = synthetic_run_data(num_rows, lengths=range(1, 109, 6))
+    lengths, tables = data_tables(update_data(data, counts))
+    for num_processes in processes:
+        start = time.perf_counter()
+        bootstrap_intervals(
+            lengths, tables, num_replicates, seed=0, processes=num_processes
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"bootstrap, {num_rows} rows, {len(lengths)} lengths, {num_replicates} replicates, {num_processes} processes: {elapsed:.2f} s"
+        )
+
+
+def benchmark_run_table(num_rows):
+    # memory and post-processing time of the runs as lists and as a RunTable
+    data, counts = synthetic_run_data(num_rows)
+    tracemalloc.start()
+    rows = [dat[:] for dat in data]
+    rows_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    table = RunTable.from_rows(data)
+
+    start = time.perf_counter()
+    result_rows = process_data_pandas(update_data(rows, counts))
+    rows_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result_table = process_data_pandas(update_data(table, counts))
+    table_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(result_table, result_rows)
+    assert table.to_rows() == rows, "RunTable differs from the rows"
+    print(
+        f"RunTable, {num_rows} rows: {rows_bytes / num_rows:.0f} -> {table.nbytes() / num_rows:.0f} bytes per run, update_data + process_data_pandas {rows_time:.2f} s -> {table_time:.2f} s"
+    )
+
+
+def benchmark_quantities(num_rows, seed=0):
+    # separability metrics of num_rows (length or replicate) rows of fractions
+    rng = np.random.default_rng(seed)
+    observed = rng.uniform(0.2, 0.8, (num_rows, len(FRACTIONS)))
+    errors = rng.uniform(0.01, 0.05, (num_rows, len(FRACTIONS)))
+
+    start = time.perf_counter()
+    quantities_loop = [
+        compute_quantities_loop(
+            dict(zip(FRACTIONS, row)),
+            {f"{name}_error": error for name, error in zip(FRACTIONS, row_errors)},
+        )
+        for row, row_errors in zip(observed, errors)
+    ]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    quantities = batch_quantities(observed, errors)
+    batch_time = time.perf_counter() - start
+
+    for key, values in quantities.items():
+        assert np.allclose(values, [row[key] for row in quantities_loop])
+    print(
+        f"compute_quantities, {num_rows} rows: loop {loop_time:.3f} s, batched {batch_time:.4f} s ({loop_time / batch_time:.0f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    for protocol in ["BB84", "BBM92"]:
+        benchmark_update_data(10**6, protocol)
+    benchmark_process_data(10**6)
+    benchmark_count_tables(3 * 10**7)
+    benchmark_quantities(18 * 2000)
+    benchmark_bootstrap(18 * 500)
+    benchmark_run_table(10**6)
@@ -0,0 +1,106 @@
+from pack_chains import master_chains
+from simulation import (
+    generate_circuits,
+    get_custom_layout,
+    build_noise_model,
+    load_pickle_stream,
+)
+from analysis import update_data, process_data_pandas
+from device_jobs import DeviceJobManager
+from local_runtime import LocalRuntimeService, LocalSampler, LocalBatch
+from qiskit import transpile
+from functools import partial
+import numpy as np
+import tempfile
+import time
+import os
+import yaml
+
+
+def benchmark(
+    circuits,
+    data,
+    noise_model,
+    QPU,
+    custom_layout,
+    chunk_size,
+    jobs_in_flight,
+    latency=3,
+    failure_rate=0.0,
+    seed=0,
+):
+    # device path on the local runtime: wall time for the whole sweep
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        service = LocalRuntimeService(
+            noise_model=noise_model,
+            method="stabilizer",
+            latency=latency,
+            failure_rate=failure_rate,
+            seed=seed,
+            jobs_dir=tmp_dir,
+        )
+        backend = service.backend(QPU)
+        manager = DeviceJobManager(
+            service,
+            backend,
+            sampler_class=partial(LocalSampler, service=service),
+            mode_class=LocalBatch,
+            chunk_size=chunk_size,
+            max_in_flight=jobs_in_flight,
+            max_retries=10,
+            poll_interval=0.1,
+        )
+        results_path = os.path.join(tmp_dir, "results_device.pkl")
+        start = time.perf_counter()
+        manager.run(
+            circuits,
+            lambda chunk: transpile(
+                chunk,
+                backend=backend,
+                initial_layout=custom_layout,
+                optimization_level=0,
+            ),
+            results_path=results_path,
+            raw_results_path=os.path.join(tmp_dir, "raw_results_device.pkl"),
+        )
+        elapsed = time.perf_counter() - start
+        counts = load_pickle_stream(results_path)
+
+    quber = process_data_pandas(update_data(data.copy(), counts))["QUBER"]
+    print(
+        f"chunk size {chunk_size:4d}, {jobs_in_flight} in flight: {elapsed:6.2f} s ({len(circuits) / elapsed:.2f} circuits/s, {manager.submitted} jobs), QUBER {np.round(quber.values, 3).tolist()}"
+    )
+    return elapsed
+
+
+if __name__ == "__main__":
+    with open("config/sim_config.yaml", "r") as file:
+        config = yaml.safe_load(file)
+
+    QPU = config["simulation"]["QPU"]
+    master_chain = master_chains[QPU]
+
+    data, circuits = generate_circuits(
+        [1, 10, 50], 100, master_chain, "BB84", QPU=QPU, rng=np.random.default_rng(0)
+    )
+    custom_layout = get_custom_layout(circuits[0], master_chain)
+    noise_model = build_noise_model(
+        LocalRuntimeService(jobs_dir=tempfile.gettempdir()).backend(QPU), "stabilizer"
+    )
+
+    # a single job (previous device path) against chunks with jobs in flight
+    for chunk_size, jobs_in_flight in [
+        (len(circuits), 1),
+        (20, 1),
+        (20, 3),
+        (5, 3),
+        (5, 8),
+    ]:
+        benchmark(
+            circuits, data, noise_model, QPU, custom_layout, chunk_size, jobs_in_flight
+        )
+
+    # failed jobs are submitted again
+    benchmark(
+        circuits, data, noise_model, QPU, custom_layout, 5, 8, failure_rate=0.2, seed=1
+    )
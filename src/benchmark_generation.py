@@ -0,0 +1,188 @@
+from pack_chains import master_chains
+from simulation import generate_circuits, BASES
+from qiskit import QuantumCircuit, QuantumRegister
+import numpy as np
+import random
+import time
+import yaml
+
+
+def generate_circuits_loop(lengths, runs, master_chain, protocol, choice=random.choice):
+    # previous implementation of generate_circuits (one random.choice per choice
+    # and one gate at a time), kept as a reference for benchmarks
+
+    max_circuit_len = len(master_chain)
+    data = []
+    circuits = []
+
+    qr = QuantumRegister(len(master_chain))
+    if protocol == "Id-BB84":
+        qr_idBB84 = QuantumRegister(127)
+    circuit_idx = 0
+
+    for length in lengths:
+        if protocol == "Id-BB84":
+            qc = QuantumCircuit(qr_idBB84)
+        else:
+            qc = QuantumCircuit(qr)
+        current_qb = 0
+        cl_bit = 0
+
+        for r in range(runs):
+            alice_basis = choice(["X", "Z"])
+            bob_basis = choice(["X", "Z"])
+            alice_bit = None
+
+            if protocol == "BB84":
+                alice_bit = choice([0, 1])
+                if alice_bit == 1:
+                    qc.x(current_qb)
+                if alice_basis == "X":
+                    qc.h(current_qb)
+                for qb in range(current_qb, current_qb + length):
+                    qc.swap(qb, qb + 1)
+                current_qb = current_qb + length
+                if bob_basis == "X":
+                    qc.h(current_qb)
+
+            elif protocol == "BBM92":
+                qc.h(current_qb)
+                qc.cx(current_qb, current_qb + 1)
+                if alice_basis == "X":
+                    qc.h(current_qb)
+                for qb in range(current_qb + 1, current_qb + length):
+                    qc.swap(qb, qb + 1)
+                current_qb = current_qb + length
+                if bob_basis == "X":
+                    qc.h(current_qb)
+
+            elif protocol == "Id-BB84":
+                alice_bit = choice([0, 1])
+                if alice_bit == 1:
+                    qc.x(current_qb)
+                if alice_basis == "X":
+                    qc.h(current_qb)
+                for _ in range(length):
+                    qc.id(current_qb)
+                if bob_basis == "X":
+                    qc.h(current_qb)
+
+            data.append(
+                [
+                    length,
+                    alice_basis,
+                    bob_basis,
+                    alice_bit,
+                    None,
+                    current_qb,
+                    cl_bit,
+                    circuit_idx,
+                ]
+            )
+
+            if protocol != "Id-BB84":
+                if current_qb + length + 1 > max_circuit_len - 1:
+                    current_qb = 0
+                    cl_bit = 0
+                    circuit_idx += 1
+                    qc.measure_all()
+                    circuits.append(qc)
+                    qc = QuantumCircuit(qr)
+                else:
+                    current_qb += 1
+                    cl_bit += 1
+            else:
+                current_qb += 1
+                cl_bit += 1
+                if current_qb >= 127:
+                    current_qb = 0
+                    cl_bit = 0
+                    circuit_idx += 1
+                    qc.measure_all()
+                    circuits.append(qc)
+                    qc = QuantumCircuit(qr_idBB84)
+
+        if len(circuits) != data[-1][-1] + 1:
+            circuit_idx += 1
+            qc.measure_all()
+            circuits.append(qc)
+
+    return data, circuits
+
+
+def replay_choices(lengths, runs, protocol, seed):
+    # the choices drawn by generate_circuits, in the order the loop asks for them
+    rng = np.random.default_rng(seed)
+    sequence = []
+    for _ in lengths:
+        choices = rng.integers(0, 2, size=(runs, 3), dtype=np.int8)
+        for alice_basis, bob_basis, alice_bit in choices.tolist():
+            sequence.extend([BASES[alice_basis], BASES[bob_basis]])
+            if protocol != "BBM92":
+                sequence.append(alice_bit)
+    sequence.reverse()
+    return lambda options: sequence.pop()
+
+
+def gate_list(circuit):
+    return [
+        (
+            instruction.operation.name,
+            tuple(circuit.find_bit(qb).index for qb in instruction.qubits),
+        )
+        for instruction in circuit.data
+    ]
+
+
+def check_equivalence(lengths, runs, master_chain, protocol, seed=0):
+    # same choices -> same data rows and same circuits
+    data, circuits = generate_circuits(
+        lengths, runs, master_chain, protocol, rng=np.random.default_rng(seed)
+    )
+    data_loop, circuits_loop = generate_circuits_loop(
+        lengths,
+        runs,
+        master_chain,
+        protocol,
+        choice=replay_choices(lengths, runs, protocol, seed),
+    )
+    assert data.to_rows() == data_loop, "data rows differ"
+    assert len(circuits) == len(circuits_loop), "number of circuits differs"
+    assert all(
+        gate_list(circ) == gate_list(circ_loop)
+        for circ, circ_loop in zip(circuits, circuits_loop)
+    ), "circuits differ"
+    print(f"{protocol}: vectorized generation matches the loop.")
+
+
+def benchmark(lengths, runs, master_chain, protocol, repeat=1):
+    timings = {"loop": [], "vectorized": []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        generate_circuits_loop(lengths, runs, master_chain, protocol)
+        timings["loop"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        generate_circuits(
+            lengths, runs, master_chain, protocol, rng=np.random.default_rng()
+        )
+        timings["vectorized"].append(time.perf_counter() - start)
+
+    loop_time = min(timings["loop"])
+    vectorized_time = min(timings["vectorized"])
+    print(
+        f"{protocol}, {len(lengths)} lengths, {runs} runs: loop {loop_time:.3f} s, vectorized {vectorized_time:.3f} s ({loop_time / vectorized_time:.1f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    with open("config/sim_config.yaml", "r") as file:
+        config = yaml.safe_load(file)
+
+    master_chain = master_chains[config["simulation"]["QPU"]]
+    lengths = config["simulation"]["lengths"]
+
+    for protocol in ["BB84", "BBM92", "Id-BB84"]:
+        check_equivalence([1, 5, 30, 108], 200, master_chain, protocol)
+        for runs in [500, 2000]:
+            benchmark(lengths, runs, master_chain, protocol)
@@ -0,0 +1,83 @@
+from pack_chains import master_chains
+from simulation import generate_circuits, get_custom_layout, native_target
+from native_circuits import verify_native_circuits
+from qiskit import transpile
+import numpy as np
+import time
+import yaml
+
+
+def benchmark(lengths, runs, master_chain, protocol, QPU, seed=0):
+    backend = native_target(QPU)
+
+    # virtual circuits + transpile
+    start = time.perf_counter()
+    _, circuits = generate_circuits(
+        lengths, runs, master_chain, protocol, QPU=QPU, rng=np.random.default_rng(seed)
+    )
+    generation_time = time.perf_counter() - start
+    custom_layout = get_custom_layout(circuits[0], master_chain)
+    start = time.perf_counter()
+    for circ in circuits:
+        transpile(
+            circ,
+            backend=backend,
+            initial_layout=custom_layout,
+            optimization_level=0,
+        )
+    transpile_time = time.perf_counter() - start
+
+    # native circuits (no transpile needed)
+    start = time.perf_counter()
+    _, native_circuits = generate_circuits(
+        lengths,
+        runs,
+        master_chain,
+        protocol,
+        QPU=QPU,
+        native=True,
+        rng=np.random.default_rng(seed),
+    )
+    native_time = time.perf_counter() - start
+
+    before = generation_time + transpile_time
+    print(
+        f"{protocol}, lengths {lengths}, {runs} runs, {len(circuits)} circuits:\n"
+        f"  generation + transpile: {before:.2f} s ({generation_time:.2f} s + {transpile_time:.2f} s)\n"
+        f"  native generation:      {native_time:.2f} s ({before / native_time:.1f}x faster)"
+    )
+
+
+def verify(lengths, runs, master_chain, protocol, QPU, seed=0):
+    backend = native_target(QPU)
+    _, circuits = generate_circuits(
+        lengths, runs, master_chain, protocol, QPU=QPU, rng=np.random.default_rng(seed)
+    )
+    _, native_circuits = generate_circuits(
+        lengths,
+        runs,
+        master_chain,
+        protocol,
+        QPU=QPU,
+        native=True,
+        rng=np.random.default_rng(seed),
+    )
+    verify_native_circuits(
+        native_circuits,
+        circuits,
+        backend,
+        layout=get_custom_layout(circuits[0], master_chain),
+    )
+
+
+if __name__ == "__main__":
+    with open("config/sim_config.yaml", "r") as file:
+        config = yaml.safe_load(file)
+
+    QPU = config["simulation"]["QPU"]
+    master_chain = master_chains[QPU]
+
+    for protocol in ["BB84", "BBM92", "Id-BB84"]:
+        # equivalence with the transpiled circuits on small lengths
+        verify([1, 2, 3, 5], 50, master_chain, protocol, QPU)
+        benchmark([1, 10, 50, 100], 100, master_chain, protocol, QPU)
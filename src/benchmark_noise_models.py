@@ -0,0 +1,84 @@
+from pack_chains import master_chains
+from simulation import (
+    generate_circuits,
+    build_noise_model,
+    noise_qubits,
+    get_custom_layout,
+    native_target,
+    run_batch,
+)
+from noise_cache import NoiseModelStore
+from qiskit import transpile
+from qiskit_aer import AerSimulator
+import numpy as np
+import tempfile
+import time
+import yaml
+
+
+def benchmark_store(backend, method, qubits=None, couplers=None):
+    # build time against load time from the store
+    with tempfile.TemporaryDirectory() as cache_dir:
+        store = NoiseModelStore(cache_dir)
+        start = time.perf_counter()
+        build_noise_model(backend, method, store, qubits, couplers)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        build_noise_model(backend, method, store, qubits, couplers)
+        load_time = time.perf_counter() - start
+    kind = "full" if qubits is None else "reduced"
+    print(
+        f"{method}, {kind} noise model: build {build_time:.2f} s, load from store {load_time:.2f} s ({build_time / load_time:.1f}x faster)"
+    )
+
+
+def benchmark_throughput(circuits, backend, method, qubits, couplers, seed=0):
+    # circuits/s with the full and the reduced noise model (same counts expected)
+    counts = {}
+    for kind, noise_qbs, noise_couplers in [
+        ("full", None, None),
+        ("reduced", qubits, couplers),
+    ]:
+        noise_model = build_noise_model(
+            backend, method, qubits=noise_qbs, couplers=noise_couplers
+        )
+        simulator = AerSimulator(method=method, noise_model=noise_model, device="CPU")
+        start = time.perf_counter()
+        counts[kind] = [
+            run_batch(simulator, [circ], seed_simulator=seed + idx)
+            for idx, circ in enumerate(circuits)
+        ]
+        elapsed = time.perf_counter() - start
+        print(f"{method}, {kind} noise model: {len(circuits) / elapsed:.2f} circuits/s")
+    print(f"Same counts: {counts['full'] == counts['reduced']}")
+
+
+if __name__ == "__main__":
+    with open("config/sim_config.yaml", "r") as file:
+        config = yaml.safe_load(file)
+
+    QPU = config["simulation"]["QPU"]
+    master_chain = master_chains[QPU]
+    backend = native_target(QPU)
+
+    _, circuits = generate_circuits(
+        [1, 10, 50, 100],
+        100,
+        master_chain,
+        "BB84",
+        QPU=QPU,
+        rng=np.random.default_rng(0),
+    )
+    custom_layout = get_custom_layout(circuits[0], master_chain)
+    qubits, couplers = noise_qubits(master_chain, circuits[0])
+    circuits = [
+        transpile(
+            circ, backend=backend, initial_layout=custom_layout, optimization_level=0
+        )
+        for circ in circuits
+    ]
+
+    for method in ["stabilizer", "matrix_product_state"]:
+        benchmark_store(backend, method)
+        benchmark_store(backend, method, qubits, couplers)
+        benchmark_throughput(circuits, backend, method, qubits, couplers)
@@ -0,0 +1,38 @@
+from privacy_amplification import toeplitz_seed, toeplitz_hash, toeplitz_hash_matrix
+import numpy as np
+import time
+
+
+def timed(function, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def benchmark(total_bits=2**22, key_fraction=0.5):
+    # Mbit/s of the FFT hash against the block size (total_bits hashed as a batch
+    # of blocks), and of the Toeplitz matrix product up to 2^13 bits
+    rng = np.random.default_rng(0)
+    for exponent in range(10, 23, 2):
+        num_bits = 2**exponent
+        final_bits = int(key_fraction * num_bits)
+        blocks = rng.integers(
+            0, 2, (max(total_bits // num_bits, 1), num_bits), dtype=np.uint8
+        )
+        seed = toeplitz_seed(num_bits, final_bits, rng)
+        hashed, fft_time = timed(toeplitz_hash, blocks, seed, final_bits)
+        line = f"block 2^{exponent}, {len(blocks)} blocks: FFT {blocks.size / fft_time / 1e6:.1f} Mbit/s"
+        if exponent <= 13:
+            reference, matrix_time = timed(
+                toeplitz_hash_matrix, blocks[:8], seed, final_bits, repeat=1
+            )
+            assert np.array_equal(hashed[:8], reference)
+            line += f", matrix {8 * num_bits / matrix_time / 1e6:.2f} Mbit/s"
+        print(line)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,94 @@
+from reconciliation import reconcile_keys, initial_block_size
+import numpy as np
+import time
+
+
+def synthetic_keys(num_bits, qber, rng):
+    alice = rng.integers(0, 2, num_bits, dtype=np.uint8)
+    errors = (rng.random(num_bits) < qber).astype(np.uint8)
+    return alice, alice ^ errors
+
+
+def cascade_loop(alice, bob, qber, num_passes=4, seed=None):
+    # reference: Cascade on one key with a Python loop over the blocks and the
+    # bisections (parities recomputed from the bits)
+    rng = np.random.default_rng(seed)
+    alice, bob = alice.tolist(), bob.tolist()
+    block_size = initial_block_size(qber, len(alice))
+    passes = []
+    leaked = 0
+
+    def parity(bits, indices):
+        return sum(bits[idx] for idx in indices) % 2
+
+    def bisect(block):
+        nonlocal leaked
+        while len(block) > 1:
+            half = block[: len(block) // 2]
+            leaked += 1
+            block = (
+                half if parity(alice, half) != parity(bob, half) else block[len(half) :]
+            )
+        bob[block[0]] ^= 1
+        return block[0]
+
+    for idx in range(num_passes):
+        order = (
+            list(range(len(alice)))
+            if idx == 0
+            else rng.permutation(len(alice)).tolist()
+        )
+        size = block_size * 2**idx
+        blocks = [order[start : start + size] for start in range(0, len(order), size)]
+        # block of every bit
+        block_of = [None] * len(alice)
+        for block in blocks:
+            for bit in block:
+                block_of[bit] = block
+        leaked += len(blocks)
+        passes.append(block_of)
+        pending = blocks
+        while pending:
+            block = pending.pop()
+            if parity(alice, block) == parity(bob, block):
+                continue
+            flipped = bisect(block)
+            # blocks of the previous passes holding the corrected bit
+            pending += [block_of[flipped] for block_of in passes]
+    return np.array(bob, dtype=np.uint8), leaked
+
+
+def benchmark_loop(num_bits=10**6, qber=0.03):
+    rng = np.random.default_rng(0)
+    alice, bob = synthetic_keys(num_bits, qber, rng)
+    start = time.perf_counter()
+    corrected, leaked = cascade_loop(alice, bob, qber, seed=1)
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    report, _ = reconcile_keys({1: (alice, bob)}, {1: qber}, seed=1)
+    vectorized = time.perf_counter() - start
+    print(
+        f"{num_bits} bits, QBER {qber}: loop {loop:.2f} s ({leaked} leaked, {np.count_nonzero(corrected != alice)} residual errors), "
+        f"vectorized {vectorized:.3f} s ({report['leaked_bits'][0]} leaked, {report['residual_error_rate'][0] * num_bits:.0f} residual errors)"
+    )
+
+
+def benchmark(num_bits=2 * 10**6, qbers=(0.01, 0.03, 0.05, 0.08)):
+    # throughput, leakage over the Shannon limit and residual errors against the
+    # QBER and the frame size
+    rng = np.random.default_rng(0)
+    keys = {qber: synthetic_keys(num_bits, qber, rng) for qber in qbers}
+    for frame_bits in [2**12, 2**14, 2**16]:
+        report, _ = reconcile_keys(
+            keys, {qber: qber for qber in qbers}, frame_bits=frame_bits, seed=1
+        )
+        for row in report.itertuples():
+            print(
+                f"frame {frame_bits:6d} bits, QBER {row.QBER:.2f}: {row.bits_per_s / 1e6:.2f} Mbit/s, "
+                f"{row.leaked_bits} leaked bits (efficiency {row.efficiency:.3f}), residual error rate {row.residual_error_rate:.1e}"
+            )
+
+
+if __name__ == "__main__":
+    benchmark_loop()
+    benchmark()
@@ -0,0 +1,74 @@
+from benchmark_analysis import synthetic_run_data
+from analysis import update_data, data_tables
+from storage import write_data, write_counts, store_tables
+from simulation import load_pickle_stream
+import numpy as np
+import tempfile
+import pickle
+import time
+import os
+
+
+def folder_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def benchmark(num_rows, protocol="BB84"):
+    # pickles against columnar stores: size on disk and time to the count tables
+    data, counts = synthetic_run_data(num_rows, protocol, lengths=range(1, 109, 6))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {
+            name: os.path.join(tmp_dir, name)
+            for name in ["data.pkl", "results.pkl", "data_columns", "results_columns"]
+        }
+        start = time.perf_counter()
+        with open(paths["data.pkl"], "wb") as file:
+            pickle.dump(data, file)
+        with open(paths["results.pkl"], "wb") as file:
+            pickle.dump(counts, file)
+        pickle_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        write_data(paths["data_columns"], data)
+        write_counts(paths["results_columns"], counts)
+        columnar_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        lengths, tables = data_tables(
+            update_data(
+                load_pickle_stream(paths["data.pkl"]),
+                load_pickle_stream(paths["results.pkl"]),
+            )
+        )
+        pickle_read = time.perf_counter() - start
+
+        start = time.perf_counter()
+        lengths_columnar, tables_columnar = store_tables(
+            paths["data_columns"], paths["results_columns"]
+        )
+        columnar_read = time.perf_counter() - start
+        assert np.array_equal(lengths, lengths_columnar)
+        assert np.array_equal(tables, tables_columnar)
+
+        start = time.perf_counter()
+        store_tables(paths["data_columns"], paths["results_columns"], lengths=[1])
+        one_length_read = time.perf_counter() - start
+
+        sizes = {name: folder_size(path) / 2**20 for name, path in paths.items()}
+
+    print(
+        f"{protocol}, {num_rows} rows, {len(counts)} circuits of {len(next(iter(counts[0])))} bits:"
+    )
+    print(
+        f"  data {sizes['data.pkl']:.1f} MB -> {sizes['data_columns']:.1f} MB, counts {sizes['results.pkl']:.1f} MB -> {sizes['results_columns']:.2f} MB"
+    )
+    print(
+        f"  write {pickle_write:.2f} s -> {columnar_write:.2f} s, count tables {pickle_read:.2f} s -> {columnar_read:.2f} s ({one_length_read:.3f} s for one length)"
+    )
+
+
+if __name__ == "__main__":
+    for protocol in ["BB84", "BBM92"]:
+        benchmark(10**6, protocol)
@@ -0,0 +1,139 @@
+from analysis import table_metrics, batch_quantities, fraction_matrix
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import norm
+import pandas as pd
+import numpy as np
+
+# Bootstrap confidence intervals of QUBER, CHSH and the separability metrics of
+# compute_quantities. Runs of one length are resampled through their count table:
+# a replicate is a multinomial draw of the same number of runs over the 16
+# (alice_basis, bob_basis, alice_bit, bob_bit) cells, so thousands of replicates
+# are a (replicates, 2, 2, 2, 2) array evaluated at once by table_metrics.
+
+METRICS = [
+    "QUBER",
+    "CHSH",
+    "Norm of Expected Minus Observed Point",
+    "Norm of Expected Minus Observed with Error Normalization",
+    "Distance to Uncorrelated Surface",
+    "Gaussian Overlap",
+]
+
+
+def resample_tables(table, num_replicates, rng):
+    # multinomial draws of the runs of one length: [replicate, ab, bb, a, b]
+    cells = table.reshape(-1)
+    total = cells.sum()
+    replicates = rng.multinomial(total, cells / total, size=num_replicates)
+    return replicates.reshape(num_replicates, 2, 2, 2, 2)
+
+
+def tables_metrics(tables):
+    # every metric of METRICS for a stack of count tables (one value per table)
+    metrics = table_metrics(tables)
+    return {
+        "QUBER": metrics["QUBER"],
+        "CHSH": metrics["CHSH"],
+        **batch_quantities(
+            fraction_matrix(metrics["fractions"]),
+            fraction_matrix(metrics["errors"], "_error"),
+        ),
+    }
+
+
+def jackknife_tables(table):
+    # leave-one-run-out tables: removing any run of a cell gives the same table,
+    # so there are at most 16 distinct ones, weighted by the runs in the cell
+    cells = table.reshape(-1)
+    occupied = np.flatnonzero(cells)
+    tables = np.repeat(cells[None, :], len(occupied), axis=0)
+    tables[np.arange(len(occupied)), occupied] -= 1
+    return tables.reshape(-1, 2, 2, 2, 2), cells[occupied]
+
+
+def acceleration(values, weights):
+    # BCa acceleration from the jackknife values
+    finite = np.isfinite(values)
+    values, weights = values[finite], weights[finite]
+    if weights.sum() == 0:
+        return 0.0
+    diff = np.average(values, weights=weights) - values
+    denominator = 6 * np.sum(weights * diff**2) ** 1.5
+    return np.sum(weights * diff**3) / denominator if denominator > 0 else 0.0
+
+
+def intervals(estimate, replicates, accel, confidence):
+    # percentile and BCa intervals of one metric
+    replicates = replicates[np.isfinite(replicates)]
+    if len(replicates) == 0 or not np.isfinite(estimate):
+        return [np.nan] * 4
+    alpha = (1 - confidence) / 2
+    percentile = np.quantile(replicates, [alpha, 1 - alpha])
+
+    # bias correction: fraction of the replicates below the estimate
+    below = np.mean(replicates < estimate) + 0.5 * np.mean(replicates == estimate)
+    z0 = norm.ppf(np.clip(below, 1 / len(replicates), 1 - 1 / len(replicates)))
+    z = z0 + norm.ppf([alpha, 1 - alpha])
+    levels = norm.cdf(z0 + z / (1 - accel * z))
+    bca = np.quantile(replicates, levels)
+    return [*percentile, *bca]
+
+
+def bootstrap_length(table, num_replicates, confidence, seed):
+    # intervals of every metric for the count table of one length
+    rng = np.random.default_rng(seed)
+    estimates = tables_metrics(table[None])
+    replicates = tables_metrics(resample_tables(table, num_replicates, rng))
+    jackknife, weights = jackknife_tables(table)
+    jackknife = tables_metrics(jackknife)
+
+    row = {}
+    for key in METRICS:
+        low, high, bca_low, bca_high = intervals(
+            estimates[key][0],
+            replicates[key],
+            acceleration(jackknife[key], weights),
+            confidence,
+        )
+        row[f"{key}_ci_low"] = low
+        row[f"{key}_ci_high"] = high
+        row[f"{key}_bca_low"] = bca_low
+        row[f"{key}_bca_high"] = bca_high
+    return row
+
+
+def bootstrap_intervals(
+    lengths, tables, num_replicates=2000, confidence=0.95, seed=None, processes=1
+):
+    # intervals of every length, lengths spread over a process pool if processes > 1
+    seeds = np.random.SeedSequence(seed).spawn(len(lengths))
+    args = (
+        tables,
+        [num_replicates] * len(lengths),
+        [confidence] * len(lengths),
+        seeds,
+    )
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            rows = list(executor.map(bootstrap_length, *args))
+    else:
+        rows = list(map(bootstrap_length, *args))
+    return pd.DataFrame(rows).assign(length=lengths)
+
+
+def add_intervals(result_df, intervals_df):
+    # bootstrap columns placed after the _error column of QUBER and CHSH and after
+    # each separability metric
+    result_df = result_df.merge(intervals_df, on="length", how="left")
+    columns = []
+    for column in result_df.columns:
+        if column in intervals_df.columns and column != "length":
+            continue
+        columns.append(column)
+        metric = column[: -len("_error")] if column.endswith("_error") else column
+        if metric in METRICS and (column.endswith("_error") or metric in METRICS[2:]):
+            columns += [
+                f"{metric}_{kind}"
+                for kind in ["ci_low", "ci_high", "bca_low", "bca_high"]
+            ]
+    return result_df[columns]
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+
+# configuration entries that change the circuits or their results
+CONFIG_KEYS = [
+    "protocol",
+    "device",
+    "QPU",
+    "chain_discovery",
+    "chain_max_error",
+    "lengths",
+    "runs",
+    "seed",
+    "method",
+    "fallback_method",
+    "pauli_tolerance",
+    "templates",
+    "native",
+    "packing",
+    # logged device jobs are keyed by the (start, stop) range of their chunk
+    "device_chunk_size",
+    # jobs (and their IDs) of the local stand-in are not those of the real service
+    "local_runtime",
+    # the reduced noise model gives the same noise on the chain, but other
+    # simulator random draws for the same seed
+    "reduced_noise",
+]
+
+
+def config_hash(config):
+    relevant = {key: config.get(key) for key in CONFIG_KEYS}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def pending_ranges(completed, num_circuits, chunk_size):
+    # contiguous ranges (start, stop) of circuits not completed yet, at most
+    # chunk_size circuits long
+    ranges = []
+    start = None
+    for idx in range(num_circuits + 1):
+        if idx < num_circuits and idx not in completed:
+            if start is None:
+                start = idx
+            if idx + 1 - start == chunk_size:
+                ranges.append((start, idx + 1))
+                start = None
+        elif start is not None:
+            ranges.append((start, idx))
+            start = None
+    return ranges
+
+
+def flatten_counts(completed, num_circuits):
+    # counts of all circuits in circuit_idx order (templates have one entry per shot)
+    list_count = []
+    for idx in range(num_circuits):
+        list_count.extend(completed[idx])
+    return list_count
+
+
+class Checkpoint:
+    # append-only log of pickled records: a header with the configuration hash and
+    # the seed, the counts of ranges of finished circuits and the submitted job IDs
+
+    def __init__(self, config, path="data/checkpoint.pkl", resume=False, every=50):
+        self.path = path
+        self.every = every
+        self.config_hash = config_hash(config)
+        # circuit index -> list of counts, job key -> job ID
+        self.completed = {}
+        self.jobs = {}
+
+        header = None
+        if resume and os.path.exists(path):
+            records = self._read()
+            if records and records[0]["config_hash"] == self.config_hash:
+                header = records[0]
+                for record in records[1:]:
+                    if record["config_hash"] != self.config_hash:
+                        continue
+                    if record["type"] == "counts":
+                        for offset, counts in enumerate(record["counts"]):
+                            self.completed[record["start"] + offset] = counts
+                    elif record["type"] == "job":
+                        self.jobs[(record["start"], record["stop"])] = record["job_id"]
+                print(
+                    f"Resuming: {len(self.completed)} circuits completed, {len(self.jobs)} jobs submitted."
+                )
+            else:
+                print("Checkpoint belongs to a different configuration: starting over.")
+
+        if header is None:
+            # a seed is needed to generate the same circuits again when resuming
+            seed = config.get("seed")
+            if seed is None:
+                seed = int(np.random.SeedSequence().entropy % 2**31)
+            header = {"type": "header", "config_hash": self.config_hash, "seed": seed}
+            with open(path, "wb") as file:
+                pickle.dump(header, file)
+        self.seed = header["seed"]
+
+    def _read(self):
+        records = []
+        with open(self.path, "rb") as file:
+            while True:
+                try:
+                    records.append(pickle.load(file))
+                except (EOFError, pickle.UnpicklingError):
+                    # a truncated last record (crash while writing) is ignored
+                    break
+        return records
+
+    def _append(self, record):
+        with open(self.path, "ab") as file:
+            pickle.dump(record, file)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def record(self, start, circuit_counts):
+        # circuit_counts: list of counts of circuits start, start + 1, ...
+        self._append(
+            {
+                "type": "counts",
+                "config_hash": self.config_hash,
+                "start": start,
+                "stop": start + len(circuit_counts),
+                "counts": circuit_counts,
+            }
+        )
+        for offset, counts in enumerate(circuit_counts):
+            self.completed[start + offset] = counts
+
+    def record_job(self, job_id, start, stop):
+        self._append(
+            {
+                "type": "job",
+                "config_hash": self.config_hash,
+                "start": start,
+                "stop": stop,
+                "job_id": job_id,
+            }
+        )
+        self.jobs[(start, stop)] = job_id
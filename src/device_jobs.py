@@ -0,0 +1,216 @@
+import asyncio
+import pickle
+import time
+
+
+def unpack_result(result):
+    # one list of single-shot counts dicts per pub (template pubs have one per shot)
+    circuit_counts = []
+    for circ_res in result:
+        for val in circ_res.data.values():
+            if val.num_shots == 1:
+                circuit_counts.append([val.get_counts()])
+            else:
+                circuit_counts.append(
+                    [{bitstring: 1} for bitstring in val.get_bitstrings()]
+                )
+    return circuit_counts
+
+
+class DeviceJobManager:
+    # submit circuits to a device in chunks of chunk_size circuits (one Sampler
+    # job each) inside a runtime Batch or Session, with at most max_in_flight jobs
+    # queued or running at the same time. Jobs are polled concurrently and the
+    # counts of a chunk are appended to the results file as soon as it is done
+    # (see load_pickle_stream); failed chunks are submitted again up to
+    # max_retries times.
+
+    def __init__(
+        self,
+        service,
+        backend,
+        sampler_class,
+        mode_class=None,
+        chunk_size=100,
+        max_in_flight=3,
+        max_retries=3,
+        poll_interval=10,
+        checkpoint=None,
+        accumulator=None,
+    ):
+        self.service = service
+        self.backend = backend
+        self.sampler_class = sampler_class
+        # Batch, Session or None (jobs submitted directly to the backend)
+        self.mode_class = mode_class
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.checkpoint = checkpoint
+        # live metrics updated as each chunk is done
+        self.accumulator = accumulator
+        self.submitted = 0
+        self.retried = 0
+
+    def run(self, circuits, prepare, results_path, raw_results_path):
+        # prepare: function transpiling a list of circuits for the backend
+        return asyncio.run(self._run(circuits, prepare, results_path, raw_results_path))
+
+    async def _run(self, circuits, prepare, results_path, raw_results_path):
+        num_circuits = len(circuits)
+        completed = self.checkpoint.completed if self.checkpoint is not None else {}
+        chunks = []
+        for start in range(0, num_circuits, self.chunk_size):
+            stop = min(start + self.chunk_size, num_circuits)
+            if not all(idx in completed for idx in range(start, stop)):
+                chunks.append((start, stop))
+
+        start_time = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.prepare_lock = asyncio.Lock()
+        with open(results_path, "wb") as results_file, open(
+            raw_results_path, "wb"
+        ) as raw_file:
+            # counts of the circuits completed before a restart
+            for idx in sorted(completed):
+                pickle.dump({"start": idx, "counts": completed[idx]}, results_file)
+            if self.accumulator is not None:
+                self.accumulator.add_completed(completed)
+
+            if self.mode_class is None:
+                sampler = self.sampler_class(self.backend)
+                await self._run_chunks(
+                    chunks,
+                    circuits,
+                    prepare,
+                    sampler,
+                    semaphore,
+                    results_file,
+                    raw_file,
+                )
+            else:
+                with self.mode_class(backend=self.backend) as mode:
+                    sampler = self.sampler_class(mode=mode)
+                    await self._run_chunks(
+                        chunks,
+                        circuits,
+                        prepare,
+                        sampler,
+                        semaphore,
+                        results_file,
+                        raw_file,
+                    )
+
+        elapsed = time.perf_counter() - start_time
+        num_pending = sum(stop - start for start, stop in chunks)
+        print(
+            f"Device: {num_pending} circuits in {len(chunks)} chunks, {self.submitted} jobs submitted ({self.retried} retries) in {elapsed:.2f} s."
+        )
+        return 0
+
+    async def _run_chunks(
+        self, chunks, circuits, prepare, sampler, semaphore, results_file, raw_file
+    ):
+        self.done = 0
+        self.num_chunks = len(chunks)
+        await asyncio.gather(
+            *(
+                self._run_chunk(
+                    start,
+                    stop,
+                    circuits,
+                    prepare,
+                    sampler,
+                    semaphore,
+                    results_file,
+                    raw_file,
+                )
+                for start, stop in chunks
+            )
+        )
+
+    async def _submit(self, sampler, pubs, start, stop):
+        job = await asyncio.to_thread(sampler.run, pubs, shots=1)
+        self.submitted += 1
+        if self.checkpoint is not None:
+            self.checkpoint.record_job(job.job_id(), start, stop)
+        return job
+
+    async def _run_chunk(
+        self, start, stop, circuits, prepare, sampler, semaphore, results_file, raw_file
+    ):
+        async with semaphore:
+            job = None
+            if self.checkpoint is not None and (start, stop) in self.checkpoint.jobs:
+                # submitted before a restart: fetch the job instead of submitting it again
+                try:
+                    job = await asyncio.to_thread(
+                        self.service.job, self.checkpoint.jobs[(start, stop)]
+                    )
+                except Exception as error:
+                    print(f"Chunk {start}-{stop}: job not fetched ({error}).")
+            pubs = None
+
+            for _ in range(self.max_retries + 1):
+                if job is None:
+                    if pubs is None:
+                        # the transpiler is not thread safe: one chunk at a time
+                        async with self.prepare_lock:
+                            transpiled = await asyncio.to_thread(
+                                prepare, circuits[start:stop]
+                            )
+                        # template circuits carry their number of shots in the metadata
+                        pubs = [
+                            (circ, None, circ.metadata.get("shots", 1))
+                            for circ in transpiled
+                        ]
+                    try:
+                        job = await self._submit(sampler, pubs, start, stop)
+                    except Exception as error:
+                        print(f"Chunk {start}-{stop}: submission failed ({error}).")
+                        self.retried += 1
+                        await asyncio.sleep(self.poll_interval)
+                        continue
+
+                status = await asyncio.to_thread(job.status)
+                while status not in ("DONE", "CANCELLED", "ERROR"):
+                    await asyncio.sleep(self.poll_interval)
+                    status = await asyncio.to_thread(job.status)
+
+                if status == "DONE":
+                    try:
+                        result = await asyncio.to_thread(job.result)
+                        break
+                    except Exception as error:
+                        status = f"ERROR ({error})"
+                print(f"Chunk {start}-{stop}: job {job.job_id()} {status}.")
+                self.retried += 1
+                job = None
+            else:
+                raise Exception(
+                    f"Chunk {start}-{stop} failed after {self.max_retries + 1} attempts."
+                )
+
+        circuit_counts = unpack_result(result)
+        # written from the event loop thread: records are never interleaved
+        pickle.dump({"start": start, "result": result}, raw_file)
+        raw_file.flush()
+        pickle.dump(
+            {
+                "start": start,
+                "counts": [
+                    counts for counts_list in circuit_counts for counts in counts_list
+                ],
+            },
+            results_file,
+        )
+        results_file.flush()
+        if self.checkpoint is not None:
+            self.checkpoint.record(start, circuit_counts)
+
+        self.done += 1
+        print(f"Chunk {start}-{stop} done ({self.done}/{self.num_chunks} chunks).")
+        if self.accumulator is not None:
+            self.accumulator.add_counts(start, circuit_counts)
+            print(f"Live metrics: {self.accumulator.report()}.")
@@ -0,0 +1,148 @@
+from qiskit_aer.noise import NoiseModel
+from qiskit_aer.primitives import SamplerV2 as AerSampler
+from pack_chains import fake_backend
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pickle
+import random
+import time
+import uuid
+
+# Offline stand-in for QiskitRuntimeService, Sampler, Batch and Session: jobs are
+# executed by Aer on the noise model of the fake backend and return the same
+# PrimitiveResult as the runtime Sampler. Queue latency, job size limits and
+# random failures can be configured to exercise the device code path.
+
+
+class LocalRuntimeService:
+    # service of the local device: one job runs at a time (as on a QPU), after
+    # waiting latency seconds in the queue. Jobs with more than max_circuits pubs
+    # are rejected at submission, a fraction failure_rate of the jobs fails.
+    # Finished jobs are stored in jobs_dir, so that they can be fetched by ID
+    # after a restart.
+
+    def __init__(
+        self,
+        noise_model=None,
+        method="matrix_product_state",
+        latency=0,
+        max_circuits=None,
+        failure_rate=0.0,
+        seed=None,
+        jobs_dir="data/local_runtime",
+    ):
+        self.noise_model = noise_model
+        self.method = method
+        self.latency = latency
+        self.max_circuits = max_circuits
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.jobs_dir = jobs_dir
+        self.jobs = {}
+        self.num_jobs = 0
+        # the device: runs one job at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def backend(self, name):
+        backend = fake_backend(name)
+        if self.noise_model is None:
+            self.noise_model = NoiseModel.from_backend(backend)
+        return backend
+
+    def job(self, job_id):
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        path = os.path.join(self.jobs_dir, f"{job_id}.pkl")
+        if not os.path.exists(path):
+            raise Exception(f"Job {job_id} not found.")
+        with open(path, "rb") as file:
+            return LocalJob(job_id, result=pickle.load(file))
+
+    def submit(self, pubs, shots):
+        if self.max_circuits is not None and len(pubs) > self.max_circuits:
+            raise Exception(
+                f"Job too large: {len(pubs)} circuits (at most {self.max_circuits})."
+            )
+        seed = None if self.seed is None else self.seed + self.num_jobs
+        self.num_jobs += 1
+        job = LocalJob(f"local-{uuid.uuid4().hex[:20]}")
+        job.ready_time = time.perf_counter() + self.latency
+        fail = self.random.random() < self.failure_rate
+        job.future = self.executor.submit(self._execute, job, pubs, shots, seed, fail)
+        self.jobs[job.job_id()] = job
+        return job
+
+    def _execute(self, job, pubs, shots, seed, fail):
+        # wait in the queue, then run on Aer
+        time.sleep(max(job.ready_time - time.perf_counter(), 0))
+        job.started = True
+        if fail:
+            raise Exception("Job failed on the local device.")
+        sampler = AerSampler(
+            default_shots=shots,
+            seed=seed,
+            options={
+                "backend_options": {
+                    "method": self.method,
+                    "noise_model": self.noise_model,
+                }
+            },
+        )
+        result = sampler.run(pubs, shots=shots).result()
+        with open(os.path.join(self.jobs_dir, f"{job.job_id()}.pkl"), "wb") as file:
+            pickle.dump(result, file)
+        return result
+
+
+class LocalJob:
+    # same interface as RuntimeJobV2: job_id(), status() and result()
+
+    def __init__(self, job_id, result=None):
+        self._job_id = job_id
+        self._result = result
+        self.future = None
+        self.started = result is not None
+
+    def job_id(self):
+        return self._job_id
+
+    def status(self):
+        if self.future is None:
+            return "DONE"
+        if not self.future.done():
+            return "RUNNING" if self.started else "QUEUED"
+        return "ERROR" if self.future.exception() is not None else "DONE"
+
+    def result(self):
+        if self.future is None:
+            return self._result
+        return self.future.result()
+
+
+class LocalBatch:
+    # context manager standing in for Batch and Session
+
+    def __init__(self, service=None, backend=None, max_time=None):
+        self.service = service
+        self.backend = backend
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+LocalSession = LocalBatch
+
+
+class LocalSampler:
+    # Sampler(mode) with mode a backend, a LocalBatch or a LocalSession
+
+    def __init__(self, mode=None, service=None):
+        self.service = service
+
+    def run(self, pubs, shots=1):
+        return self.service.submit(pubs, shots)
@@ -1,6 +1,23 @@
-from pack_chains import master_chains
-from analysis import update_data, process_data, process_data_pandas
-from simulation import generate_circuits, run_simulation
+from pack_chains import get_master_chain
+from analysis import update_data
+from bootstrap import bootstrap_intervals, add_intervals
+from simulation import (
+    generate_circuits,
+    iter_circuits,
+    run_simulation,
+    run_streaming_simulation,
+    compare_methods,
+    load_pickle_stream,
+)
+from transpile_cache import TranspileCache
+from checkpoint import Checkpoint
+from accumulator import RunAccumulator
+from sequential import run_sequential
+from adaptive import run_adaptive
+from storage import write_data, write_results, store_tables
+from reconciliation import data_keys, store_keys, reconcile_keys
+from privacy_amplification import amplify_keys
+import numpy as np
 import pickle
 import yaml
 
@@ -14,44 +31,357 @@ def main():
     run_sim = config["simulation"]["run_sim"]
     device = config["simulation"]["device"]
     QPU = config["simulation"]["QPU"]
+    chain_discovery = config["simulation"]["chain_discovery"]
+    chain_max_error = config["simulation"]["chain_max_error"]
     lengths = config["simulation"]["lengths"]
     runs = config["simulation"]["runs"]
     draw = config["simulation"]["draw"]
+    batch_size = config["simulation"]["batch_size"]
+    max_parallel_experiments = config["simulation"]["max_parallel_experiments"]
+    max_parallel_threads = config["simulation"]["max_parallel_threads"]
+    workers = config["simulation"]["workers"]
+    shard_size = config["simulation"]["shard_size"]
+    seed = config["simulation"]["seed"]
+    method = config["simulation"]["method"]
+    fallback_method = config["simulation"]["fallback_method"]
+    pauli_tolerance = config["simulation"]["pauli_tolerance"]
+    methods_to_compare = config["simulation"]["compare_methods"]
+    templates = config["simulation"]["templates"]
+    native = config["simulation"]["native"]
+    packing = config["simulation"]["packing"]
+    transpile_cache = config["simulation"]["transpile_cache"]
+    transpile_cache_size_mb = config["simulation"]["transpile_cache_size_mb"]
+    streaming = config["simulation"]["streaming"]
+    window = config["simulation"]["window"]
+    checkpoint = config["simulation"]["checkpoint"]
+    checkpoint_every = config["simulation"]["checkpoint_every"]
+    resume = config["simulation"]["resume"]
+    noise_cache = config["simulation"]["noise_cache"]
+    reduced_noise = config["simulation"]["reduced_noise"]
+    device_mode = config["simulation"]["device_mode"]
+    device_chunk_size = config["simulation"]["device_chunk_size"]
+    jobs_in_flight = config["simulation"]["jobs_in_flight"]
+    max_retries = config["simulation"]["max_retries"]
+    poll_interval = config["simulation"]["poll_interval"]
+    local_runtime = config["simulation"]["local_runtime"]
+    bootstrap = config["simulation"]["bootstrap"]
+    bootstrap_confidence = config["simulation"]["bootstrap_confidence"]
+    bootstrap_processes = config["simulation"]["bootstrap_processes"]
+    live_metrics = config["simulation"]["live_metrics"]
+    live_every = config["simulation"]["live_every"]
+    storage = config["simulation"]["storage"]
+    reconciliation = config["simulation"]["reconciliation"]
+    frame_bits = config["simulation"]["frame_bits"]
+    cascade_passes = config["simulation"]["cascade_passes"]
+    reconciliation_processes = config["simulation"]["reconciliation_processes"]
+    privacy_amplification = config["simulation"]["privacy_amplification"]
+    security = config["simulation"]["security"]
+    pa_block_bits = config["simulation"]["pa_block_bits"]
+    if privacy_amplification and not reconciliation:
+        raise Exception("Privacy amplification needs reconciliation: True.")
+    sequential = config["simulation"]["sequential"]
+    round_runs = config["simulation"]["round_runs"]
+    max_runs = config["simulation"]["max_runs"]
+    qber_width = config["simulation"]["qber_width"]
+    chsh_width = config["simulation"]["chsh_width"]
+    target_confidence = config["simulation"]["target_confidence"]
+    adaptive = config["simulation"]["adaptive"]
+    max_length = config["simulation"]["max_length"]
+    coarse_points = config["simulation"]["coarse_points"]
+    refine_points = config["simulation"]["refine_points"]
+    resolution = config["simulation"]["resolution"]
+    qber_threshold = config["simulation"]["qber_threshold"]
+    adaptive_budget = config["simulation"]["adaptive_budget"]
+    if (sequential or adaptive) and (checkpoint or resume or live_metrics):
+        # rounds are generated from the results of the previous ones
+        raise Exception(
+            "checkpoint, resume and live_metrics are not supported in sequential and adaptive mode."
+        )
+
+    # per-length count tables updated as the counts arrive (QUBER and CHSH printed
+    # during the simulation)
+    accumulator = RunAccumulator(every=live_every) if live_metrics else None
+
+    # options of run_simulation shared by the plain and the sequential mode
+    simulation_options = {
+        "device": device,
+        "QPU": QPU,
+        "draw": draw,
+        "batch_size": batch_size,
+        "max_parallel_experiments": max_parallel_experiments,
+        "max_parallel_threads": max_parallel_threads,
+        "workers": workers,
+        "shard_size": shard_size,
+        "method": method,
+        "fallback_method": fallback_method,
+        "pauli_tolerance": pauli_tolerance,
+        "transpile_cache": transpile_cache,
+        "transpile_cache_size_mb": transpile_cache_size_mb,
+        "noise_cache": noise_cache,
+        "reduced_noise": reduced_noise,
+        "device_mode": device_mode,
+        "device_chunk_size": device_chunk_size,
+        "jobs_in_flight": jobs_in_flight,
+        "max_retries": max_retries,
+        "poll_interval": poll_interval,
+        "local_runtime": (
+            {
+                "latency": config["simulation"]["local_latency"],
+                "max_circuits": config["simulation"]["local_max_circuits"],
+                "failure_rate": config["simulation"]["local_failure_rate"],
+            }
+            if local_runtime
+            else None
+        ),
+        "storage": storage,
+    }
+
+    if run_sim and adaptive:
+
+        # lengths chosen during the sweep (coarse grid, then refined where QBER
+        # crosses qber_threshold or the metrics change the most)
+        run_adaptive(
+            get_master_chain(QPU, chain_discovery, chain_max_error),
+            protocol,
+            runs=runs,
+            max_length=max_length,
+            coarse_points=coarse_points,
+            refine_points=refine_points,
+            resolution=resolution,
+            threshold=qber_threshold,
+            budget=adaptive_budget,
+            baseline_lengths=lengths,
+            seed=seed,
+            templates=templates,
+            native=native,
+            packing=packing,
+            **simulation_options,
+        )
+
+    elif run_sim and sequential:
+
+        # rounds of round_runs runs, each length until its QUBER and CHSH
+        # intervals are narrow enough (or max_runs)
+        run_sequential(
+            lengths,
+            get_master_chain(QPU, chain_discovery, chain_max_error),
+            protocol,
+            round_runs=round_runs,
+            max_runs=max_runs,
+            qber_width=qber_width,
+            chsh_width=chsh_width,
+            confidence=target_confidence,
+            baseline_runs=runs,
+            seed=seed,
+            templates=templates,
+            native=native,
+            packing=packing,
+            **simulation_options,
+        )
+
+    elif run_sim and streaming and not device:
+
+        # protocol choices (reproducible if a seed is given)
+        rng = np.random.default_rng(seed)
+
+        master_chain = get_master_chain(QPU, chain_discovery, chain_max_error)
+
+        # circuits are generated while the previous ones are simulated
+        circuit_stream = iter_circuits(
+            lengths=lengths,
+            runs=runs,
+            master_chain=master_chain,
+            protocol=protocol,
+            QPU=QPU,
+            templates=templates,
+            native=native,
+            packing=packing,
+            rng=rng,
+        )
+
+        run_streaming_simulation(
+            circuit_stream,
+            master_chain,
+            window=window,
+            method=method,
+            fallback_method=fallback_method,
+            pauli_tolerance=pauli_tolerance,
+            QPU=QPU,
+            noise_cache=noise_cache,
+            reduced_noise=reduced_noise,
+            batch_size=batch_size,
+            max_parallel_experiments=max_parallel_experiments,
+            max_parallel_threads=max_parallel_threads,
+            seed=seed,
+            cache=(
+                TranspileCache(max_size_mb=transpile_cache_size_mb)
+                if transpile_cache
+                else None
+            ),
+            accumulator=accumulator,
+            storage=storage,
+            **(
+                {
+                    "data_path": "data/data_columns",
+                    "results_path": "data/results_local_columns",
+                }
+                if storage == "columnar"
+                else {}
+            ),
+        )
+
+    elif run_sim:
 
-    if run_sim:
+        if checkpoint or resume:
+            # finished circuits (and device job IDs) are logged in data/checkpoint.pkl;
+            # on resume the same circuits are generated again from the logged seed
+            checkpoint = Checkpoint(
+                config["simulation"], resume=resume, every=checkpoint_every
+            )
+            seed = checkpoint.seed
+        else:
+            checkpoint = None
 
-        master_chain = master_chains[QPU]
+        # protocol choices (reproducible if a seed is given)
+        rng = np.random.default_rng(seed)
+
+        master_chain = get_master_chain(QPU, chain_discovery, chain_max_error)
 
         data, circuits = generate_circuits(
             lengths=lengths,
             runs=runs,
             master_chain=master_chain,
             protocol=protocol,
+            QPU=QPU,
+            templates=templates,
+            native=native,
+            packing=packing,
+            rng=rng,
         )
 
-        with open("data/data.pkl", "wb") as file:
-            pickle.dump(data, file)
+        if storage == "columnar":
+            write_data("data/data_columns", data)
+        else:
+            with open("data/data.pkl", "wb") as file:
+                pickle.dump(data, file)
+
+        if accumulator is not None:
+            accumulator.watch(data, circuits)
 
         run_simulation(
-            circuits=circuits, master_chain=master_chain, device=device, draw=draw
+            circuits=circuits,
+            master_chain=master_chain,
+            seed=seed,
+            checkpoint=checkpoint,
+            accumulator=accumulator,
+            **simulation_options,
         )
 
-    # process: quber, plots, remember a lot of images (circuits and processor, processor with circuits highlighted)
-    with open("data/data.pkl", "rb") as file:
-        data = pickle.load(file)
+        if methods_to_compare:
+            compare_methods(
+                data,
+                circuits,
+                master_chain,
+                methods_to_compare,
+                seed=seed,
+                QPU=QPU,
+                noise_cache=noise_cache,
+                reduced_noise=reduced_noise,
+                batch_size=batch_size,
+                max_parallel_experiments=max_parallel_experiments,
+                max_parallel_threads=max_parallel_threads,
+            )
 
-    if device:
-        with open("data/results_device.pkl", "rb") as file:
-            counts = pickle.load(file)
+    # process: quber, plots, remember a lot of images (circuits and processor, processor with circuits highlighted)
+    # per-length count tables: all the analysis needs, saved to merge campaigns
+    # (see accumulator.py)
+    if storage == "columnar":
+        # memory-mapped columns: only those needed for the count tables are read
+        count_tables = RunAccumulator().add_tables(
+            *store_tables(
+                "data/data_columns",
+                (
+                    "data/results_device_columns"
+                    if device
+                    else "data/results_local_columns"
+                ),
+            )
+        )
     else:
-        with open("data/results_local.pkl", "rb") as file:
-            counts = pickle.load(file)
+        # files written in streaming mode contain several pickled chunks
+        data = load_pickle_stream("data/data.pkl")
 
-    data = update_data(data, counts)
+        if device:
+            counts = load_pickle_stream("data/results_device.pkl")
+        else:
+            counts = load_pickle_stream("data/results_local.pkl")
 
-    processed_data = process_data_pandas(data)
+        data = update_data(data, counts)
+        count_tables = RunAccumulator().add_data(data)
+    count_tables.save("data/count_tables.json")
+
+    processed_data = count_tables.process()
+    if bootstrap:
+        # percentile and BCa intervals next to the Wald errors
+        lengths, tables = count_tables.lengths_tables()
+        processed_data = add_intervals(
+            processed_data,
+            bootstrap_intervals(
+                lengths,
+                tables,
+                num_replicates=bootstrap,
+                confidence=bootstrap_confidence,
+                seed=seed,
+                processes=bootstrap_processes,
+            ),
+        )
     with open("data/processed_data.pkl", "wb") as file:
         pickle.dump(processed_data, file)
+    if storage == "columnar":
+        write_results("data/processed_data_columns", processed_data)
+
+    if reconciliation:
+        # Cascade on the sifted key of every length, block sizes from its QUBER
+        if storage == "columnar":
+            keys = store_keys(
+                "data/data_columns",
+                (
+                    "data/results_device_columns"
+                    if device
+                    else "data/results_local_columns"
+                ),
+            )
+        else:
+            keys = data_keys(data)
+        reconciliation_df, reconciled_keys = reconcile_keys(
+            keys,
+            dict(zip(processed_data["length"], processed_data["QUBER"])),
+            frame_bits=frame_bits,
+            num_passes=cascade_passes,
+            seed=seed,
+            processes=reconciliation_processes,
+        )
+        print(reconciliation_df.to_string(index=False))
+        with open("data/reconciliation.pkl", "wb") as file:
+            pickle.dump(reconciliation_df, file)
+        with open("data/reconciled_keys.pkl", "wb") as file:
+            pickle.dump(reconciled_keys, file)
+
+    if privacy_amplification:
+        # Toeplitz hashing of the reconciled keys, final lengths from their QBER
+        # and leaked bits
+        amplification_df, final_keys = amplify_keys(
+            reconciled_keys,
+            reconciliation_df,
+            security=security,
+            block_bits=pa_block_bits,
+            seed=seed,
+        )
+        print(amplification_df.to_string(index=False))
+        with open("data/privacy_amplification.pkl", "wb") as file:
+            pickle.dump(amplification_df, file)
+        with open("data/final_keys.pkl", "wb") as file:
+            pickle.dump(final_keys, file)
 
 
 if __name__ == "__main__":
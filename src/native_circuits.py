@@ -0,0 +1,175 @@
+from qiskit import QuantumCircuit, ClassicalRegister, transpile
+from qiskit.circuit import CircuitInstruction
+from qiskit.transpiler import CouplingMap
+from qiskit.exceptions import QiskitError
+from qiskit.quantum_info import Clifford, Operator
+from functools import lru_cache
+
+# gates used by the protocol runs and their number of qubits
+PROTOCOL_GATES = {"x": 1, "h": 1, "id": 1, "swap": 2, "cx": 2}
+
+
+def native_basis(backend):
+    # native gates of the backend (no control flow, measurements or delays)
+    return tuple(
+        sorted(
+            name
+            for name in backend.target.operation_names
+            if name not in ("for_loop", "switch_case", "if_else", "measure", "delay")
+        )
+    )
+
+
+@lru_cache
+def gate_decomposition(name, basis, reverse=False):
+    # decomposition of a protocol gate in the native basis, as a list of
+    # (operation, local qubits). For two qubit gates reverse=True means that the
+    # native two qubit gate acts from the second qubit to the first one.
+    num_qubits = PROTOCOL_GATES[name]
+    qc = QuantumCircuit(num_qubits)
+    getattr(qc, name)(*range(num_qubits))
+    coupling_map = None
+    if num_qubits == 2:
+        coupling_map = CouplingMap([[1, 0]] if reverse else [[0, 1]])
+    decomposed = transpile(
+        qc,
+        basis_gates=list(basis),
+        coupling_map=coupling_map,
+        initial_layout=list(range(num_qubits)),
+        optimization_level=0,
+    )
+    return [
+        (
+            instruction.operation,
+            tuple(decomposed.find_bit(qb).index for qb in instruction.qubits),
+        )
+        for instruction in decomposed.data
+    ]
+
+
+class NativeCircuit(QuantumCircuit):
+    # circuit on all the physical qubits of the backend that exposes the protocol
+    # gates on virtual qubits (virtual qubit i is physical qubit layout[i]) and
+    # appends their native decomposition: the result runs without transpile
+
+    def __init__(self, backend, layout, metadata=None):
+        super().__init__(backend.num_qubits, metadata=dict(metadata or {}, native=True))
+        self.layout_list = list(layout)
+        self.basis = native_basis(backend)
+        two_qubit_gates = [
+            name
+            for name in self.basis
+            if backend.target.operation_from_name(name).num_qubits == 2
+        ]
+        self.directions = set(backend.target[two_qubit_gates[0]].keys())
+
+    def _append_native(self, name, *virtual_qubits):
+        physical = [self.layout_list[qb] for qb in virtual_qubits]
+        reverse = len(physical) == 2 and tuple(physical) not in self.directions
+        if reverse and tuple(physical[::-1]) not in self.directions:
+            raise Exception(f"Qubits {physical} are not coupled.")
+        qubits = [self.qubits[qb] for qb in physical]
+        for operation, local_qubits in gate_decomposition(name, self.basis, reverse):
+            # operations come from the transpiler: skip append validation
+            self._append(
+                CircuitInstruction(operation, [qubits[qb] for qb in local_qubits])
+            )
+
+    def compose_gadget(self, gadget, offset):
+        # gadget: (operation, virtual qubits) pairs of protocol gates
+        for operation, gadget_qubits in gadget:
+            self._append_native(operation.name, *(offset + qb for qb in gadget_qubits))
+
+    def x(self, qubit):
+        self._append_native("x", qubit)
+
+    def h(self, qubit):
+        self._append_native("h", qubit)
+
+    def id(self, qubit):
+        self._append_native("id", qubit)
+
+    def swap(self, qubit1, qubit2):
+        self._append_native("swap", qubit1, qubit2)
+
+    def cx(self, control_qubit, target_qubit):
+        self._append_native("cx", control_qubit, target_qubit)
+
+    def measure_all(self):
+        # same classical layout as measure_all on the virtual circuit
+        creg = ClassicalRegister(len(self.layout_list), "meas")
+        self.add_register(creg)
+        self.barrier(self.layout_list)
+        self.measure(self.layout_list, creg)
+
+
+def is_native(circuit):
+    return circuit.metadata.get("native", False)
+
+
+def unitary_part(circuit):
+    # circuit without barriers and measurements on the physical qubits
+    reduced = QuantumCircuit(circuit.num_qubits)
+    for instruction in circuit.data:
+        if instruction.operation.name in ("measure", "barrier"):
+            continue
+        reduced.append(
+            instruction.operation,
+            [circuit.find_bit(qb).index for qb in instruction.qubits],
+        )
+    return reduced
+
+
+def wire_sequences(circuit):
+    # ordered operations acting on each qubit: equal sequences on every wire
+    # mean the same circuit up to the order of commuting (disjoint) gates
+    sequences = [[] for _ in range(circuit.num_qubits)]
+    for instruction in circuit.data:
+        qubits = tuple(circuit.find_bit(qb).index for qb in instruction.qubits)
+        key = (instruction.operation.name, tuple(instruction.operation.params), qubits)
+        for qb in qubits:
+            sequences[qb].append(key)
+    return sequences
+
+
+def measured_qubits(circuit):
+    # physical qubit measured by each classical bit
+    return [
+        circuit.find_bit(instruction.qubits[0]).index
+        for instruction in sorted(
+            (
+                instruction
+                for instruction in circuit.data
+                if instruction.operation.name == "measure"
+            ),
+            key=lambda instruction: circuit.find_bit(instruction.clbits[0]).index,
+        )
+    ]
+
+
+def verify_native_circuits(native_circuits, virtual_circuits, backend, layout=None):
+    # check that each native circuit implements the same operation as the
+    # transpiled virtual circuit: same measurements and either the same gates on
+    # every qubit or an equivalent Clifford (or, for few qubits, unitary) operation
+    for idx, (native, virtual) in enumerate(zip(native_circuits, virtual_circuits)):
+        transpiled = transpile(
+            virtual, backend=backend, initial_layout=layout, optimization_level=0
+        )
+        if measured_qubits(native) != measured_qubits(transpiled):
+            raise Exception(f"Circuit {idx}: measured qubits differ.")
+
+        native_unitary = unitary_part(native)
+        transpiled_unitary = unitary_part(transpiled)
+        if wire_sequences(native_unitary) == wire_sequences(transpiled_unitary):
+            continue
+
+        try:
+            equivalent = Clifford(native_unitary) == Clifford(transpiled_unitary)
+        except QiskitError:
+            # not Clifford: compare unitaries (only feasible on few qubits)
+            equivalent = Operator(native_unitary).equiv(Operator(transpiled_unitary))
+        if not equivalent:
+            raise Exception(f"Circuit {idx}: native circuit is not equivalent.")
+
+    print(f"Native circuits verified: {len(native_circuits)} circuits equivalent.")
+    return True
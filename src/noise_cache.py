@@ -0,0 +1,77 @@
+from qiskit_aer.noise import NoiseModel
+from pack_chains import calibration_date
+import hashlib
+import os
+import pickle
+
+
+def chain_couplers(chain):
+    # couplers between consecutive qubits of the chain, in both directions
+    couplers = set()
+    for qb1, qb2 in zip(chain, chain[1:]):
+        couplers.update([(qb1, qb2), (qb2, qb1)])
+    return couplers
+
+
+def reduce_noise_model(noise_model, qubits, couplers=None):
+    # same noise model restricted to the errors acting on qubits (and, for two
+    # qubit errors, on couplers): circuits that only use them have the same noise
+    qubits = set(qubits)
+    reduced = NoiseModel(basis_gates=noise_model.basis_gates)
+    for instruction, qubit_errors in noise_model._local_quantum_errors.items():
+        for qargs, error in qubit_errors.items():
+            if not qubits.issuperset(qargs):
+                continue
+            if len(qargs) == 2 and couplers is not None and qargs not in couplers:
+                continue
+            reduced.add_quantum_error(error, instruction, qargs)
+    for instruction, error in noise_model._default_quantum_errors.items():
+        reduced.add_all_qubit_quantum_error(error, instruction)
+    for qargs, error in noise_model._local_readout_errors.items():
+        if qubits.issuperset(qargs):
+            reduced.add_readout_error(error, qargs)
+    if noise_model._default_readout_error is not None:
+        reduced.add_all_qubit_readout_error(noise_model._default_readout_error)
+    return reduced
+
+
+class NoiseModelStore:
+    # noise models built from a backend, pickled in cache_dir and keyed by the
+    # backend name, its calibration date, the variant (full or Pauli-twirled for
+    # the stabilizer method) and the qubits and couplers kept
+
+    def __init__(self, cache_dir="data/noise_models"):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, backend, pauli, qubits=None, couplers=None):
+        digest = hashlib.sha256()
+        digest.update(backend.name.encode())
+        digest.update(calibration_date(backend).encode())
+        digest.update(repr(pauli).encode())
+        if qubits is not None:
+            digest.update(repr(sorted(qubits)).encode())
+        if couplers is not None:
+            digest.update(repr(sorted(couplers)).encode())
+        return digest.hexdigest()
+
+    def get(self, backend, pauli=False, qubits=None, couplers=None):
+        # stored noise model, None if it was never built
+        path = os.path.join(
+            self.cache_dir, f"{self.key(backend, pauli, qubits, couplers)}.pkl"
+        )
+        try:
+            with open(path, "rb") as file:
+                return pickle.load(file)
+        except (FileNotFoundError, EOFError):
+            return None
+
+    def put(self, noise_model, backend, pauli=False, qubits=None, couplers=None):
+        path = os.path.join(
+            self.cache_dir, f"{self.key(backend, pauli, qubits, couplers)}.pkl"
+        )
+        # write to a temporary file first: workers may share the same store
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(noise_model, file)
+        os.replace(tmp_path, path)
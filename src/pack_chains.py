@@ -1,4 +1,138 @@
-master_chains = {}
+from qiskit.providers.exceptions import QiskitBackendNotFoundError
+from qiskit_ibm_runtime.fake_provider import FakeProviderForBackendV2
+import json
+import os
+
+
+def fake_backend(QPU):
+    # fake backend with the topology and calibration of QPU ("ibm_sherbrooke" -> fake_sherbrooke)
+    name = QPU if QPU.startswith("fake_") else QPU.replace("ibm_", "fake_", 1)
+    try:
+        return FakeProviderForBackendV2().backend(name)
+    except QiskitBackendNotFoundError:
+        raise Exception("QPU unknown.")
+
+
+def error_rates(backend):
+    # readout error of each qubit and worst two qubit gate error of each coupler
+    target = backend.target
+    qubit_error = {}
+    edge_error = {}
+    for name in target.operation_names:
+        for qargs, properties in target[name].items():
+            if qargs is None or properties is None or properties.error is None:
+                continue
+            if name == "measure":
+                qubit_error[qargs[0]] = properties.error
+            elif len(qargs) == 2:
+                edge = tuple(sorted(qargs))
+                edge_error[edge] = max(edge_error.get(edge, 0), properties.error)
+    return qubit_error, edge_error
+
+
+def _walk(adjacency, start, weight):
+    # greedy simple path from start (grown at both ends): always move to the
+    # free neighbour with the fewest free neighbours (Warnsdorff's rule), unless
+    # it is a dead end; ties are broken by the lowest weight
+    path = [start]
+    visited = {start}
+    for _ in range(2):
+        current = path[-1]
+        while True:
+            candidates = []
+            for qb in adjacency[current]:
+                if qb in visited:
+                    continue
+                onward = sum(nb not in visited for nb in adjacency[qb])
+                candidates.append((onward == 0, onward, weight(current, qb), qb))
+            if not candidates:
+                break
+            current = min(candidates)[-1]
+            path.append(current)
+            visited.add(current)
+        path.reverse()
+    return path
+
+
+def find_chain(backend, weighted=False, max_error=None, max_starts=64):
+    # long simple path through the coupling map of backend (the longest one is
+    # NP-hard to find: greedy walks from the max_starts qubits of lowest degree).
+    # weighted: prefer qubits and couplers with low error and, among the longest
+    # paths found, pick the one with the lowest total error.
+    # max_error: qubits and couplers with a larger error are not used.
+    qubit_error, edge_error = error_rates(backend)
+    adjacency = {qb: set() for qb in range(backend.num_qubits)}
+    for qb1, qb2 in backend.coupling_map.get_edges():
+        edge = tuple(sorted((qb1, qb2)))
+        if max_error is not None and (
+            edge_error.get(edge, 0) > max_error
+            or qubit_error.get(qb1, 0) > max_error
+            or qubit_error.get(qb2, 0) > max_error
+        ):
+            continue
+        adjacency[qb1].add(qb2)
+        adjacency[qb2].add(qb1)
+
+    def error_weight(qb1, qb2):
+        return edge_error.get(tuple(sorted((qb1, qb2))), 0) + qubit_error.get(qb2, 0)
+
+    # ties broken by qubit index, and by error in weighted mode
+    weights = [lambda qb1, qb2: 0]
+    if weighted:
+        weights.append(error_weight)
+
+    starts = sorted(
+        (qb for qb in adjacency if adjacency[qb]),
+        key=lambda qb: (len(adjacency[qb]), qb),
+    )[:max_starts]
+    best, best_error = [], 0
+    for start in starts:
+        for weight in weights:
+            path = _walk(adjacency, start, weight)
+            error = 0
+            if weighted:
+                error = sum(error_weight(qb1, qb2) for qb1, qb2 in zip(path, path[1:]))
+            if len(path) > len(best) or (len(path) == len(best) and error < best_error):
+                best, best_error = path, error
+    return best
+
+
+def calibration_date(backend):
+    properties = backend.properties()
+    if properties is None:
+        return "uncalibrated"
+    return properties.last_update_date.strftime("%Y%m%d%H%M%S")
+
+
+def cached_chain(backend, weighted=False, max_error=None, cache_dir="data/chains"):
+    # chains are stored per backend name and calibration date
+    kind = "weighted" if weighted else "longest"
+    if max_error is not None:
+        kind += f"_max{max_error}"
+    path = os.path.join(
+        cache_dir, f"{backend.name}_{calibration_date(backend)}_{kind}.json"
+    )
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            return json.load(file)
+    chain = find_chain(backend, weighted=weighted, max_error=max_error)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(chain, file)
+    return chain
+
+
+class MasterChains(dict):
+    # hand-made chains, filled with the chain found in the coupling map of the
+    # fake backend for any other QPU the first time it is requested
+
+    def __missing__(self, QPU):
+        chain = cached_chain(fake_backend(QPU))
+        self[QPU] = chain
+        return chain
+
+
+master_chains = MasterChains()
 
 # Sherbrooke
 
@@ -17,3 +151,17 @@ master_chain_Sherbrooke.extend([112])
 master_chain_Sherbrooke.extend(list(range(126, 112, -1)))
 
 master_chains["ibm_sherbrooke"] = master_chain_Sherbrooke
+
+
+def get_master_chain(QPU, discovery="manual", max_error=None):
+    # "manual": hand-made chain if there is one, "longest" or "weighted": chain
+    # found in the coupling map (weighted by the calibrated error rates)
+    if discovery == "manual":
+        return master_chains[QPU]
+    if discovery in ("longest", "weighted"):
+        return cached_chain(
+            fake_backend(QPU),
+            weighted=discovery == "weighted",
+            max_error=max_error,
+        )
+    raise Exception("Chain discovery unknown.")
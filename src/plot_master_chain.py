@@ -1,17 +1,25 @@
 from qiskit.visualization import plot_gate_map
-from pack_chains import master_chains
-from qiskit_ibm_runtime.fake_provider import FakeSherbrooke
+from pack_chains import fake_backend, get_master_chain
+import yaml
 
-backend = FakeSherbrooke()
+with open("config/sim_config.yaml", "r") as file:
+    config = yaml.safe_load(file)
 
-chain = master_chains["ibm_sherbrooke"]
+QPU = config["simulation"]["QPU"]
+backend = fake_backend(QPU)
+
+chain = get_master_chain(
+    QPU,
+    config["simulation"]["chain_discovery"],
+    config["simulation"]["chain_max_error"],
+)
 
 # Create a color map for qubits
-total_qubits = backend.configuration().num_qubits
+total_qubits = backend.num_qubits
 qubit_color = ["#808080"] * total_qubits
 
 for qubit in chain:
     qubit_color[qubit] = "#FF0000"
 
 fig = plot_gate_map(backend, qubit_color=qubit_color)
-fig.savefig("img/ibm_sherbrooke_topology_master_chain.png")
+fig.savefig(f"img/{QPU}_topology_master_chain.png")
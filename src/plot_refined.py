@@ -2,10 +2,15 @@ import os
 import pickle
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
+from storage import read_results
 
 
 # Function to load data
-def load_data(folder):
+def load_data(folder, columns=None, lengths=None):
+    # columnar results (storage: "columnar") are read column by column
+    columns_path = os.path.join(folder, "processed_data_columns")
+    if os.path.exists(columns_path):
+        return read_results(columns_path, columns, lengths)
     data_path = os.path.join(folder, "processed_data.pkl")
     if not os.path.exists(data_path):
         print(f"Warning: No processed data found in {folder}. Skipping.")
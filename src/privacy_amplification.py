@@ -0,0 +1,108 @@
+from reconciliation import binary_entropy
+import scipy.fft
+import pandas as pd
+import numpy as np
+import time
+
+# Privacy amplification of the reconciled keys by Toeplitz hashing. The hash of an
+# n-bit block x is T x mod 2, with T the m x n Toeplitz matrix of a public random
+# seed of n + m - 1 bits: row i of T x is the convolution of the seed and x at
+# n - 1 + i, so all the rows come from one FFT convolution (O(n log n) instead of
+# the O(n m) product). Blocks of the same size are hashed together as the rows of
+# one array.
+
+
+def final_key_length(num_bits, qber, leaked_bits, security=1e-10):
+    # bits left once the information of the eavesdropper (n h(QBER) from the
+    # errors, the parities leaked by reconciliation) and the security parameter
+    # are removed
+    if num_bits == 0 or not np.isfinite(qber):
+        return 0
+    length = num_bits * (1 - binary_entropy(qber)) - leaked_bits + 2 * np.log2(security)
+    return max(int(np.floor(length)), 0)
+
+
+def toeplitz_seed(num_bits, final_bits, rng):
+    return rng.integers(0, 2, num_bits + final_bits - 1, dtype=np.uint8)
+
+
+def toeplitz_hash(blocks, seed, final_bits, workers=1):
+    # hashes of the rows of blocks [block, n] (0/1) with the Toeplitz matrix of
+    # seed: [block, final_bits]
+    blocks = np.atleast_2d(blocks)
+    num_bits = blocks.shape[1]
+    if final_bits == 0:
+        return np.zeros((len(blocks), 0), dtype=np.uint8)
+    size = scipy.fft.next_fast_len(num_bits + len(seed) - 1, real=True)
+    product = scipy.fft.rfft(blocks, size, axis=1, workers=workers) * scipy.fft.rfft(
+        seed, size, workers=workers
+    )
+    convolution = scipy.fft.irfft(product, size, axis=1, workers=workers)
+    rows = convolution[:, num_bits - 1 : num_bits - 1 + final_bits]
+    # sums of at most n ones: exact once rounded
+    return (np.rint(rows).astype(np.int64) & 1).astype(np.uint8)
+
+
+def toeplitz_hash_matrix(blocks, seed, final_bits):
+    # reference: the product with the Toeplitz matrix, T[i, j] = seed[n - 1 + i - j]
+    blocks = np.atleast_2d(blocks)
+    num_bits = blocks.shape[1]
+    rows = np.arange(final_bits)[:, None] + num_bits - 1 - np.arange(num_bits)
+    matrix = seed[rows].astype(np.int64)
+    return ((blocks.astype(np.int64) @ matrix.T) & 1).astype(np.uint8)
+
+
+def amplify_key(key, num_bits, qber, leaked_bits, security, block_bits, rng, workers=1):
+    # final key of one packed key: blocks of about block_bits bits (the same
+    # size, a few bits of the key dropped) hashed together with one seed, each to
+    # its share of the final length. Returns the packed final key and its bits
+    bits = np.unpackbits(key, count=num_bits)
+    num_blocks = max(-(-num_bits // block_bits), 1)
+    size = num_bits // num_blocks
+    blocks = bits[: num_blocks * size].reshape(num_blocks, size)
+    final_bits = final_key_length(
+        size, qber, leaked_bits * size / max(num_bits, 1), security
+    )
+    if size == 0 or final_bits == 0:
+        return np.zeros(0, dtype=np.uint8), 0
+    seed = toeplitz_seed(size, final_bits, rng)
+    final_key = toeplitz_hash(blocks, seed, final_bits, workers).ravel()
+    return np.packbits(final_key), len(final_key)
+
+
+def amplify_keys(
+    reconciled_keys,
+    reconciliation_df,
+    security=1e-10,
+    block_bits=2**20,
+    seed=None,
+    workers=1,
+):
+    # final key of every length ({length: (packed key, number of bits)}), output
+    # length from the QBER and the leaked bits of reconciliation_df. Returns the
+    # per-length report and the final keys ({length: (packed key, number of bits)})
+    rng = np.random.default_rng(seed)
+    reconciliation_df = reconciliation_df.set_index("length")
+    rows = []
+    final_keys = {}
+    for length, (key, num_bits) in reconciled_keys.items():
+        qber = reconciliation_df.loc[length, "QBER"]
+        leaked_bits = reconciliation_df.loc[length, "leaked_bits"]
+        start = time.perf_counter()
+        final_key, final_bits = amplify_key(
+            key, num_bits, qber, leaked_bits, security, block_bits, rng, workers
+        )
+        elapsed = time.perf_counter() - start
+        final_keys[length] = (final_key, final_bits)
+        rows.append(
+            {
+                "length": length,
+                "reconciled_bits": num_bits,
+                "QBER": qber,
+                "leaked_bits": leaked_bits,
+                "final_bits": final_bits,
+                "key_fraction": final_bits / num_bits if num_bits else np.nan,
+                "Mbit_per_s": num_bits / elapsed / 1e6 if elapsed > 0 else np.nan,
+            }
+        )
+    return pd.DataFrame(rows), final_keys
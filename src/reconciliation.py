@@ -0,0 +1,294 @@
+from concurrent.futures import ProcessPoolExecutor
+from storage import store_measured
+from run_table import RunTable
+import pandas as pd
+import numpy as np
+import time
+
+# Cascade error reconciliation of the sifted keys (bits of the runs where Alice
+# and Bob chose the same basis). A key is cut into frames of frame_bits bits,
+# stored bit-packed (np.packbits) and reconciled independently, so that batches of
+# frames can go to a process pool. Within a batch every step is vectorized over
+# all the blocks: block parities and the parities of the binary search are
+# differences of prefix parities (cumulative XOR) of the permuted keys, and the
+# binary searches of all the blocks with an odd parity difference advance together.
+
+
+def sifted_keys(length, alice_basis, bob_basis, alice_bit, bob_bit):
+    # {length: (alice_key, bob_key)}: bits of the matched-basis runs, in run order
+    sifted = (alice_basis == bob_basis) & (bob_bit >= 0) & (alice_bit >= 0)
+    keys = {}
+    for value in np.unique(length[sifted]):
+        runs = sifted & (length == value)
+        keys[int(value)] = (
+            alice_bit[runs].astype(np.uint8),
+            bob_bit[runs].astype(np.uint8),
+        )
+    return keys
+
+
+def data_keys(data):
+    # sifted keys of the runs with the measured bits (see update_data), a RunTable
+    # or legacy data rows
+    if not isinstance(data, RunTable):
+        data = RunTable.from_rows(data)
+    return sifted_keys(
+        data.length, data.alice_basis, data.bob_basis, data.alice_bit, data.bob_bit
+    )
+
+
+def store_keys(data_path, counts_path, lengths=None):
+    # sifted keys from a data store and a counts store (see storage.py)
+    columns = store_measured(data_path, counts_path, lengths)
+    return sifted_keys(
+        columns["length"],
+        columns["alice_basis"],
+        columns["bob_basis"],
+        columns["alice_bit"],
+        columns["bob_bit"],
+    )
+
+
+def initial_block_size(qber, frame_bits):
+    # first pass blocks of about 0.73 / QBER bits (one error expected in half of
+    # them), the whole frame if no errors are expected
+    if not np.isfinite(qber) or qber <= 0:
+        return frame_bits
+    return int(np.clip(round(0.73 / qber), 4, frame_bits))
+
+
+def pack_frames(key, frame_bits):
+    # key cut into frames of frame_bits bits (the last one padded with zeros),
+    # packed: [frame, frame_bits // 8]
+    num_frames = max(-(-len(key) // frame_bits), 1)
+    frames = np.zeros(num_frames * frame_bits, dtype=np.uint8)
+    frames[: len(key)] = key
+    return np.packbits(frames.reshape(num_frames, frame_bits), axis=1)
+
+
+def prefix_parity(bits):
+    # parity[j] = XOR of bits[:j], so that the parity of bits[lo:hi] is
+    # parity[hi] ^ parity[lo]
+    parity = np.zeros(len(bits) + 1, dtype=np.uint8)
+    np.bitwise_xor.accumulate(bits, out=parity[1:])
+    return parity
+
+
+class CascadePass:
+    # blocks of one pass over a batch of frames: bits are permuted within each
+    # frame (not in the first pass) and cut into blocks of block_size bits. odd:
+    # blocks where the parities of Alice and Bob differ
+
+    def __init__(self, alice, bob, num_frames, frame_bits, block_size, rng=None):
+        if rng is None:
+            self.perm = np.arange(len(alice))
+        else:
+            self.perm = (
+                rng.permuted(np.tile(np.arange(frame_bits), (num_frames, 1)), axis=1)
+                + frame_bits * np.arange(num_frames)[:, None]
+            ).ravel()
+        # position of each bit in the permuted order
+        self.position = np.empty_like(self.perm)
+        self.position[self.perm] = np.arange(len(self.perm))
+
+        starts = np.arange(0, frame_bits, block_size)
+        self.starts = (starts + frame_bits * np.arange(num_frames)[:, None]).ravel()
+        self.ends = np.minimum(
+            self.starts + block_size,
+            (self.starts // frame_bits + 1) * frame_bits,
+        )
+        self.block = np.repeat(np.arange(len(self.starts)), self.ends - self.starts)
+        self.alice_parity = prefix_parity(alice[self.perm])
+        self.odd = self.block_parities(self.alice_parity) ^ self.block_parities(
+            prefix_parity(bob[self.perm])
+        )
+
+    def block_parities(self, parity):
+        return parity[self.ends] ^ parity[self.starts]
+
+    def toggle(self, flipped):
+        # parity differences of the blocks holding the corrected bits
+        np.bitwise_xor.at(self.odd, self.block[self.position[flipped]], 1)
+
+    def correct(self, bob):
+        # binary search of one error in every block with an odd parity difference
+        # (all the blocks at once), returns the corrected bits and the leaked
+        # parities (one per bisection of a block)
+        bob_parity = prefix_parity(bob[self.perm])
+        blocks = np.flatnonzero(self.odd)
+        low, high = self.starts[blocks], self.ends[blocks]
+        leaked = 0
+        while True:
+            active = high - low > 1
+            if not active.any():
+                break
+            leaked += int(active.sum())
+            mid = (low + high) // 2
+            left = (
+                self.alice_parity[mid] ^ self.alice_parity[low]
+                != bob_parity[mid] ^ bob_parity[low]
+            )
+            high = np.where(active & left, mid, high)
+            low = np.where(active & ~left, mid, low)
+        flipped = self.perm[low]
+        bob[flipped] ^= 1
+        return flipped, leaked
+
+
+def cascade(alice, bob, num_frames, frame_bits, block_size, num_passes=4, rng=None):
+    # Bob's frames corrected to Alice's (unpacked, frames one after the other),
+    # returns the corrected bits and the leaked parities. Block sizes double at
+    # every pass; a corrected bit changes the parity of its blocks in the previous
+    # passes, which are then searched again (the cascade)
+    if rng is None:
+        rng = np.random.default_rng()
+    bob = bob.copy()
+    passes = []
+    leaked = 0
+    for idx in range(num_passes):
+        size = min(block_size * 2**idx, frame_bits)
+        current = CascadePass(
+            alice, bob, num_frames, frame_bits, size, None if idx == 0 else rng
+        )
+        # Alice's parity of every block is disclosed
+        leaked += len(current.starts)
+        passes.append(current)
+
+        while True:
+            pending = [
+                cascade_pass for cascade_pass in passes if cascade_pass.odd.any()
+            ]
+            if not pending:
+                break
+            flipped, bits = pending[0].correct(bob)
+            leaked += bits
+            for cascade_pass in passes:
+                cascade_pass.toggle(flipped)
+    return bob, leaked
+
+
+def reconcile_frames(
+    alice_frames, bob_frames, frame_bits, block_size, num_passes, seed
+):
+    # one batch of packed frames (run by the workers of the pool)
+    num_frames = len(alice_frames)
+    alice = np.unpackbits(alice_frames, axis=1).ravel()
+    bob = np.unpackbits(bob_frames, axis=1).ravel()
+    bob, leaked = cascade(
+        alice,
+        bob,
+        num_frames,
+        frame_bits,
+        block_size,
+        num_passes,
+        np.random.default_rng(seed),
+    )
+    return np.packbits(bob.reshape(num_frames, frame_bits), axis=1), leaked
+
+
+def reconcile_key(
+    alice_key,
+    bob_key,
+    qber,
+    frame_bits=2**14,
+    num_passes=4,
+    batch_frames=16,
+    seed=None,
+    executor=None,
+):
+    # Bob's key reconciled with Alice's (bit-packed), with the leaked parities and
+    # the block size of the first pass chosen from the QBER. Batches of
+    # batch_frames frames go to the executor if given
+    # frames of whole bytes, of about the same size: padding (whose blocks leak
+    # parities) is less than a byte per frame
+    num_frames = max(-(-len(alice_key) // frame_bits), 1)
+    frame_bits = 8 * -(-len(alice_key) // (8 * num_frames)) or 8
+    block_size = initial_block_size(qber, frame_bits)
+    alice_frames = pack_frames(alice_key, frame_bits)
+    bob_frames = pack_frames(bob_key, frame_bits)
+    starts = range(0, len(alice_frames), batch_frames)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(len(starts))
+    args = (
+        [alice_frames[start : start + batch_frames] for start in starts],
+        [bob_frames[start : start + batch_frames] for start in starts],
+        [frame_bits] * len(starts),
+        [block_size] * len(starts),
+        [num_passes] * len(starts),
+        seeds,
+    )
+    if executor is not None:
+        batches = list(executor.map(reconcile_frames, *args))
+    else:
+        batches = list(map(reconcile_frames, *args))
+    frames = np.concatenate([frames for frames, _ in batches])
+    leaked = sum(leaked for _, leaked in batches)
+    # padding bits are equal on both sides, never corrected
+    key = np.unpackbits(frames, axis=1).ravel()[: len(bob_key)]
+    return np.packbits(key), leaked, block_size
+
+
+def binary_entropy(p):
+    p = np.clip(p, 1e-12, 1 - 1e-12)
+    return -p * np.log2(p) - (1 - p) * np.log2(1 - p)
+
+
+def reconcile_keys(
+    keys,
+    qbers,
+    frame_bits=2**14,
+    num_passes=4,
+    batch_frames=16,
+    seed=None,
+    processes=1,
+):
+    # Cascade on the sifted key of every length ({length: (alice_key, bob_key)},
+    # qbers: {length: QBER}). Returns the per-length report and the reconciled
+    # keys ({length: (packed key, number of bits)})
+    seeds = dict(zip(keys, np.random.SeedSequence(seed).spawn(len(keys))))
+    executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    rows = []
+    reconciled = {}
+    try:
+        for length, (alice_key, bob_key) in keys.items():
+            start = time.perf_counter()
+            key, leaked, block_size = reconcile_key(
+                alice_key,
+                bob_key,
+                qbers[length],
+                frame_bits=frame_bits,
+                num_passes=num_passes,
+                batch_frames=batch_frames,
+                seed=seeds[length],
+                executor=executor,
+            )
+            elapsed = time.perf_counter() - start
+            num_bits = len(alice_key)
+            reconciled[length] = (key, num_bits)
+            errors = int(np.count_nonzero(alice_key != bob_key))
+            residual = int(
+                np.count_nonzero(np.unpackbits(key, count=num_bits) != alice_key)
+            )
+            rows.append(
+                {
+                    "length": length,
+                    "sifted_bits": num_bits,
+                    "QBER": qbers[length],
+                    "key_errors": errors,
+                    "block_size": block_size,
+                    "leaked_bits": leaked,
+                    # leaked bits over the Shannon limit n h(QBER)
+                    "efficiency": (
+                        leaked / (num_bits * binary_entropy(errors / num_bits))
+                        if num_bits and errors
+                        else np.nan
+                    ),
+                    "residual_error_rate": residual / num_bits if num_bits else np.nan,
+                    "bits_per_s": num_bits / elapsed if elapsed > 0 else np.nan,
+                }
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return pd.DataFrame(rows), reconciled
@@ -0,0 +1,165 @@
+from operator import itemgetter
+import pandas as pd
+import numpy as np
+
+# columns of the protocol runs, in the order of the (legacy) data rows
+# [length, alice_basis, bob_basis, alice_bit, bob_bit, virtual_qb, cl_bit, circuit_idx]
+COLUMNS = {
+    "length": np.int32,
+    "alice_basis": np.int8,
+    "bob_basis": np.int8,
+    "alice_bit": np.int8,
+    "bob_bit": np.int8,
+    "virtual_qb": np.int32,
+    "cl_bit": np.int32,
+    "circuit_idx": np.int32,
+}
+# bases are stored as codes: BASES[code]
+BASES = ["X", "Z"]
+BASIS_COLUMNS = ["alice_basis", "bob_basis"]
+BIT_COLUMNS = ["alice_bit", "bob_bit"]
+# bits not measured yet (Bob's bits and Alice's BBM92 bits until update_data)
+NOT_MEASURED = -1
+
+
+class RunTable:
+    # protocol runs as NumPy columns (20 bytes per run instead of a list of eight
+    # Python objects). Columns are readable as attributes (table.length, ...) and
+    # grow by doubling their capacity, so appends are amortized O(1) per run.
+
+    def __init__(self, capacity=1024):
+        self._columns = {
+            name: np.empty(capacity, dtype=dtype) for name, dtype in COLUMNS.items()
+        }
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get("_columns")
+        if columns is not None and name in columns:
+            return columns[name][: self._size]
+        raise AttributeError(name)
+
+    def columns(self):
+        # views of the columns (no copy)
+        return {name: column[: self._size] for name, column in self._columns.items()}
+
+    def _reserve(self, size):
+        capacity = len(self._columns["length"])
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            self._columns[name] = grown
+
+    def append_columns(self, **columns):
+        # new runs given as columns (scalars are broadcast), bob_bit not measured
+        # if missing
+        columns.setdefault("bob_bit", NOT_MEASURED)
+        num_runs = max(np.size(value) for value in columns.values())
+        self._reserve(self._size + num_runs)
+        for name, column in self._columns.items():
+            column[self._size : self._size + num_runs] = columns[name]
+        self._size += num_runs
+        return self
+
+    def extend(self, other):
+        if isinstance(other, RunTable):
+            return self.append_columns(**other.columns())
+        return self.extend(RunTable.from_rows(other))
+
+    @classmethod
+    def concat(cls, tables):
+        table = cls(capacity=max(sum(len(table) for table in tables), 1))
+        for other in tables:
+            table.extend(other)
+        return table
+
+    @classmethod
+    def from_columns(cls, columns):
+        table = cls(capacity=max(len(columns["length"]), 1))
+        return table.append_columns(**columns)
+
+    @classmethod
+    def from_rows(cls, rows):
+        # legacy data rows: bases "X"/"Z", bits None until measured
+        columns = {}
+        for idx, name in enumerate(COLUMNS):
+            values = np.fromiter(
+                map(itemgetter(idx), rows), dtype=object, count=len(rows)
+            )
+            if name in BASIS_COLUMNS:
+                values = values == BASES[1]
+            elif name in BIT_COLUMNS:
+                values = np.where(values == None, NOT_MEASURED, values)
+            columns[name] = values.astype(COLUMNS[name])
+        return cls.from_columns(columns)
+
+    def to_rows(self):
+        columns = []
+        for name, column in self.columns().items():
+            values = column.tolist()
+            if name in BASIS_COLUMNS:
+                values = [BASES[value] for value in values]
+            elif name in BIT_COLUMNS:
+                values = [None if value == NOT_MEASURED else value for value in values]
+            columns.append(values)
+        return [list(row) for row in zip(*columns)]
+
+    def __iter__(self):
+        # legacy rows, for code looping over the runs
+        return iter(self.to_rows())
+
+    def __getitem__(self, index):
+        # a run as a legacy row, or a RunTable of the selected runs
+        if isinstance(index, (int, np.integer)):
+            return self[[index]].to_rows()[0]
+        return RunTable.from_columns(
+            {name: column[index] for name, column in self.columns().items()}
+        )
+
+    def copy(self):
+        return self[:]
+
+    def select(self, lengths):
+        # runs of the given lengths
+        return self[np.isin(self.length, lengths)]
+
+    def masked(self, name):
+        # bit column with the runs not measured yet masked
+        return np.ma.masked_equal(self.columns()[name], NOT_MEASURED)
+
+    def to_pandas(self, decode=True):
+        # DataFrame sharing the memory of the columns (bases as categoricals of
+        # their codes if decode)
+        frame = {}
+        for name, column in self.columns().items():
+            if decode and name in BASIS_COLUMNS:
+                column = pd.Categorical.from_codes(column, BASES)
+            frame[name] = column
+        return pd.DataFrame(frame, copy=False)
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns().values())
+
+    def __eq__(self, other):
+        if not isinstance(other, RunTable):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            np.array_equal(column, other.columns()[name])
+            for name, column in self.columns().items()
+        )
+
+    def __getstate__(self):
+        # only the used part of the columns is pickled
+        return {"columns": self.columns()}
+
+    def __setstate__(self, state):
+        self._columns = {
+            name: np.array(column) for name, column in state["columns"].items()
+        }
+        self._size = len(self._columns["length"])
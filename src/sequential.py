@@ -0,0 +1,217 @@
+from simulation import generate_circuits, run_simulation, SimulationResources
+from analysis import update_data, data_tables
+from accumulator import RunAccumulator
+from run_table import RunTable
+from storage import write_data, write_counts
+from scipy.stats import norm
+import pandas as pd
+import numpy as np
+import pickle
+
+# Sequential mode: runs are generated and executed in rounds, and a length stops
+# getting runs as soon as its QUBER and CHSH confidence intervals are narrower
+# than the targets (or its runs reach max_runs). Short chains settle after a few
+# rounds, the budget goes to the long ones.
+
+
+def wilson_half_width(successes, trials, z):
+    # half width of the Wilson score interval of a proportion (not 0 when no
+    # errors are observed, infinite without trials)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = successes / trials
+        half = (
+            z
+            / (1 + z**2 / trials)
+            * np.sqrt(p * (1 - p) / trials + z**2 / (4 * trials**2))
+        )
+    return np.where(trials > 0, half, np.inf)
+
+
+def interval_widths(tables, confidence=0.95):
+    # widths of the confidence intervals of QUBER and CHSH of each length used by
+    # the stopping rule: Wilson interval of the mismatched fraction for QUBER,
+    # Wilson intervals of the equal-bit fraction of each pair of bases (on the runs
+    # of that pair) combined in quadrature for CHSH = |E_XX - E_XZ| + |E_ZX + E_ZZ|
+    # with E = 2 p_equal - 1 (the _error columns of the results are unchanged)
+    tables = tables.astype(np.float64)
+    z = norm.ppf((1 + confidence) / 2)
+    pair_runs = tables.sum(axis=(3, 4))
+    pair_equal = tables[..., 0, 0] + tables[..., 1, 1]
+
+    same_basis = pair_runs[:, 0, 0] + pair_runs[:, 1, 1]
+    mismatched = same_basis - pair_equal[:, 0, 0] - pair_equal[:, 1, 1]
+    qber_width = 2 * wilson_half_width(mismatched, same_basis, z)
+
+    correlator_half = 2 * wilson_half_width(pair_equal, pair_runs, z)
+    chsh_width = 2 * np.sqrt((correlator_half**2).sum(axis=(1, 2)))
+    return qber_width, chsh_width
+
+
+def simulate_round(
+    lengths,
+    runs,
+    master_chain,
+    protocol,
+    rng,
+    seed,
+    first_circuit,
+    templates=False,
+    native=False,
+    packing=False,
+    **simulation_options,
+):
+    # runs of the given lengths generated and simulated at once: data with the
+    # measured bits and the counts (seeds follow those of the previous rounds)
+    data, circuits = generate_circuits(
+        lengths=lengths,
+        runs=runs,
+        master_chain=master_chain,
+        protocol=protocol,
+        QPU=simulation_options.get("QPU", "ibm_sherbrooke"),
+        templates=templates,
+        native=native,
+        packing=packing,
+        rng=rng,
+    )
+    counts = run_simulation(
+        circuits=circuits,
+        master_chain=master_chain,
+        seed=None if seed is None else seed + first_circuit,
+        **simulation_options,
+    )
+    return update_data(data, counts), counts
+
+
+def add_round(data, counts, round_data, round_counts):
+    # counts entries of the round follow those of the previous rounds
+    round_data.circuit_idx[:] += len(counts)
+    data.extend(round_data)
+    counts.extend(round_counts)
+
+
+def write_rounds(data, counts, device=False, storage="pickle"):
+    # data and counts of all rounds, as written by a single run_simulation
+    results_name = "results_device" if device else "results_local"
+    if storage == "columnar":
+        write_data("data/data_columns", data)
+        write_counts(f"data/{results_name}_columns", counts)
+    else:
+        with open("data/data.pkl", "wb") as file:
+            pickle.dump(data, file)
+        with open(f"data/{results_name}.pkl", "wb") as file:
+            pickle.dump(counts, file)
+
+
+def run_sequential(
+    lengths,
+    master_chain,
+    protocol,
+    round_runs=100,
+    max_runs=2000,
+    qber_width=0.05,
+    chsh_width=0.2,
+    confidence=0.95,
+    baseline_runs=None,
+    seed=None,
+    rng=None,
+    templates=False,
+    native=False,
+    packing=False,
+    **simulation_options,
+):
+    # simulation_options: passed to run_simulation (device, QPU, method, ...).
+    # Simulators, noise models and worker pools are built in the first round and
+    # reused by the next ones. Writes the data and counts of all rounds as
+    # run_simulation would, returns the report of the runs spent per length.
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    accumulator = RunAccumulator()
+    data = RunTable()
+    counts = []
+    spent = {length: 0 for length in lengths}
+    stopped = {}
+    active = list(lengths)
+    round_idx = 0
+
+    resources = SimulationResources()
+    try:
+        while active:
+            round_idx += 1
+            # active lengths have all run the same number of runs so far
+            runs = min(round_runs, max_runs - spent[active[0]])
+            round_data, round_counts = simulate_round(
+                active,
+                runs,
+                master_chain,
+                protocol,
+                rng,
+                seed,
+                len(counts),
+                templates=templates,
+                native=native,
+                packing=packing,
+                resources=resources,
+                **simulation_options,
+            )
+            accumulator.add_tables(*data_tables(round_data))
+            add_round(data, counts, round_data, round_counts)
+            for length in active:
+                spent[length] += runs
+
+            # stop the lengths whose intervals are narrow enough, or at the cap
+            all_lengths, tables = accumulator.lengths_tables()
+            qber_widths, chsh_widths = interval_widths(tables, confidence)
+            widths = dict(zip(all_lengths.tolist(), zip(qber_widths, chsh_widths)))
+            for length in active:
+                qber, chsh = widths[length]
+                if qber <= qber_width and chsh <= chsh_width:
+                    stopped[length] = "target"
+                elif spent[length] >= max_runs:
+                    stopped[length] = "cap"
+            active = [length for length in active if length not in stopped]
+            print(
+                f"Round {round_idx}: {runs} runs for {len(round_counts)} circuits, {len(active)} lengths still running."
+            )
+    finally:
+        resources.close()
+
+    write_rounds(
+        data,
+        counts,
+        simulation_options.get("device", False),
+        simulation_options.get("storage", "pickle"),
+    )
+
+    report = sequential_report(
+        lengths, spent, stopped, widths, accumulator, baseline_runs, len(counts)
+    )
+    with open("data/sequential_report.pkl", "wb") as file:
+        pickle.dump(report, file)
+    return report
+
+
+def sequential_report(
+    lengths, spent, stopped, widths, accumulator, baseline_runs, num_circuits
+):
+    result_df = accumulator.process().set_index("length")
+    report = pd.DataFrame(
+        {
+            "length": lengths,
+            "runs": [spent[length] for length in lengths],
+            "stop": [stopped[length] for length in lengths],
+            "QUBER": [result_df.loc[length, "QUBER"] for length in lengths],
+            "QUBER_width": [widths[length][0] for length in lengths],
+            "CHSH": [result_df.loc[length, "CHSH"] for length in lengths],
+            "CHSH_width": [widths[length][1] for length in lengths],
+        }
+    )
+    total = int(report["runs"].sum())
+    print(report.to_string(index=False))
+    if baseline_runs is not None:
+        baseline = baseline_runs * len(lengths)
+        print(
+            f"Sequential mode: {total} runs in {num_circuits} circuits, against {baseline} runs with runs: {baseline_runs} for every length ({100 * total / baseline:.1f}%)."
+        )
+    else:
+        print(f"Sequential mode: {total} runs in {num_circuits} circuits.")
+    return report
@@ -1,25 +1,315 @@
 from qiskit import (
+    ClassicalRegister,
     QuantumCircuit,
     QuantumRegister,
     transpile,
 )
+from qiskit.circuit import Barrier, CircuitInstruction, Measure
 from qiskit.transpiler import Layout
+from qiskit.quantum_info import Chi, pauli_basis
 from qiskit_aer import AerSimulator
-from qiskit_aer.noise import NoiseModel
-from qiskit_ibm_runtime import Sampler
-from qiskit_ibm_runtime.fake_provider import FakeSherbrooke
+from qiskit_aer.noise import NoiseModel, pauli_error
+from qiskit_ibm_runtime import Batch, Sampler, Session
 from qiskit_ibm_runtime import QiskitRuntimeService
 from qiskit.visualization import circuit_drawer
 import matplotlib.pyplot as plt
-from math import ceil
-import random
+from analysis import update_data, process_data_pandas
+from transpile_cache import TranspileCache
+from native_circuits import NativeCircuit, is_native
+from checkpoint import pending_ranges, flatten_counts
+from storage import data_writer, data_columns, CountsWriter, write_counts
+from run_table import RunTable, BASES, NOT_MEASURED
+from pack_chains import fake_backend
+from device_jobs import DeviceJobManager
+from local_runtime import (
+    LocalRuntimeService,
+    LocalSampler,
+    LocalBatch,
+    LocalSession,
+)
+from noise_cache import NoiseModelStore, chain_couplers, reduce_noise_model
+from copy import deepcopy
+from functools import lru_cache, partial
+from math import ceil, isclose, pi
+import numpy as np
 from dotenv import load_dotenv
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 import pickle
 import gc
+import time
+
+
+def append_run(qc, protocol, current_qb, length, alice_basis, bob_basis, alice_bit):
+    # append the gates of a single protocol run starting at current_qb and
+    # return the qubit measured by Bob
+
+    if protocol == "BB84":
+
+        if alice_bit == 1:
+            qc.x(current_qb)  # Prepare |1⟩ in Z basis
+        if alice_basis == "X":
+            qc.h(current_qb)  # Prepare |+⟩ or |-⟩
+
+        for qb in range(current_qb, current_qb + length):
+            qc.swap(qb, qb + 1)
+        current_qb = current_qb + length
+
+        if bob_basis == "X":
+            qc.h(current_qb)  # Apply H-gate if Bob is measuring in the X basis
+
+    elif protocol == "BBM92":
+
+        # prepare entangled state
+        qc.h(current_qb)
+        qc.cx(current_qb, current_qb + 1)
+
+        # Alice measurement basis choice
+        if alice_basis == "X":
+            qc.h(current_qb)
+
+        # transport entangled state
+        for qb in range(current_qb + 1, current_qb + length):
+            qc.swap(qb, qb + 1)
+
+        current_qb = current_qb + length
+
+        # Bob measurement basis choice
+        if bob_basis == "X":
+            qc.h(current_qb)
+
+    elif protocol == "Id-BB84":
+
+        if alice_bit == 1:
+            qc.x(current_qb)  # Prepare |1⟩ in Z basis
+        if alice_basis == "X":
+            qc.h(current_qb)  # Prepare |+⟩ or |-⟩
 
+        # vary depth
+        for _ in range(length):
+            qc.id(current_qb)
+
+        if bob_basis == "X":
+            qc.h(current_qb)  # Apply H-gate if Bob is measuring in the X basis
+
+    else:
+        raise Exception("Protocol unknown.")
+
+    return current_qb
+
+
+def run_configurations(protocol):
+    # distinct (alice_basis, bob_basis, alice_bit) choices of a protocol run
+    if protocol in ("BB84", "Id-BB84"):
+        alice_bits = [0, 1]
+    elif protocol == "BBM92":
+        # Alice bit is measured, not chosen
+        alice_bits = [None]
+    else:
+        raise Exception("Protocol unknown.")
+    return [
+        (alice_basis, bob_basis, alice_bit)
+        for alice_basis in BASES
+        for bob_basis in BASES
+        for alice_bit in alice_bits
+    ]
+
+
+def native_target(QPU):
+    # fake backend of QPU: native gates, coupling map and noise of the device
+    return fake_backend(QPU)
+
+
+def empty_circuit(qr, layout, native_backend=None, metadata=None):
+    # virtual circuit on qr, or native circuit with virtual qubit i on layout[i]
+    if native_backend is None:
+        return QuantumCircuit(qr, metadata=metadata)
+    return NativeCircuit(native_backend, layout, metadata=metadata)
+
+
+@lru_cache
+def run_gadget(protocol, length, alice_basis, bob_basis, alice_bit):
+    # gates of a single run starting at qubit 0, as (operation, qubits) pairs,
+    # and the qubit measured by Bob
+    width = 1 if protocol == "Id-BB84" else length + 1
+    qc = QuantumCircuit(width)
+    measured_qb = append_run(qc, protocol, 0, length, alice_basis, bob_basis, alice_bit)
+    gadget = tuple(
+        (
+            instruction.operation,
+            tuple(qc.find_bit(qb).index for qb in instruction.qubits),
+        )
+        for instruction in qc.data
+    )
+    return gadget, measured_qb
 
-def generate_circuits(lengths, runs, master_chain, protocol, QPU="ibm_sherbrooke"):
+
+def compose_gadget(qc, gadget, offset):
+    # append a run gadget to qc shifting its qubits by offset
+    if is_native(qc):
+        qc.compose_gadget(gadget, offset)
+        return
+    qubits = qc.qubits
+    for operation, gadget_qubits in gadget:
+        qc._append(
+            CircuitInstruction(
+                operation, tuple(qubits[offset + qb] for qb in gadget_qubits)
+            )
+        )
+
+
+def measurement_instructions(qr, creg):
+    # barrier and measurements appended by measure_all, built once per register
+    return [CircuitInstruction(Barrier(qr.size), tuple(qr))] + [
+        CircuitInstruction(Measure(), (qb,), (cb,)) for qb, cb in zip(qr, creg)
+    ]
+
+
+def draw_choices(rng, runs, protocol):
+    # alice basis, bob basis and alice bit (None for BBM92) of every run,
+    # as indices in BASES / bit values, drawn in a single call
+    choices = rng.integers(0, 2, size=(runs, 3), dtype=np.int8)
+    if protocol not in ("BB84", "BBM92", "Id-BB84"):
+        raise Exception("Protocol unknown.")
+    return choices
+
+
+def iter_template_circuits(
+    lengths,
+    runs,
+    master_chain,
+    protocol,
+    QPU="ibm_sherbrooke",
+    native=False,
+    rng=None,
+):
+    # one circuit per (length, configuration): the number of runs drawn for each
+    # configuration is stored in circuit.metadata["shots"] and every shot is a run.
+    # Runs always start from the first qubit of the chain.
+    # Yields the runs of each circuit (a RunTable) together with the circuit.
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    max_circuit_len = len(master_chain)
+    if protocol != "Id-BB84":
+        assert all(
+            l <= max_circuit_len - 1 for l in lengths
+        ), f"max len must be at most {max_circuit_len-1}"
+        qr = QuantumRegister(len(master_chain))
+        layout = master_chain
+    else:
+        # use all device
+        num_qubits = native_target(QPU).num_qubits
+        qr = QuantumRegister(num_qubits)
+        layout = list(range(num_qubits))
+    native_backend = native_target(QPU) if native else None
+
+    configurations = run_configurations(protocol)
+
+    # (length, alice_basis, bob_basis, alice_bit, bob_bit, virtual_qubit_measured, classic_bit , shot_index)
+    shot_idx = 0
+
+    for length in lengths:
+        # simulate choices: only the number of runs of each configuration matters
+        class_counts = rng.multinomial(
+            runs, [1 / len(configurations)] * len(configurations)
+        )
+
+        for shots, (alice_basis, bob_basis, alice_bit) in zip(
+            class_counts.tolist(), configurations
+        ):
+            if shots == 0:
+                continue
+
+            qc = empty_circuit(qr, layout, native_backend, metadata={"shots": shots})
+            gadget, measured_qb = run_gadget(
+                protocol, length, alice_basis, bob_basis, alice_bit
+            )
+            compose_gadget(qc, gadget, 0)
+            qc.measure_all()
+
+            rows = RunTable(capacity=shots).append_columns(
+                length=length,
+                alice_basis=BASES.index(alice_basis),
+                bob_basis=BASES.index(bob_basis),
+                alice_bit=NOT_MEASURED if alice_bit is None else alice_bit,
+                virtual_qb=measured_qb,
+                cl_bit=0,
+                circuit_idx=np.arange(shot_idx, shot_idx + shots),
+            )
+            shot_idx += shots
+
+            yield rows, qc
+
+
+def circuit_schedule(lengths, runs, capacity, run_width, packing=False):
+    # runs of each circuit as a list of (length, number of runs), in chain order.
+    # Without packing every circuit holds runs of a single length; with packing
+    # each circuit is filled greedily with the widest runs that still fit, so that
+    # the tail left by long runs is used by shorter ones.
+    if not packing:
+        schedule = []
+        for length in lengths:
+            runs_per_circuit = capacity // run_width(length)
+            for start in range(0, runs, runs_per_circuit):
+                schedule.append([(length, min(runs_per_circuit, runs - start))])
+        return schedule
+
+    remaining = {}
+    for length in lengths:
+        remaining[length] = remaining.get(length, 0) + runs
+    by_width = sorted(remaining, key=run_width, reverse=True)
+    schedule = []
+    while by_width:
+        free = capacity
+        circuit = []
+        for length in by_width:
+            count = min(remaining[length], free // run_width(length))
+            if count:
+                circuit.append((length, count))
+                remaining[length] -= count
+                free -= count * run_width(length)
+        by_width = [length for length in by_width if remaining[length]]
+        schedule.append(circuit)
+    return schedule
+
+
+def packing_report(schedule, capacity, run_width, baseline):
+    # qubits used by runs over qubits available in the circuits of schedule,
+    # compared with the schedule baseline
+    used = sum(
+        count * run_width(length) for circuit in schedule for length, count in circuit
+    )
+    print(
+        f"Packing: {len(schedule)} circuits instead of {len(baseline)} ({len(baseline) - len(schedule)} saved), "
+        f"efficiency {100*used/(len(schedule)*capacity):.2f}% (one length per circuit: {100*used/(len(baseline)*capacity):.2f}%)."
+    )
+
+
+def iter_circuits(
+    lengths,
+    runs,
+    master_chain,
+    protocol,
+    QPU="ibm_sherbrooke",
+    templates=False,
+    native=False,
+    packing=False,
+    rng=None,
+):
+    # lazily build the circuits: yields the runs of each circuit (a RunTable)
+    # together with the circuit, so that only the current circuit is kept in memory.
+    # With packing, runs of different lengths share the same circuit.
+
+    if templates:
+        yield from iter_template_circuits(
+            lengths, runs, master_chain, protocol, QPU=QPU, native=native, rng=rng
+        )
+        return
+
+    if rng is None:
+        rng = np.random.default_rng()
 
     max_circuit_len = len(master_chain)
     if protocol != "Id-BB84":
@@ -28,184 +318,906 @@ def generate_circuits(lengths, runs, master_chain, protocol, QPU="ibm_sherbrooke
         ), f"max len must be at most {max_circuit_len-1}"
 
     # (length, alice_basis, bob_basis, alice_bit, bob_bit, virtual_qubit_measured, classic_bit , circuit_index)
-    data = []
-    circuits = []
 
-    qr = QuantumRegister(len(master_chain))
     if protocol == "Id-BB84":
-        if QPU == "ibm_sherbrooke":
-            # use all device
-            qr_idBB84 = QuantumRegister(127)
-        else:
-            raise Exception("QPU unknown.")
-    circuit_idx = 0
+        # use all device
+        num_qubits = native_target(QPU).num_qubits
+        qr = QuantumRegister(num_qubits)
+        layout = list(range(num_qubits))
+    else:
+        qr = QuantumRegister(len(master_chain))
+        layout = master_chain
+    native_backend = native_target(QPU) if native else None
+    # empty circuit with the classical register of measure_all, copied for each circuit
+    creg = ClassicalRegister(qr.size, "meas")
+    empty = QuantumCircuit(qr, creg)
+    measurements = measurement_instructions(qr, creg)
+
+    if protocol == "Id-BB84":
+        # one run per qubit, measured on the qubit itself
+        run_width = lambda length: 1
+        measured_offset = lambda length: 0
+    else:
+        # runs of length + 1 qubits, measured on the last one
+        run_width = lambda length: length + 1
+        measured_offset = lambda length: length
 
+    schedule = circuit_schedule(lengths, runs, qr.size, run_width, packing)
+    if packing:
+        packing_report(
+            schedule,
+            qr.size,
+            run_width,
+            circuit_schedule(lengths, runs, qr.size, run_width),
+        )
+
+    # simulate choices: remember total choices, consumed in order for each length
+    choices = {}
     for length in lengths:
-        # cr = ClassicalRegister(len(master_chain) // length)
-        if protocol == "Id-BB84":
-            qc = QuantumCircuit(qr_idBB84)
+        drawn = draw_choices(rng, runs, protocol)
+        choices[length] = (
+            np.concatenate([choices[length], drawn]) if length in choices else drawn
+        )
+    next_run = {length: 0 for length in choices}
+    placed_gadgets = {}
+
+    for circuit_idx, circuit_runs in enumerate(schedule):
+        if native_backend is None:
+            qc = empty.copy_empty_like()
         else:
-            qc = QuantumCircuit(qr)
-        current_qb = 0
-        cl_bit = 0
+            qc = empty_circuit(qr, layout, native_backend)
+        rows = RunTable(capacity=sum(count for _, count in circuit_runs))
+        first_qb = 0
+        for length, count in circuit_runs:
+            start = next_run[length]
+            next_run[length] += count
+            segment = choices[length][start : start + count]
+            # runs of the segment, placed one after the other from first_qb
+            rows.append_columns(
+                length=length,
+                alice_basis=segment[:, 0],
+                bob_basis=segment[:, 1],
+                alice_bit=NOT_MEASURED if protocol == "BBM92" else segment[:, 2],
+                virtual_qb=first_qb
+                + run_width(length) * np.arange(count)
+                + measured_offset(length),
+                cl_bit=np.arange(len(rows), len(rows) + count),
+                circuit_idx=circuit_idx,
+            )
+            circuit_choices = segment.tolist()
 
-        for r in range(runs):
-            # simulate choices: remember total choices
-            alice_basis = random.choice(["X", "Z"])
-            bob_basis = random.choice(["X", "Z"])
+            # compose the (cached) gadget of each run in its circuit
+            for alice_basis, bob_basis, alice_bit in circuit_choices:
+                if protocol == "BBM92":
+                    alice_bit = None
+                if native_backend is not None:
+                    gadget, _ = run_gadget(
+                        protocol,
+                        length,
+                        BASES[alice_basis],
+                        BASES[bob_basis],
+                        alice_bit,
+                    )
+                    compose_gadget(qc, gadget, first_qb)
+                else:
+                    key = (length, alice_basis, bob_basis, alice_bit, first_qb)
+                    if key not in placed_gadgets:
+                        # gadget instructions on the qubits of this position
+                        gadget, _ = run_gadget(
+                            protocol,
+                            length,
+                            BASES[alice_basis],
+                            BASES[bob_basis],
+                            alice_bit,
+                        )
+                        placed_gadgets[key] = [
+                            CircuitInstruction(
+                                operation,
+                                tuple(qr[first_qb + qb] for qb in gadget_qubits),
+                            )
+                            for operation, gadget_qubits in gadget
+                        ]
+                    for instruction in placed_gadgets[key]:
+                        qc._append(instruction)
+                first_qb += run_width(length)
 
-            if protocol == "BB84":
+        if native_backend is None:
+            for instruction in measurements:
+                qc._append(instruction)
+        else:
+            qc.measure_all()
 
-                alice_bit = random.choice([0, 1])
+        yield rows, qc
 
-                if alice_bit == 1:
-                    qc.x(current_qb)  # Prepare |1⟩ in Z basis
-                if alice_basis == "X":
-                    qc.h(current_qb)  # Prepare |+⟩ or |-⟩
 
-                for qb in range(current_qb, current_qb + length):
-                    qc.swap(qb, qb + 1)
-                current_qb = current_qb + length
+def generate_circuits(
+    lengths,
+    runs,
+    master_chain,
+    protocol,
+    QPU="ibm_sherbrooke",
+    templates=False,
+    native=False,
+    packing=False,
+    rng=None,
+):
 
-                if bob_basis == "X":
-                    qc.h(current_qb)  # Apply H-gate if Bob is measuring in the X basis
+    data = RunTable()
+    circuits = []
+    for rows, qc in iter_circuits(
+        lengths,
+        runs,
+        master_chain,
+        protocol,
+        QPU=QPU,
+        templates=templates,
+        native=native,
+        packing=packing,
+        rng=rng,
+    ):
+        data.extend(rows)
+        circuits.append(qc)
 
-                data.append(
-                    [
-                        length,
-                        alice_basis,
-                        bob_basis,
-                        alice_bit,
-                        None,
-                        current_qb,
-                        cl_bit,
-                        circuit_idx,
-                    ]
-                )
+    if templates:
+        print(
+            f"Template generation successful: {len(circuits)} circuits for {len(data)} runs."
+        )
+    else:
+        assert len(circuits) == data.circuit_idx[-1] + 1
+        print("Circuit generation successful.")
 
-            elif protocol == "BBM92":
+    return data, circuits
 
-                # prepare entangled state
-                qc.h(current_qb)
-                qc.cx(current_qb, current_qb + 1)
 
-                # Alice measurement basis choice
-                if alice_basis == "X":
-                    qc.h(current_qb)
+def circuit_generator(circuits, backend, custom_layout, cache=None):
+    for circ in circuits:
+        if is_native(circ):
+            # already on physical qubits and in the native basis
+            yield circ
+        elif cache is not None:
+            yield cache.transpile(
+                circ,
+                backend=backend,
+                initial_layout=custom_layout,
+                optimization_level=0,
+            )
+        else:
+            yield transpile(
+                circ,
+                backend=backend,
+                initial_layout=custom_layout,
+                optimization_level=0,
+            )
 
-                # transport entangled state
-                for qb in range(current_qb + 1, current_qb + length):
-                    qc.swap(qb, qb + 1)
 
-                current_qb = current_qb + length
+def batch_generator(iterable, batch_size):
+    # group consecutive items in lists of (at most) batch_size elements
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-                # Bob measurement basis choice
-                if bob_basis == "X":
-                    qc.h(current_qb)
 
-                data.append(
-                    [
-                        length,
-                        alice_basis,
-                        bob_basis,
-                        None,
-                        None,
-                        current_qb,
-                        cl_bit,
-                        circuit_idx,
-                    ]
+def run_batch(simulator, batch, **run_options):
+    # run a batch of circuits and return, for each circuit, the list of its
+    # single-shot counts dicts (one per run). Template circuits
+    # (circuit.metadata["shots"] > 1) are expanded shot by shot, circuits with the
+    # same number of shots are submitted in the same job.
+    circuit_counts = []
+    start = 0
+    while start < len(batch):
+        shots = batch[start].metadata.get("shots", 1)
+        stop = start
+        while stop < len(batch) and batch[stop].metadata.get("shots", 1) == shots:
+            stop += 1
+        result = simulator.run(
+            batch[start:stop], shots=shots, memory=shots > 1, **run_options
+        ).result()
+        for i in range(stop - start):
+            if shots == 1:
+                circuit_counts.append([result.get_counts(i)])
+            else:
+                circuit_counts.append(
+                    [{bitstring: 1} for bitstring in result.get_memory(i)]
                 )
+        start = stop
+    return circuit_counts
 
-            elif protocol == "Id-BB84":
 
-                alice_bit = random.choice([0, 1])
+def get_custom_layout(circuit, master_chain):
+    if circuit.num_qubits == len(master_chain):
+        return Layout.from_intlist(master_chain, circuit.qregs[0])
+    # Id-BB84
+    return None
 
-                if alice_bit == 1:
-                    qc.x(current_qb)  # Prepare |1⟩ in Z basis
-                if alice_basis == "X":
-                    qc.h(current_qb)  # Prepare |+⟩ or |-⟩
 
-                # vary depth
-                for _ in range(length):
-                    qc.id(current_qb)
+# gates that map Pauli operators to Pauli operators (rz/p only at multiples of pi/2)
+CLIFFORD_GATES = {
+    "id",
+    "x",
+    "y",
+    "z",
+    "h",
+    "s",
+    "sdg",
+    "sx",
+    "sxdg",
+    "cx",
+    "cy",
+    "cz",
+    "ecr",
+    "swap",
+}
+NON_UNITARY_OPERATIONS = {"measure", "barrier", "reset", "delay"}
 
-                if bob_basis == "X":
-                    qc.h(current_qb)  # Apply H-gate if Bob is measuring in the X basis
 
-                data.append(
-                    [
-                        length,
-                        alice_basis,
-                        bob_basis,
-                        alice_bit,
-                        None,
-                        current_qb,
-                        cl_bit,
-                        circuit_idx,
-                    ]
+def is_clifford_circuit(circuit):
+    for instruction in circuit.data:
+        operation = instruction.operation
+        if operation.name in CLIFFORD_GATES or operation.name in NON_UNITARY_OPERATIONS:
+            continue
+        if operation.name in ("rz", "p"):
+            angle = float(operation.params[0]) / (pi / 2)
+            if isclose(angle, round(angle), abs_tol=1e-9):
+                continue
+        return False
+    return True
+
+
+def non_pauli_weight(error):
+    # weight of the off-diagonal chi matrix of the channel (over its trace): what
+    # the Pauli twirl of the stabilizer method drops (amplitude damping, coherent
+    # errors); 0 for Pauli channels
+    chi = Chi(error.to_quantumchannel()).data
+    off_diagonal = np.abs(chi).sum() - np.abs(np.diag(chi)).sum()
+    return off_diagonal / np.real(np.trace(chi))
+
+
+@lru_cache(maxsize=None)
+def noise_non_pauli_weight(QPU, qubits=None, couplers=None):
+    # largest non-Pauli weight of the gate errors of the backend noise model
+    # (restricted to qubits and couplers if given), reset errors excluded: the
+    # protocol circuits never reset
+    noise_model = NoiseModel.from_backend(fake_backend(QPU))
+    if qubits is not None:
+        noise_model = reduce_noise_model(
+            noise_model, list(qubits), None if couplers is None else set(couplers)
+        )
+    weights = [
+        non_pauli_weight(error)
+        for instruction, qubit_errors in noise_model._local_quantum_errors.items()
+        if instruction not in ("reset", "delay")
+        for error in qubit_errors.values()
+    ] + [
+        non_pauli_weight(error)
+        for instruction, error in noise_model._default_quantum_errors.items()
+        if instruction not in ("reset", "delay")
+    ]
+    return max(weights, default=0.0)
+
+
+def select_method(
+    circuits,
+    method="automatic",
+    fallback_method="matrix_product_state",
+    master_chain=None,
+    QPU="ibm_sherbrooke",
+    pauli_tolerance=0.0,
+):
+    # stabilizer if every circuit is Clifford and the noise of the chain is close
+    # enough to a Pauli channel (non-Pauli weight up to pauli_tolerance) for its
+    # Pauli twirl to be used, fallback_method otherwise
+    if method != "automatic":
+        return method
+    if not all(is_clifford_circuit(circ) for circ in circuits):
+        return fallback_method
+    qubits, couplers = (
+        noise_qubits(master_chain, circuits[0])
+        if master_chain is not None
+        else (None, None)
+    )
+    weight = noise_non_pauli_weight(
+        QPU,
+        None if qubits is None else tuple(qubits),
+        None if couplers is None else tuple(sorted(couplers)),
+    )
+    if weight > pauli_tolerance:
+        print(
+            f"Non-Pauli noise weight {weight:.4f} above pauli_tolerance {pauli_tolerance}: {fallback_method} instead of stabilizer."
+        )
+        return fallback_method
+    return "stabilizer"
+
+
+def pauli_approximate_error(error):
+    # Pauli twirl of the channel: keep the diagonal of its chi matrix
+    chi = np.real(np.diag(Chi(error.to_quantumchannel()).data))
+    probabilities = np.clip(chi, 0, None) / np.sum(np.clip(chi, 0, None))
+    labels = pauli_basis(error.num_qubits).to_labels()
+    return pauli_error(
+        [(label, prob) for label, prob in zip(labels, probabilities) if prob > 0]
+    )
+
+
+def pauli_approximate_noise_model(noise_model):
+    # same noise model with every (thermal relaxation + depolarizing) error replaced
+    # by its Pauli-twirled version, so that it can be run with the stabilizer method
+    pauli_model = NoiseModel(basis_gates=noise_model.basis_gates)
+    for instruction, qubit_errors in noise_model._local_quantum_errors.items():
+        for qubits, error in qubit_errors.items():
+            pauli_model.add_quantum_error(
+                pauli_approximate_error(error), instruction, qubits
+            )
+    for instruction, error in noise_model._default_quantum_errors.items():
+        pauli_model.add_all_qubit_quantum_error(
+            pauli_approximate_error(error), instruction
+        )
+    for qubits, error in noise_model._local_readout_errors.items():
+        pauli_model.add_readout_error(error, qubits)
+    if noise_model._default_readout_error is not None:
+        pauli_model.add_all_qubit_readout_error(noise_model._default_readout_error)
+    return pauli_model
+
+
+def build_noise_model(backend, method, store=None, qubits=None, couplers=None):
+    # noise model of backend (Pauli-twirled for the stabilizer method), reduced to
+    # qubits and couplers if given. With a store it is built only once per
+    # backend calibration and loaded from disk afterwards.
+    pauli = method == "stabilizer"
+    if store is not None:
+        noise_model = store.get(backend, pauli, qubits, couplers)
+        if noise_model is not None:
+            return noise_model
+    noise_model = NoiseModel.from_backend(backend)
+    if qubits is not None:
+        noise_model = reduce_noise_model(noise_model, qubits, couplers)
+    if pauli:
+        noise_model = pauli_approximate_noise_model(noise_model)
+    if store is not None:
+        store.put(noise_model, backend, pauli, qubits, couplers)
+    return noise_model
+
+
+def noise_qubits(master_chain, circuit):
+    # qubits and couplers used by the circuits laid out on master_chain
+    # (None: circuits on the whole device, as Id-BB84)
+    if get_custom_layout(circuit, master_chain) is None:
+        return None, None
+    return list(master_chain), chain_couplers(master_chain)
+
+
+def build_simulator(
+    backend, method, noise_store=None, qubits=None, couplers=None, **options
+):
+    # method = 'automatic', 'statevector', 'density_matrix', 'stabilizer', 'matrix_product_state', 'extended_stabilizer', 'unitary', 'superop', 'tensor_network'
+    # note: 'density_matrix' is only viable for circuits on few qubits
+    noise_model = build_noise_model(backend, method, noise_store, qubits, couplers)
+    return AerSimulator(method=method, noise_model=noise_model, device="CPU", **options)
+
+
+class SimulationResources:
+    # simulators, noise models and worker pools kept across the run_simulation
+    # calls of the sequential and adaptive modes (one per round), so that noise
+    # models are built and workers started once. close() shuts the pools down.
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key, build):
+        if key not in self.items:
+            self.items[key] = build()
+        return self.items[key]
+
+    def close(self):
+        for item in self.items.values():
+            if isinstance(item, ProcessPoolExecutor):
+                item.shutdown()
+        self.items = {}
+
+
+# simulator state of a shard worker, built once per process by _init_shard_worker
+_shard_worker = {}
+
+
+def _init_shard_worker(
+    master_chain,
+    max_parallel_threads,
+    method,
+    cache_size_mb,
+    QPU="ibm_sherbrooke",
+    noise_cache=False,
+    qubits=None,
+    couplers=None,
+):
+    backend = fake_backend(QPU)
+    _shard_worker["backend"] = backend
+    _shard_worker["master_chain"] = master_chain
+    _shard_worker["cache"] = (
+        TranspileCache(max_size_mb=cache_size_mb) if cache_size_mb else None
+    )
+    _shard_worker["simulator"] = build_simulator(
+        backend,
+        method,
+        noise_store=NoiseModelStore() if noise_cache else None,
+        qubits=qubits,
+        couplers=couplers,
+        max_parallel_threads=max_parallel_threads,
+    )
+
+
+def _run_shard(start, circuits, seed, batch_size):
+    backend = _shard_worker["backend"]
+    simulator = _shard_worker["simulator"]
+    cache = _shard_worker["cache"]
+    custom_layout = get_custom_layout(circuits[0], _shard_worker["master_chain"])
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+
+    shard_count = []
+    progress = 0
+    for batch in batch_generator(
+        circuit_generator(circuits, backend, custom_layout, cache), batch_size
+    ):
+        run_options = {}
+        if seed is not None:
+            # one seed per job (seed + index of its first circuit): Aer derives
+            # the seeds of the other circuits of the job from it, so the counts
+            # depend on batch_size and on where shards and batches start
+            run_options["seed_simulator"] = seed + start + progress
+        shard_count.extend(run_batch(simulator, batch, **run_options))
+        progress += len(batch)
+        del batch
+
+    cache_stats = None
+    if cache is not None:
+        cache_stats = (cache.hits - hits, cache.misses - misses)
+
+    return start, shard_count, cache_stats
+
+
+def run_sharded_simulation(
+    circuits,
+    master_chain,
+    workers,
+    shard_size,
+    seed=None,
+    batch_size=1,
+    max_parallel_threads=1,
+    method="matrix_product_state",
+    transpile_cache_size_mb=None,
+    checkpoint=None,
+    QPU="ibm_sherbrooke",
+    noise_cache=False,
+    reduced_noise=False,
+    accumulator=None,
+    resources=None,
+):
+    num_circuits = len(circuits)
+    # circuit index -> counts, prefilled with the circuits completed before a restart
+    completed = checkpoint.completed if checkpoint is not None else {}
+    shards = pending_ranges(completed, num_circuits, shard_size)
+    if accumulator is not None:
+        accumulator.add_completed(completed)
+    num_pending = sum(stop - start for start, stop in shards)
+    cache_hits, cache_misses = 0, 0
+    start_time = time.perf_counter()
+
+    initargs = (
+        master_chain,
+        max_parallel_threads,
+        method,
+        transpile_cache_size_mb,
+        QPU,
+        noise_cache,
+        *(noise_qubits(master_chain, circuits[0]) if reduced_noise else ()),
+    )
+
+    def new_executor():
+        return ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_shard_worker, initargs=initargs
+        )
+
+    # with resources the pool (and the simulators of its workers) is reused by
+    # the next calls with the same workers and initargs
+    if resources is not None:
+        executor = resources.get(("pool", workers, repr(initargs)), new_executor)
+    else:
+        executor = new_executor()
+    try:
+        futures = [
+            executor.submit(
+                _run_shard,
+                start,
+                circuits[start:stop],
+                seed,
+                batch_size,
+            )
+            for start, stop in shards
+        ]
+        progress = 0
+        for future in as_completed(futures):
+            start, counts, cache_stats = future.result()
+            if checkpoint is not None:
+                # saved as soon as the shard is done
+                checkpoint.record(start, counts)
+            else:
+                for offset, circuit_counts in enumerate(counts):
+                    completed[start + offset] = circuit_counts
+            if accumulator is not None:
+                accumulator.add_counts(start, counts)
+            if cache_stats is not None:
+                cache_hits += cache_stats[0]
+                cache_misses += cache_stats[1]
+            progress += len(counts)
+            elapsed = time.perf_counter() - start_time
+            print(
+                f"{100*(num_circuits - num_pending + progress)/num_circuits:.2f}% completed: {progress} circuits run over {num_pending} ({progress / elapsed:.2f} circuits/s)."
+            )
+            if accumulator is not None:
+                print(f"Live metrics: {accumulator.report()}.")
+    finally:
+        if resources is None:
+            executor.shutdown()
+
+    # merge shards (and circuits completed before a restart) in circuit_idx order
+    list_count = flatten_counts(completed, num_circuits)
+
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"Simulated {num_pending} circuits in {elapsed:.2f} s ({num_pending / elapsed:.2f} circuits/s, {workers} workers, shard size {shard_size})."
+    )
+    if transpile_cache_size_mb and num_pending:
+        print(
+            f"Transpile cache: {cache_hits} hits, {cache_misses} misses ({100*cache_hits/num_pending:.2f}% hit rate)."
+        )
+
+    return list_count
+
+
+def run_local_simulation(
+    circuits,
+    master_chain,
+    method="matrix_product_state",
+    batch_size=1,
+    max_parallel_experiments=1,
+    max_parallel_threads=0,
+    seed=None,
+    cache=None,
+    checkpoint=None,
+    QPU="ibm_sherbrooke",
+    noise_cache=False,
+    reduced_noise=False,
+    accumulator=None,
+    resources=None,
+):
+    # define simulator (noise model loaded from data/noise_models if noise_cache,
+    # restricted to the master chain if reduced_noise, reused from resources if given)
+    backend = fake_backend(QPU)
+    qubits, couplers = (
+        noise_qubits(master_chain, circuits[0]) if reduced_noise else (None, None)
+    )
+
+    def new_simulator():
+        return build_simulator(
+            backend,
+            method,
+            noise_store=NoiseModelStore() if noise_cache else None,
+            qubits=qubits,
+            couplers=couplers,
+        )
+
+    if resources is not None:
+        simulator = resources.get(
+            ("simulator", QPU, method, repr(qubits), repr(couplers)), new_simulator
+        )
+    else:
+        simulator = new_simulator()
+    custom_layout = get_custom_layout(circuits[0], master_chain)
+
+    num_circuits = len(circuits)
+    # circuit index -> counts, prefilled with the circuits completed before a restart.
+    # With a checkpoint the counts are saved every checkpoint.every circuits, with
+    # an accumulator the live metrics are updated every accumulator.every circuits.
+    chunk_size = num_circuits
+    if accumulator is not None:
+        chunk_size = accumulator.every
+    if checkpoint is not None:
+        completed = checkpoint.completed
+        chunk_size = min(chunk_size, checkpoint.every)
+    else:
+        completed = {}
+    chunks = pending_ranges(completed, num_circuits, chunk_size)
+    if accumulator is not None:
+        accumulator.add_completed(completed)
+    num_pending = sum(stop - first for first, stop in chunks)
+    print_every = ceil(num_pending / 30) if num_pending else 1
+    progress = 0
+    start = time.perf_counter()
+    for first, stop in chunks:
+        chunk_count = []
+        offset = 0
+        # each batch is submitted as a single Aer job: experiments inside the job
+        # are distributed over max_parallel_experiments (0 = all available cores)
+        for batch in batch_generator(
+            circuit_generator(circuits[first:stop], backend, custom_layout, cache),
+            batch_size,
+        ):
+            if (progress - 1) // print_every != (
+                progress + len(batch) - 1
+            ) // print_every:
+                elapsed = time.perf_counter() - start
+                rate = progress / elapsed if elapsed > 0 else 0.0
+                print(
+                    f"{100*progress/num_pending:.2f}% completed: {progress} circuits run over {num_pending} ({rate:.2f} circuits/s)."
                 )
+                # force garbage collection
+                gc.collect()
+            run_options = {
+                "max_parallel_experiments": max_parallel_experiments,
+                "max_parallel_threads": max_parallel_threads,
+            }
+            if seed is not None:
+                # one seed per job (seed + index of its first circuit): reproduced
+                # only with the same batch_size and chunks starting at the same
+                # circuits (Aer derives the seeds of the rest of the job from it)
+                run_options["seed_simulator"] = seed + first + offset
+            # counts are returned in submission order
+            chunk_count.extend(run_batch(simulator, batch, **run_options))
+            progress += len(batch)
+            offset += len(batch)
+            del batch
+
+        if checkpoint is not None:
+            checkpoint.record(first, chunk_count)
+        else:
+            for idx, circuit_counts in enumerate(chunk_count):
+                completed[first + idx] = circuit_counts
+        if accumulator is not None:
+            accumulator.add_counts(first, chunk_count)
+            print(f"Live metrics: {accumulator.report()}.")
+        del chunk_count
 
+    elapsed = time.perf_counter() - start
+    print(
+        f"Simulated {num_pending} circuits in {elapsed:.2f} s ({num_pending / elapsed:.2f} circuits/s, batch size {batch_size}, method {method})."
+    )
+    if cache is not None:
+        cache.report()
+
+    return flatten_counts(completed, num_circuits)
+
+
+def run_streaming_simulation(
+    circuit_stream,
+    master_chain,
+    window=100,
+    method="automatic",
+    fallback_method="matrix_product_state",
+    pauli_tolerance=0.0,
+    batch_size=1,
+    max_parallel_experiments=1,
+    max_parallel_threads=0,
+    seed=None,
+    cache=None,
+    QPU="ibm_sherbrooke",
+    noise_cache=False,
+    reduced_noise=False,
+    data_path="data/data.pkl",
+    results_path="data/results_local.pkl",
+    accumulator=None,
+    storage="pickle",
+):
+    # consume (rows, circuit) pairs from circuit_stream, a window of circuits at a
+    # time: the data rows and the counts of each window are appended to data_path
+    # and results_path as soon as the window is simulated (see load_pickle_stream,
+    # or storage.ColumnStore if storage is "columnar")
+    backend = fake_backend(QPU)
+    noise_store = NoiseModelStore() if noise_cache else None
+    simulators = {}
+
+    progress = 0
+    # counts entries written so far (template circuits have one per shot)
+    num_entries = 0
+    start = time.perf_counter()
+    columnar = storage == "columnar"
+    with data_writer(data_path) if columnar else open(data_path, "wb") as data_file, (
+        CountsWriter(results_path) if columnar else open(results_path, "wb")
+    ) as results_file:
+        for window_items in batch_generator(circuit_stream, window):
+            rows = RunTable.concat([circuit_rows for circuit_rows, _ in window_items])
+            circuits = [qc for _, qc in window_items]
+            del window_items
+            if columnar:
+                data_file.append(data_columns(rows))
             else:
-                raise Exception("Protocol unknown.")
-
-            if protocol != "Id-BB84":
-                # if a new chain would overflow the circuit, reset
-                if current_qb + length + 1 > max_circuit_len - 1:
-                    current_qb = 0
-                    cl_bit = 0
-                    circuit_idx += 1
-                    qc.measure_all()
-                    circuits.append(qc)
-                    qc = QuantumCircuit(qr)
-                else:
-                    current_qb += 1
-                    cl_bit += 1
+                pickle.dump(rows, data_file)
+                data_file.flush()
+
+            window_method = select_method(
+                circuits,
+                method,
+                fallback_method,
+                master_chain,
+                QPU,
+                pauli_tolerance,
+            )
+            if window_method not in simulators:
+                print(f"Simulation method: {window_method}.")
+                qubits, couplers = (
+                    noise_qubits(master_chain, circuits[0])
+                    if reduced_noise
+                    else (None, None)
+                )
+                simulators[window_method] = build_simulator(
+                    backend,
+                    window_method,
+                    noise_store=noise_store,
+                    qubits=qubits,
+                    couplers=couplers,
+                )
+            simulator = simulators[window_method]
+            custom_layout = get_custom_layout(circuits[0], master_chain)
+
+            list_count = []
+            for batch in batch_generator(
+                circuit_generator(circuits, backend, custom_layout, cache), batch_size
+            ):
+                run_options = {
+                    "max_parallel_experiments": max_parallel_experiments,
+                    "max_parallel_threads": max_parallel_threads,
+                }
+                if seed is not None:
+                    # one seed per job, as in run_local_simulation
+                    run_options["seed_simulator"] = seed + progress
+                for circuit_counts in run_batch(simulator, batch, **run_options):
+                    list_count.extend(circuit_counts)
+                progress += len(batch)
+                del batch
+            if columnar:
+                results_file.append_counts(list_count)
             else:
-                current_qb += 1
-                cl_bit += 1
-                if QPU == "ibm_sherbrooke":
-                    if current_qb >= 127:
-                        current_qb = 0
-                        cl_bit = 0
-                        circuit_idx += 1
-                        qc.measure_all()
-                        circuits.append(qc)
-                        qc = QuantumCircuit(qr_idBB84)
-                else:
-                    raise Exception("QPU unknown.")
+                pickle.dump(list_count, results_file)
+                results_file.flush()
+            if accumulator is not None:
+                accumulator.add_window(rows, list_count, num_entries)
+            num_entries += len(list_count)
+            del rows, circuits, list_count
 
-        # if there is still a circuit not written
-        if len(circuits) != data[-1][-1] + 1:
-            circuit_idx += 1
-            qc.measure_all()
-            circuits.append(qc)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{progress} circuits run ({progress / elapsed:.2f} circuits/s, window of {window} circuits)."
+            )
+            if accumulator is not None:
+                print(f"Live metrics: {accumulator.report()}.")
 
-    assert len(circuits) == data[-1][-1] + 1
+    if cache is not None:
+        cache.report()
+    print("100.00% Simulation completed.")
 
-    print("Circuit generation successful.")
+    return 0
 
-    return data, circuits
 
+def load_pickle_stream(path):
+    # concatenate the lists (or RunTables) pickled one after the other in path (a
+    # file written by run_streaming_simulation, or a single pickled list). Chunks written out
+    # of order by DeviceJobManager ({"start": first circuit, "counts": list}) are
+    # sorted by their first circuit.
+    loaded = []
+    chunks = []
+    tables = []
+    with open(path, "rb") as file:
+        while True:
+            try:
+                item = pickle.load(file)
+            except EOFError:
+                break
+            if isinstance(item, dict):
+                chunks.append(item)
+            elif isinstance(item, RunTable):
+                tables.append(item)
+            else:
+                loaded.extend(item)
+    for chunk in sorted(chunks, key=lambda chunk: chunk["start"]):
+        loaded.extend(chunk["counts"])
+    if tables:
+        # data written as RunTables (older files hold lists of rows)
+        return RunTable.concat(tables)
+    return loaded
 
-def circuit_generator(circuits, backend, custom_layout):
-    for circ in circuits:
-        yield transpile(
-            circ,
-            backend=backend,
-            initial_layout=custom_layout,
-            optimization_level=0,
+
+def compare_methods(
+    data, circuits, master_chain, methods, seed=None, **simulation_options
+):
+    # run the same circuits with every method and compare timing and QBER/CHSH
+    timings = {}
+    processed = {}
+    for method in methods:
+        start = time.perf_counter()
+        counts = run_local_simulation(
+            circuits, master_chain, method=method, seed=seed, **simulation_options
+        )
+        timings[method] = time.perf_counter() - start
+        processed[method] = process_data_pandas(update_data(deepcopy(data), counts))
+
+    reference = methods[0]
+    comparison = processed[reference][["length"]].copy()
+    for method in methods:
+        comparison[f"QUBER ({method})"] = processed[method]["QUBER"]
+        comparison[f"CHSH ({method})"] = processed[method]["CHSH"]
+    for method in methods[1:]:
+        comparison[f"QUBER diff ({method})"] = (
+            processed[method]["QUBER"] - processed[reference]["QUBER"]
+        )
+        comparison[f"CHSH diff ({method})"] = (
+            processed[method]["CHSH"] - processed[reference]["CHSH"]
         )
+        # difference in units of the combined statistical error
+        comparison[f"QUBER diff/error ({method})"] = comparison[
+            f"QUBER diff ({method})"
+        ] / np.sqrt(
+            processed[method]["QUBER_error"] ** 2
+            + processed[reference]["QUBER_error"] ** 2
+        )
+        comparison[f"CHSH diff/error ({method})"] = comparison[
+            f"CHSH diff ({method})"
+        ] / np.sqrt(
+            processed[method]["CHSH_error"] ** 2
+            + processed[reference]["CHSH_error"] ** 2
+        )
+
+    for method in methods:
+        print(
+            f"{method}: {timings[method]:.2f} s ({timings[reference] / timings[method]:.2f}x w.r.t. {reference})"
+        )
+    print(comparison.to_string(index=False))
+
+    with open("data/method_comparison.pkl", "wb") as file:
+        pickle.dump({"timings": timings, "comparison": comparison}, file)
+
+    return comparison
 
 
 def run_simulation(
-    circuits, master_chain, device=False, QPU="ibm_sherbrooke", draw=False
+    circuits,
+    master_chain,
+    device=False,
+    QPU="ibm_sherbrooke",
+    draw=False,
+    batch_size=1,
+    max_parallel_experiments=1,
+    max_parallel_threads=0,
+    workers=1,
+    shard_size=50,
+    seed=None,
+    method="automatic",
+    fallback_method="matrix_product_state",
+    pauli_tolerance=0.0,
+    transpile_cache=False,
+    transpile_cache_size_mb=1000,
+    checkpoint=None,
+    noise_cache=False,
+    reduced_noise=False,
+    device_mode="batch",
+    device_chunk_size=100,
+    jobs_in_flight=3,
+    max_retries=3,
+    poll_interval=10,
+    local_runtime=None,
+    accumulator=None,
+    storage="pickle",
+    resources=None,
 ):
+    # resources: SimulationResources shared by several calls (simulators, noise
+    # models and worker pools built once)
 
-    if circuits[0].num_qubits == len(master_chain):
-        custom_layout = Layout.from_intlist(master_chain, circuits[0].qregs[0])
-    else:
-        # Id-BB84
-        custom_layout = None
+    custom_layout = get_custom_layout(circuits[0], master_chain)
+    cache = (
+        TranspileCache(max_size_mb=transpile_cache_size_mb) if transpile_cache else None
+    )
 
     if draw:
         circuit_drawer(circuits[0], output="mpl", fold=150).savefig("img/circuit.png")
@@ -222,69 +1234,155 @@ def run_simulation(
 
     # Use Sampler for simulation
     if not device:
-        # define simulator
-        backend = FakeSherbrooke()
-
-        # method = 'automatic', 'statevector', 'density_matrix', 'stabilizer', 'matrix_product_state', 'extended_stabilizer', 'unitary', 'superop', 'tensor_network'
-        noise_model = NoiseModel.from_backend(backend)
-        simulator = AerSimulator(
-            method="matrix_product_state", noise_model=noise_model, device="CPU"
+        method = select_method(
+            circuits,
+            method,
+            fallback_method,
+            master_chain,
+            QPU,
+            pauli_tolerance,
         )
-
-        list_count = []
-        num_circuits = len(circuits)
-        for progress, transpiled_qc in zip(
-            range(num_circuits), circuit_generator(circuits, backend, custom_layout)
-        ):
-            if progress % (ceil(num_circuits / 30)) == 0:
-                print(
-                    f"{100*progress/num_circuits:.2f}% completed: {progress} circuits run over {num_circuits}."
-                )
-                # force garbage collection
-                gc.collect()
-            result = simulator.run(transpiled_qc, shots=1).result()
-            counts = result.get_counts()
-            list_count.append(counts)
-            del transpiled_qc
-
+        print(f"Simulation method: {method}.")
+        if workers > 1:
+            # one simulator (and noise model) per worker process
+            list_count = run_sharded_simulation(
+                circuits,
+                master_chain,
+                workers=workers,
+                shard_size=shard_size,
+                seed=seed,
+                batch_size=batch_size,
+                max_parallel_threads=max(max_parallel_threads, 1),
+                method=method,
+                transpile_cache_size_mb=(
+                    transpile_cache_size_mb if transpile_cache else None
+                ),
+                checkpoint=checkpoint,
+                QPU=QPU,
+                noise_cache=noise_cache,
+                reduced_noise=reduced_noise,
+                accumulator=accumulator,
+                resources=resources,
+            )
+        else:
+            list_count = run_local_simulation(
+                circuits,
+                master_chain,
+                method=method,
+                batch_size=batch_size,
+                max_parallel_experiments=max_parallel_experiments,
+                max_parallel_threads=max_parallel_threads,
+                seed=seed,
+                cache=cache,
+                checkpoint=checkpoint,
+                QPU=QPU,
+                noise_cache=noise_cache,
+                reduced_noise=reduced_noise,
+                accumulator=accumulator,
+                resources=resources,
+            )
         print("100.00% Simulation completed.")
 
-        with open("data/results_local.pkl", "wb") as file:
-            pickle.dump(list_count, file)
+        if storage == "columnar":
+            # bit-packed counts, memory mapped by the analysis
+            write_counts("data/results_local_columns", list_count)
+        else:
+            with open("data/results_local.pkl", "wb") as file:
+                pickle.dump(list_count, file)
 
     else:
-        # load account and select real backend
+        if local_runtime is not None:
+            # offline stand-in of the runtime: jobs run on Aer with the noise model
+            # of the fake backend (local_runtime: options of LocalRuntimeService)
+            local_method = select_method(
+                circuits,
+                method,
+                fallback_method,
+                master_chain,
+                QPU,
+                pauli_tolerance,
+            )
+            qubits, couplers = (
+                noise_qubits(master_chain, circuits[0])
+                if reduced_noise
+                else (None, None)
+            )
 
-        load_dotenv()  # Load environment variables from .env file
-        api_token = os.getenv("IBMQ_API_TOKEN")
-        if api_token:
-            service = QiskitRuntimeService(channel="ibm_quantum", token=api_token)
-        else:
-            raise Exception("Unable to find API token")
-        # service = QiskitRuntimeService()
-        backend = service.backend(QPU)
-        # Transpile circuits for the simulator
-        transpiled_circuits = transpile(
-            circuits,
-            backend=backend,
-            initial_layout=custom_layout,
-            optimization_level=0,
-        )
+            def new_noise_model():
+                return build_noise_model(
+                    fake_backend(QPU),
+                    local_method,
+                    NoiseModelStore() if noise_cache else None,
+                    qubits,
+                    couplers,
+                )
 
-        sampler = Sampler(backend)
-        job = sampler.run(transpiled_circuits, shots=1)
-        result = job.result()
+            if resources is not None:
+                noise_model = resources.get(
+                    ("noise_model", QPU, local_method, repr(qubits), repr(couplers)),
+                    new_noise_model,
+                )
+            else:
+                noise_model = new_noise_model()
+            service = LocalRuntimeService(
+                noise_model=noise_model,
+                method=local_method,
+                seed=seed,
+                **local_runtime,
+            )
+            sampler_class = partial(LocalSampler, service=service)
+            mode_classes = {"batch": LocalBatch, "session": LocalSession}
+        else:
+            # load account and select real backend
 
-        with open("data/raw_results_device.pkl", "wb") as file:
-            pickle.dump(result, file)
+            load_dotenv()  # Load environment variables from .env file
+            api_token = os.getenv("IBMQ_API_TOKEN")
+            if api_token:
+                service = QiskitRuntimeService(channel="ibm_quantum", token=api_token)
+            else:
+                raise Exception("Unable to find API token")
+            # service = QiskitRuntimeService()
+            sampler_class = Sampler
+            mode_classes = {"batch": Batch, "session": Session}
+        backend = service.backend(QPU)
 
-        # Print results
-        list_count = []
-        for circ_res in result:
-            for val in circ_res.data.values():
-                list_count.append(val.get_counts())
+        def prepare(chunk):
+            # Transpile circuits for the device
+            if is_native(chunk[0]) or cache is not None:
+                return list(circuit_generator(chunk, backend, custom_layout, cache))
+            return transpile(
+                chunk,
+                backend=backend,
+                initial_layout=custom_layout,
+                optimization_level=0,
+            )
 
-        with open("data/results_device.pkl", "wb") as file:
-            pickle.dump(list_count, file)
+        # chunks of circuits submitted as separate jobs, results appended to the
+        # results file as soon as each job is done
+        manager = DeviceJobManager(
+            service,
+            backend,
+            sampler_class=sampler_class,
+            mode_class=mode_classes.get(device_mode),
+            chunk_size=device_chunk_size,
+            max_in_flight=jobs_in_flight,
+            max_retries=max_retries,
+            poll_interval=poll_interval,
+            checkpoint=checkpoint,
+            accumulator=accumulator,
+        )
+        manager.run(
+            circuits,
+            prepare,
+            results_path="data/results_device.pkl",
+            raw_results_path="data/raw_results_device.pkl",
+        )
+        list_count = load_pickle_stream("data/results_device.pkl")
+        if storage == "columnar":
+            # chunks are written as they finish: stored in circuit order once done
+            write_counts("data/results_device_columns", list_count)
+        if cache is not None:
+            cache.report()
 
-    return 0
+    # counts of every circuit, in circuit_idx order
+    return list_count
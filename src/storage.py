@@ -0,0 +1,286 @@
+from analysis import bit_matrix, measured_bits, count_tables
+from run_table import RunTable
+import pandas as pd
+import numpy as np
+import json
+import os
+
+# Columnar storage of the run data, the counts and the processed results: a store
+# is a directory with one raw binary file per column and meta.json (number of
+# rows, dtypes, categories). Columns are written a chunk at a time and memory
+# mapped when read, so that readers only touch the columns (and lengths) they use.
+# Measured bitstrings are stored bit-packed (ceil(width / 8) bytes per entry).
+
+# runs (see RunTable): bases as categorical codes (X = 0, Z = 1), bits -1 until
+# measured. Lengths and indices stay int32: Id-BB84 lengths are not bounded by
+# the chain
+DATA_DTYPES = {
+    "length": np.int32,
+    "alice_basis": np.int8,
+    "bob_basis": np.int8,
+    "alice_bit": np.int8,
+    "bob_bit": np.int8,
+    "virtual_qb": np.int32,
+    "cl_bit": np.int32,
+    "circuit_idx": np.int32,
+}
+DATA_CATEGORIES = {"alice_basis": ["X", "Z"], "bob_basis": ["X", "Z"]}
+
+
+class ColumnWriter:
+
+    def __init__(self, path, dtypes, shapes=None, categories=None, attrs=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in dtypes.items()}
+        # shape of each entry (bit-packed counts are rows of bytes)
+        self.shapes = shapes or {}
+        self.categories = categories or {}
+        self.attrs = attrs or {}
+        self.files = {
+            name: open(os.path.join(path, f"{idx}.bin"), "wb")
+            for idx, name in enumerate(self.dtypes)
+        }
+        self.num_rows = 0
+        self._write_meta()
+
+    def append(self, columns):
+        num_rows = None
+        for name, file in self.files.items():
+            values = np.asarray(columns[name])
+            dtype = self.dtypes[name]
+            if (
+                values.size
+                and np.issubdtype(values.dtype, np.integer)
+                and np.issubdtype(dtype, np.integer)
+                and not np.can_cast(values.dtype, dtype)
+            ):
+                # narrowing only if the values fit (no silent wrap around)
+                info = np.iinfo(dtype)
+                if values.min() < info.min or values.max() > info.max:
+                    raise Exception(f"Column {name} has values out of {dtype} range.")
+            array = np.ascontiguousarray(values, dtype=dtype)
+            if num_rows is not None and len(array) != num_rows:
+                raise Exception(f"Column {name} has {len(array)} rows, not {num_rows}.")
+            num_rows = len(array)
+            file.write(array.tobytes())
+            file.flush()
+        self.num_rows += num_rows
+        # readable after every chunk (e.g. while a simulation is running)
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {
+            "num_rows": self.num_rows,
+            "columns": [
+                {
+                    "name": name,
+                    "file": f"{idx}.bin",
+                    "dtype": dtype.str,
+                    "shape": list(self.shapes.get(name, ())),
+                }
+                for idx, (name, dtype) in enumerate(self.dtypes.items())
+            ],
+            "categories": self.categories,
+            "attrs": self.attrs,
+        }
+        tmp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class ColumnStore:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as file:
+            meta = json.load(file)
+        self.num_rows = meta["num_rows"]
+        self.columns = {column["name"]: column for column in meta["columns"]}
+        self.categories = meta["categories"]
+        self.attrs = meta["attrs"]
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, name):
+        # memory mapped, nothing is read until the values are used
+        column = self.columns[name]
+        shape = (self.num_rows, *column["shape"])
+        if self.num_rows == 0:
+            return np.empty(shape, dtype=column["dtype"])
+        return np.memmap(
+            os.path.join(self.path, column["file"]),
+            dtype=column["dtype"],
+            mode="r",
+            shape=shape,
+        )
+
+    def select(self, lengths):
+        # rows of the given lengths (from the length column only)
+        return np.flatnonzero(np.isin(self.column("length"), lengths))
+
+    def read(self, columns=None, lengths=None):
+        # dict of columns, restricted to the given lengths if any
+        columns = list(self.columns) if columns is None else columns
+        rows = None if lengths is None else self.select(lengths)
+        return {
+            name: self.column(name) if rows is None else self.column(name)[rows]
+            for name in columns
+        }
+
+    def frame(self, columns=None, lengths=None):
+        # DataFrame with the categorical columns decoded
+        frame = {}
+        for name, values in self.read(columns, lengths).items():
+            if name in self.categories:
+                values = pd.Categorical.from_codes(values, self.categories[name])
+            frame[name] = values
+        return pd.DataFrame(frame)
+
+
+def data_columns(data):
+    # runs (a RunTable or legacy data rows) as the columns of DATA_DTYPES
+    if not isinstance(data, RunTable):
+        data = RunTable.from_rows(data)
+    return data.columns()
+
+
+def read_run_table(path, lengths=None):
+    # runs of a data store (only the given lengths if any)
+    return RunTable.from_columns(ColumnStore(path).read(lengths=lengths))
+
+
+def data_writer(path):
+    return ColumnWriter(path, DATA_DTYPES, categories=DATA_CATEGORIES)
+
+
+def write_data(path, data, chunk_size=10**5):
+    with data_writer(path) as writer:
+        for start in range(0, len(data), chunk_size):
+            writer.append(data_columns(data[start : start + chunk_size]))
+
+
+class CountsWriter(ColumnWriter):
+    # measured bitstrings of single-shot counts, bit-packed in cl_bit order (width
+    # taken from the first counts if not given)
+
+    def __init__(self, path, width=None):
+        super().__init__(path, {"bits": np.uint8})
+        self.width = None
+        if width is not None:
+            self._set_width(width)
+
+    def _set_width(self, width):
+        self.width = width
+        self.shapes = {"bits": ((width + 7) // 8,)}
+        self.attrs = {"width": width}
+        self._write_meta()
+
+    def append_counts(self, counts):
+        if not counts:
+            return
+        bits = bit_matrix(counts)
+        if self.width is None:
+            self._set_width(bits.shape[1])
+        if bits.shape[1] != self.width:
+            raise Exception(
+                f"Bitstrings of {bits.shape[1]} bits in a store of {self.width}."
+            )
+        self.append({"bits": np.packbits(bits, axis=1)})
+
+
+def write_counts(path, counts, chunk_size=10**4):
+    with CountsWriter(path) as writer:
+        for start in range(0, len(counts), chunk_size):
+            writer.append_counts(counts[start : start + chunk_size])
+
+
+def read_bits(path, entries=None):
+    # bit matrix of the stored counts (bits[entry, cl_bit], as bit_matrix), only
+    # the given entries if any
+    store = ColumnStore(path)
+    packed = store.column("bits")
+    if entries is not None:
+        packed = packed[entries]
+    return np.unpackbits(packed, axis=1, count=store.attrs["width"])
+
+
+class PackedBits:
+    # bits[entry, cl_bit] gathered from the packed bytes, without unpacking the
+    # whole matrix (same indexing as the bit matrix for update_data)
+
+    def __init__(self, packed, width):
+        self.packed = packed
+        self.width = width
+
+    def __getitem__(self, index):
+        entry, position = index
+        position = np.asarray(position)
+        return (self.packed[entry, position >> 3] >> (7 - (position & 7))) & 1
+
+
+def read_packed(path):
+    store = ColumnStore(path)
+    return PackedBits(store.column("bits"), store.attrs["width"])
+
+
+def store_measured(data_path, counts_path, lengths=None):
+    # columns of a data store with the measured bits of Alice and Bob taken from
+    # a counts store, reading only the columns (and lengths) needed
+    columns = ColumnStore(data_path).read(
+        [
+            "length",
+            "alice_basis",
+            "bob_basis",
+            "alice_bit",
+            "virtual_qb",
+            "circuit_idx",
+        ],
+        lengths,
+    )
+    columns["alice_bit"], columns["bob_bit"] = measured_bits(
+        columns["length"],
+        columns["alice_bit"],
+        columns["virtual_qb"],
+        columns["circuit_idx"],
+        read_packed(counts_path),
+    )
+    return columns
+
+
+def store_tables(data_path, counts_path, lengths=None):
+    # count tables from a data store and a counts store
+    columns = store_measured(data_path, counts_path, lengths)
+    return count_tables(
+        columns["length"],
+        columns["alice_basis"],
+        columns["bob_basis"],
+        columns["alice_bit"],
+        columns["bob_bit"],
+    )
+
+
+def write_results(path, result_df):
+    # processed results (one row per length)
+    with ColumnWriter(path, result_df.dtypes.to_dict()) as writer:
+        writer.append({name: result_df[name].to_numpy() for name in result_df})
+
+
+def read_results(path, columns=None, lengths=None):
+    store = ColumnStore(path)
+    if columns is not None and "length" not in columns:
+        columns = ["length", *columns]
+    return store.frame(columns, lengths)
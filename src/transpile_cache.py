@@ -0,0 +1,128 @@
+from qiskit import qpy, transpile
+import hashlib
+import os
+
+
+class TranspileCache:
+    # transpiled circuits stored as QPY files, keyed by the structure of the
+    # virtual circuit, the backend, the layout and the optimization level.
+    # When the cache exceeds max_size_mb the least recently used files are removed.
+
+    def __init__(self, cache_dir="data/transpile_cache", max_size_mb=1000):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024**2
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        return [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.is_file() and entry.name.endswith(".qpy")
+        ]
+
+    def key(self, circuit, backend, initial_layout, optimization_level):
+        digest = hashlib.sha256()
+        # backend: name and supported operations
+        digest.update(backend.name.encode())
+        digest.update(repr(sorted(backend.operation_names)).encode())
+        digest.update(repr(optimization_level).encode())
+        if initial_layout is not None:
+            digest.update(repr([initial_layout[qb] for qb in circuit.qubits]).encode())
+        digest.update(repr((circuit.num_qubits, circuit.num_clbits)).encode())
+        # instruction stream
+        for instruction in circuit.data:
+            digest.update(
+                repr(
+                    (
+                        instruction.operation.name,
+                        tuple(float(param) for param in instruction.operation.params),
+                        tuple(circuit.find_bit(qb).index for qb in instruction.qubits),
+                        tuple(circuit.find_bit(cb).index for cb in instruction.clbits),
+                    )
+                ).encode()
+            )
+        return digest.hexdigest()
+
+    def transpile(self, circuit, backend, initial_layout=None, optimization_level=0):
+        key = self.key(circuit, backend, initial_layout, optimization_level)
+        path = os.path.join(self.cache_dir, f"{key}.qpy")
+
+        transpiled = self._load(path)
+        if transpiled is not None:
+            self.hits += 1
+        else:
+            transpiled = transpile(
+                circuit,
+                backend=backend,
+                initial_layout=initial_layout,
+                optimization_level=optimization_level,
+            )
+            self._store(path, transpiled)
+            self.misses += 1
+
+        # the structure is shared, name and metadata (e.g. template shots) are not
+        transpiled.name = circuit.name
+        transpiled.metadata = circuit.metadata
+        return transpiled
+
+    def _load(self, path):
+        # cached circuit, None if missing or unreadable
+        try:
+            with open(path, "rb") as file:
+                transpiled = qpy.load(file)[0]
+        except FileNotFoundError:
+            return None
+        except Exception as error:
+            # truncated (killed writer) or written by another qiskit version:
+            # removed, transpiled and stored again
+            print(f"Unreadable transpile cache file {path} ({error!r}), removed.")
+            try:
+                self.size -= os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                # already removed by another process
+                pass
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return transpiled
+
+    def _store(self, path, transpiled):
+        # write to a temporary file first: workers may share the same cache
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            qpy.dump(transpiled, file)
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        # remove least recently used circuits until the cache fits in max_size
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            self.size -= size
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def report(self):
+        print(
+            f"Transpile cache: {self.hits} hits, {self.misses} misses ({100*self.hit_rate():.2f}% hit rate), {self.size / 1024**2:.1f} MB on disk."
+        )